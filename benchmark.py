@@ -0,0 +1,1180 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.server
+import importlib.machinery
+import importlib.util
+import json
+import os
+import posixpath
+import random
+import re
+import shutil
+import signal
+import sqlite3
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.error
+import urllib.request
+
+def load_script(module_name, names):
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in names:
+        path = os.path.join(here, name)
+        if os.path.exists(path):
+            loader = importlib.machinery.SourceFileLoader(module_name, path)
+            spec = importlib.util.spec_from_loader(module_name, loader)
+            module = importlib.util.module_from_spec(spec)
+            loader.exec_module(module)
+            return module
+    raise Exception("Could not find %s next to %s" % (names[0], __file__))
+
+
+def load_vm_analyzer():
+    return load_script("vm_analyzer", ["vm-analyzer.py", "vm-analyzer"])
+
+
+class FakeGuestFS:
+    # In-memory stand-in for a launched guestfs handle. It only implements
+    # the calls the manifest code uses and counts every call, which is what
+    # a guestfsd round-trip costs on a real appliance.
+    def __init__(self, tree):
+        self._tree = tree
+        self.calls = {}
+        self.entries = 0
+
+
+    def _count(self, name, entries=0):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.entries += entries
+
+
+    def _lookup(self, path):
+        node = self._tree
+        for part in path.split("/"):
+            if not part:
+                continue
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+
+    def ls(self, path):
+        node = self._lookup(path)
+        if not isinstance(node, dict):
+            self._count("ls")
+            raise RuntimeError("ls: %s: No such file or directory" % path)
+        names = sorted(node.keys())
+        self._count("ls", len(names))
+        return names
+
+
+    def find(self, path):
+        node = self._lookup(path)
+        if not isinstance(node, dict):
+            self._count("find")
+            raise RuntimeError("find: %s: No such file or directory" % path)
+        founds = []
+        def walk(n, prefix):
+            for name in sorted(n.keys()):
+                founds.append(posixpath.join(prefix, name))
+                if isinstance(n[name], dict):
+                    walk(n[name], posixpath.join(prefix, name))
+        walk(node, "")
+        self._count("find", len(founds))
+        return founds
+
+
+    def is_file_opts(self, path, followsymlinks=False):
+        self._count("is_file_opts")
+        node = self._lookup(path)
+        return node is not None and not isinstance(node, dict)
+
+
+    def _stat(self, path):
+        node = self._lookup(path)
+        if node is None:
+            return {"st_ino": -1, "st_mode": 0, "st_size": 0, "st_mtime_sec": 0}
+        if isinstance(node, dict):
+            return {"st_ino": 1, "st_mode": stat.S_IFDIR | 0o755, "st_size": 4096, "st_mtime_sec": 0}
+        return {"st_ino": 1, "st_mode": stat.S_IFREG | 0o644, "st_size": len(node), "st_mtime_sec": 0}
+
+
+    def lstatnslist(self, path, names):
+        self._count("lstatnslist", len(names))
+        if not isinstance(self._lookup(path), dict):
+            raise RuntimeError("lstatnslist: %s: No such file or directory" % path)
+        return [self._stat(posixpath.join(path, name)) for name in names]
+
+
+    def readlinklist(self, path, names):
+        self._count("readlinklist", len(names))
+        return ["" for name in names]
+
+
+def synthetic_tree(system32_files, etc_files, depth):
+    def subtree(level):
+        if level == 0:
+            return {"f%d.dat" % i: b"" for i in range(20)}
+        return {"d%d" % i: subtree(level - 1) for i in range(4)}
+
+    system32 = {"file%06d.dll" % i: b"" for i in range(system32_files)}
+    system32.update({"screen%d.scr" % i: b"" for i in range(5)})
+    system32.update({"msiexec.exe": b"", "msi.dll": b"", "netapi32.dll": b""})
+    system32.update({"drivers": subtree(depth), "DriverStore": subtree(depth)})
+    etc = {"file%d.conf" % i: b"" for i in range(etc_files)}
+    etc.update({"hosts": b"", "group": b"", "sysconfig": subtree(depth)})
+    return {
+        "etc": etc,
+        "Windows": {"System32": system32},
+        "Program Files": {"Microsoft SQL Server": {"130": {}}},
+    }
+
+
+def legacy_expand(g, manifest):
+    # The expansion as it was done before the manifest was compiled: one
+    # recursive find() per wildcard entry, then one is_file_opts() per path.
+    ext_ap_files = []
+    for ap_file in manifest["files"]:
+        path = ap_file["path"]
+        if not path.startswith("/"):
+            path = re.sub("^.*/", "/", path)
+        if "*" in ap_file["path"]:
+            try:
+                founds = g.find(os.path.dirname(path))
+            except RuntimeError:
+                founds = []
+            for f in founds:
+                if re.compile(ap_file["path"]).match(f):
+                    ext_ap_files.append(f)
+        else:
+            ext_ap_files.append(path)
+    return [f for f in ext_ap_files if g.is_file_opts(f, followsymlinks=True)]
+
+
+def compiled_expand(g, vm_analyzer, matcher):
+    return [f["path"] for f in vm_analyzer.FileProber().probe(g, matcher.expand(g)) if f["type"] == "file"]
+
+
+def report(label, g, elapsed, hits):
+    calls = sum(g.calls.values())
+    print("%-10s %6d calls %9d entries %8.2f ms %4d hits  %s" % (label, calls, g.entries, elapsed * 1000, hits, g.calls))
+
+
+def bench_manifest(vm_analyzer, args):
+    tree = synthetic_tree(args.system32_files, args.etc_files, args.depth)
+
+    g = FakeGuestFS(tree)
+    start = time.perf_counter()
+    hits = legacy_expand(g, vm_analyzer.MANIFEST)
+    report("legacy", g, time.perf_counter() - start, len(hits))
+
+    g = FakeGuestFS(tree)
+    start = time.perf_counter()
+    matcher = vm_analyzer.ManifestMatcher(vm_analyzer.MANIFEST)
+    hits = compiled_expand(g, vm_analyzer, matcher)
+    report("compiled", g, time.perf_counter() - start, len(hits))
+
+
+def create_disk_image(path, size):
+    import guestfs
+    g = guestfs.GuestFS(python_return_dict=True)
+    g.set_backend("direct")
+    g.disk_create(path, "raw", size)
+    g.add_drive_opts(path, format="raw", readonly=0)
+    g.launch()
+    g.part_disk("/dev/sda", "mbr")
+    g.mkfs("ext4", "/dev/sda1")
+    g.mount("/dev/sda1", "/")
+    for directory in ["/etc", "/usr", "/var/lib"]:
+        g.mkdir_p(directory)
+    g.write("/etc/os-release", b'NAME="Fedora"\nID=fedora\nVERSION_ID=33\n')
+    g.write("/etc/hostname", b"benchmark\n")
+    g.umount_all()
+    g.shutdown()
+    g.close()
+
+
+def start_nbdkit(image, socket_path):
+    nbd_server = subprocess.Popen(['nbdkit', '--readonly', '--exit-with-parent', '--newstyle',
+                                   '--unix', socket_path, 'file', 'file=%s' % image])
+    for i in range(100):
+        if os.path.exists(socket_path):
+            return nbd_server
+        time.sleep(0.1)
+    nbd_server.kill()
+    raise Exception("nbdkit did not create %s" % socket_path)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def report_latencies(label, latencies):
+    print("%-10s n=%d mean=%.0fms p50=%.0fms p95=%.0fms" % (
+        label, len(latencies), 1000 * sum(latencies) / len(latencies),
+        1000 * percentile(latencies, 50), 1000 * percentile(latencies, 95)))
+
+
+def bench_pool(vm_analyzer, args):
+    # The pool only launches appliances ahead of time with the libvirt
+    # backend; anything else would compare cold scans with cold scans.
+    if not args.backend.startswith("libvirt") or args.pool_size <= 0:
+        raise Exception("The pool is disabled with backend %s and pool size %d" % (args.backend, args.pool_size))
+    workdir = tempfile.mkdtemp(prefix="vm-analyzer-bench-")
+    try:
+        image = args.image
+        if image is None:
+            image = os.path.join(workdir, "disk.img")
+            create_disk_image(image, 256 * 1024 * 1024)
+        socket_path = os.path.join(workdir, "disk.sock")
+        nbd_server = start_nbdkit(image, socket_path)
+
+        def scan(appliance):
+            appliance.add_nbd_drive(socket_path)
+            appliance.launch()
+            appliance.g.inspect_os()
+
+        latencies = []
+        for i in range(args.scans):
+            start = time.perf_counter()
+            appliance = vm_analyzer.Appliance(args.backend, False)
+            scan(appliance)
+            appliance.close()
+            latencies.append(time.perf_counter() - start)
+        report_latencies("cold", latencies)
+
+        pool = vm_analyzer.AppliancePool(args.pool_size, backend=args.backend)
+        pool.start()
+        latencies = []
+        for i in range(args.scans):
+            # Scans arrive with some idle time in between, as they would from
+            # the operator, which gives the pool time to refill.
+            time.sleep(args.interval)
+            start = time.perf_counter()
+            appliance = pool.acquire()
+            scan(appliance)
+            pool.release(appliance)
+            latencies.append(time.perf_counter() - start)
+        report_latencies("pooled", latencies)
+        print("pool: %s" % pool.stats())
+
+        nbd_server.kill()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class FakeChangedAreas:
+    # Stands in for vSphere Changed Block Tracking: every new_change() call
+    # rewrites some random extents of the image and records them as changed.
+    def __init__(self, image, size):
+        self._image = image
+        self._size = size
+        self._change = 0
+        self._areas = {}
+
+
+    def new_change(self, extents, extent_size):
+        self._change += 1
+        areas = []
+        with open(self._image, "r+b") as f:
+            for i in range(extents):
+                start = random.randrange(0, self._size - extent_size)
+                f.seek(start)
+                f.write(os.urandom(extent_size))
+                areas.append((start, extent_size))
+        self._areas[self._change] = areas
+
+
+    def disk_info(self, disk):
+        return { "uuid": "benchmark-disk", "key": 2000, "size": self._size, "change_id": "52 %d" % self._change }
+
+
+    def changed_areas(self, info, since_change_id):
+        since = int(since_change_id.split()[1])
+        return [area for change in range(since + 1, self._change + 1) for area in self._areas[change]]
+
+
+def bench_blockcache(vm_analyzer, args):
+    import nbd
+    workdir = tempfile.mkdtemp(prefix="vm-analyzer-bench-")
+    try:
+        size = args.size * 1024 * 1024
+        image = os.path.join(workdir, "disk.img")
+        with open(image, "wb") as f:
+            f.write(os.urandom(size))
+        store = vm_analyzer.BlockCacheStore(os.path.join(workdir, "cache"), size * 2, vm_analyzer.BLOCK_CACHE_BLOCK_SIZE)
+        provider = FakeChangedAreas(image, size)
+
+        # The same reads every round, like an inspection of an unchanged OS
+        rng = random.Random(42)
+        reads = [(rng.randrange(0, size - 65536), rng.choice([512, 4096, 65536])) for i in range(args.reads)]
+
+        for round in range(args.rounds):
+            if round > 0:
+                provider.new_change(args.changed_extents, 1024 * 1024)
+            info = provider.disk_info(None)
+            cache_dir, status = store.prepare(info["uuid"], size, info["change_id"],
+                                              lambda since: provider.changed_areas(info, since))
+
+            upstream = os.path.join(workdir, "up.sock")
+            statsfile = os.path.join(workdir, "up.stats")
+            upstream_server = subprocess.Popen(['nbdkit', '--readonly', '--exit-with-parent', '--newstyle',
+                                                '--unix', upstream, '--pidfile', upstream + '.pid', '--filter=stats',
+                                                'file', 'file=%s' % image, 'statsfile=%s' % statsfile])
+            proxy = os.path.join(workdir, "cache.sock")
+            proxy_server = subprocess.Popen(vm_analyzer.block_cache_cmd(proxy, proxy + '.pid', upstream, cache_dir))
+            vm_analyzer.wait_for_nbd_exports([
+                { "disk": "upstream", "pidfile": upstream + '.pid', "process": upstream_server },
+                { "disk": "cache", "pidfile": proxy + '.pid', "process": proxy_server }
+            ], 30)
+
+            start = time.perf_counter()
+            h = nbd.NBD()
+            h.connect_unix(proxy)
+            with open(image, "rb") as f:
+                for offset, count in reads:
+                    f.seek(offset)
+                    if h.pread(count, offset) != f.read(count):
+                        raise Exception("Round %d: stale data at offset %d" % (round, offset))
+            h.shutdown()
+            elapsed = time.perf_counter() - start
+
+            vm_analyzer.stop_nbdkit(proxy_server)
+            store.release(info["uuid"])
+            vm_analyzer.stop_nbdkit(upstream_server)
+            for path in [upstream + '.pid', proxy + '.pid']:
+                os.remove(path)
+            stats = vm_analyzer.read_nbdkit_stats(statsfile).get("read", {})
+            print("round %d %-11s upstream %5d requests %10d bytes %8.1f ms" % (
+                round, status, stats.get("requests", 0), stats.get("bytes", 0), elapsed * 1000))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class FakeInventoryServer(http.server.ThreadingHTTPServer):
+    # Stand-in for the Forklift inventory REST API of one vSphere provider.
+    # Every request is counted by path kind ("vm", "host", "vms", "hosts").
+    def __init__(self, vms, hosts, latency=0.0):
+        self.vms = dict((vm["id"], vm) for vm in vms)
+        self.hosts = dict((host["id"], host) for host in hosts)
+        self.latency = latency
+        self.calls = {}
+        self.lock = threading.Lock()
+        http.server.ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), FakeInventoryHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+
+    def count(self, kind):
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+
+class FakeInventoryHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        parts = self.path.split("?")[0].strip("/").split("/")
+        body = None
+        # providers/vsphere/<uid>/<collection>[/<id>]
+        if len(parts) == 4 and parts[3] in ["vms", "hosts"]:
+            self.server.count(parts[3])
+            body = list(getattr(self.server, parts[3]).values())
+        elif len(parts) == 5 and parts[3] in ["vms", "hosts"]:
+            self.server.count(parts[3][:-1])
+            body = getattr(self.server, parts[3]).get(parts[4])
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        content = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def synthetic_inventory(vm_count, host_count, disks_per_vm=2):
+    hosts = [{ "id": "host-%d" % i, "name": "esxi%d.example.com" % i, "thumbprint": "00:11:22" } for i in range(host_count)]
+    vms = []
+    for i in range(vm_count):
+        vms.append({
+            "id": "vm-%d" % i,
+            "uuid": "4201%04x-0000-0000-0000-%012x" % (i, i),
+            "host": { "kind": "Host", "id": "host-%d" % (i % host_count) },
+            "disks": [{
+                "file": "[datastore%d] vm-%d/vm-%d_%d.vmdk" % (i % 4, i, i, d),
+                "capacity": 16 * 1024 ** 3,
+                "changeId": "52 %d" % d
+            } for d in range(disks_per_vm)]
+        })
+    return vms, hosts
+
+
+def bench_inventory(vm_analyzer, args):
+    vms, hosts = synthetic_inventory(args.vms, args.hosts)
+    server = FakeInventoryServer(vms, hosts, args.latency)
+    os.environ["INVENTORY_URL"] = server.url
+    provider_url = vm_analyzer.get_inventory_db("benchmark")
+
+    errors = []
+
+    def scan_lookups(client, vm):
+        # The inventory lookups of a scan: UUID, host, then disks, which are
+        # always fetched again since they make the result fingerprint. A
+        # cache that serves another VM's data would skew the comparison.
+        uuid = client.get(provider_url + "/vms/" + vm["id"])["uuid"]
+        host = client.get(provider_url + "/hosts/" + client.get(provider_url + "/vms/" + vm["id"])["host"]["id"])
+        disks = client.get(provider_url + "/vms/" + vm["id"], max_age=0)["disks"]
+        if uuid != vm["uuid"] or host["id"] != vm["host"]["id"] or disks != vm["disks"]:
+            errors.append(vm["id"])
+
+    class UncachedClient:
+        def get(self, url, max_age=None):
+            return json.loads(vm_analyzer.requests.get(url).content)
+
+    # Every scan is requested twice, like the nightly rescans do
+    scans = vms * 2
+    for label, client, prefetch in [("uncached", UncachedClient(), False),
+                                    ("client", vm_analyzer.InventoryClient(), False),
+                                    ("prefetch", vm_analyzer.InventoryClient(), True)]:
+        server.calls = {}
+        start = time.perf_counter()
+        if prefetch:
+            client.prefetch(provider_url)
+        for i in range(0, len(scans), args.concurrency):
+            batch = [threading.Thread(target=scan_lookups, args=(client, vm)) for vm in scans[i:i + args.concurrency]]
+            for thread in batch:
+                thread.start()
+            for thread in batch:
+                thread.join()
+        elapsed = time.perf_counter() - start
+        if errors:
+            raise Exception("%s: wrong inventory data for %s" % (label, ", ".join(sorted(set(errors)))))
+        print("%-9s %6d server calls %8.1f ms  %s" % (label, sum(server.calls.values()), elapsed * 1000, server.calls))
+    server.shutdown()
+
+
+def package_key(app):
+    return (app["app2_name"], app["app2_epoch"], app["app2_version"], app["app2_release"], app["app2_arch"])
+
+
+def bench_packages(vm_analyzer, args):
+    # Needs a real guest image with an rpm or dpkg database, for example
+    # one made with virt-builder.
+    import guestfs
+    g = guestfs.GuestFS(python_return_dict=True)
+    g.set_backend(args.backend)
+    g.add_drive_opts(args.image, readonly=1)
+    g.launch()
+    for root in g.inspect_os():
+        mountpoints = g.inspect_get_mountpoints(root)
+        for mp in sorted(mountpoints, key=len):
+            g.mount_ro(mountpoints[mp], mp)
+        package_format = g.inspect_get_package_format(root)
+
+        runs = {
+            "libguestfs": lambda: g.inspect_list_applications2(root),
+            "native": lambda: vm_analyzer.PackageLister().list_applications(g, root, package_format)
+        }
+        warm = vm_analyzer.PackageLister()
+        runs["cached"] = lambda: warm.list_applications(g, root, package_format)
+        results = {}
+        for label, run in runs.items():
+            latencies = []
+            for i in range(args.rounds):
+                start = time.perf_counter()
+                results[label] = run()
+                latencies.append(time.perf_counter() - start)
+            report_latencies(label, latencies)
+
+        reference = set(package_key(app) for app in results["libguestfs"])
+        native = set(package_key(app) for app in results["native"])
+        print("%s (%s): %d packages, %d only in libguestfs, %d only in native" % (
+            g.inspect_get_product_name(root), package_format, len(reference),
+            len(reference - native), len(native - reference)))
+        print("cache: %s" % warm.stats())
+        g.umount_all()
+    g.shutdown()
+    g.close()
+
+
+def rpm_header(tags):
+    # An rpm header blob, as stored in rpmdb.sqlite, from {tag: value}.
+    # Integers are stored as INT32, strings as STRING.
+    index = b""
+    data = b""
+    for tag, value in sorted(tags.items()):
+        if isinstance(value, int):
+            data += b"\0" * (-len(data) % 4)
+            index += struct.pack(">IIiI", tag, 4, len(data), 1)
+            data += struct.pack(">i", value)
+        else:
+            index += struct.pack(">IIiI", tag, 6, len(data), 1)
+            data += value.encode() + b"\0"
+    return struct.pack(">II", len(tags), len(data)) + index + data
+
+
+def synthetic_rpmdb(path, package_count):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE Packages (hnum INTEGER PRIMARY KEY AUTOINCREMENT, blob BLOB NOT NULL)")
+    for i in range(package_count):
+        connection.execute("INSERT INTO Packages (blob) VALUES (?)", (rpm_header({
+            1000: "package%d" % i, 1001: "1.%d" % i, 1002: "1.el8", 1022: "x86_64",
+            1004: "Synthetic package %d" % i, 1005: "Synthetic package %d for benchmarks" % i
+        }),))
+    connection.commit()
+    connection.close()
+
+
+def write_linux_tree(g, workdir, args, fstab):
+    for directory in ["/etc/sysconfig", "/bin", "/sbin", "/usr/bin", "/lib", "/var/lib/rpm", "/opt/mssql/bin"]:
+        g.mkdir_p(directory)
+    g.write("/etc/redhat-release", b"Red Hat Enterprise Linux release 8.4 (Ootpa)\n")
+    g.write("/etc/os-release", b'NAME="Red Hat Enterprise Linux"\nID="rhel"\nVERSION_ID="8.4"\n')
+    g.write("/etc/hostname", b"benchmark\n")
+    g.write("/etc/fstab", fstab.encode())
+    g.write("/etc/hosts", b"127.0.0.1 localhost\n")
+    g.write("/etc/group", b"root:x:0:\n")
+    g.write("/opt/mssql/bin/mssql-conf", b"#!/bin/sh\n")
+    for i in range(args.etc_files):
+        g.write("/etc/file%d.conf" % i, b"# synthetic\n")
+    rpmdb = os.path.join(workdir, "rpmdb.sqlite")
+    synthetic_rpmdb(rpmdb, args.packages)
+    g.upload(rpmdb, "/var/lib/rpm/rpmdb.sqlite")
+    os.remove(rpmdb)
+
+
+def create_linux_images(g, paths, workdir, args):
+    # linux: /boot and an LVM volume group on one disk. multidisk: the
+    # volume group spans the first two disks and a third one holds /data.
+    g.part_init("/dev/sda", "mbr")
+    g.part_add("/dev/sda", "p", 2048, 526335)
+    g.part_add("/dev/sda", "p", 526336, -2048)
+    g.part_set_bootable("/dev/sda", 1, True)
+    g.mkfs("ext4", "/dev/sda1")
+    pvs = ["/dev/sda2"]
+    if len(paths) > 1:
+        g.pvcreate("/dev/sdb")
+        pvs.append("/dev/sdb")
+    g.pvcreate("/dev/sda2")
+    g.vgcreate("vg_bench", pvs)
+    g.lvcreate("var", "vg_bench", 256)
+    g.lvcreate_free("root", "vg_bench", 100)
+    g.mkfs("ext4", "/dev/vg_bench/root")
+    g.mkfs("ext4", "/dev/vg_bench/var")
+    fstab = "/dev/mapper/vg_bench-root / ext4 defaults 0 0\n/dev/sda1 /boot ext4 defaults 0 0\n/dev/mapper/vg_bench-var /var ext4 defaults 0 0\n"
+    if len(paths) > 2:
+        g.mkfs("ext4", "/dev/sdc")
+        fstab += "/dev/sdc /data ext4 defaults 0 0\n"
+    g.mount("/dev/vg_bench/root", "/")
+    for mp, device in [("/boot", "/dev/sda1"), ("/var", "/dev/vg_bench/var")] + ([("/data", "/dev/sdc")] if len(paths) > 2 else []):
+        g.mkdir_p(mp)
+        g.mount(device, mp)
+    write_linux_tree(g, workdir, args, fstab)
+
+
+def create_windows_image(g, paths, workdir, args):
+    # Inspection only recognizes Windows with real SYSTEM and SOFTWARE
+    # hives, which can't be generated here, so they come from --windows-hives.
+    g.part_disk("/dev/sda", "mbr")
+    g.part_set_bootable("/dev/sda", 1, True)
+    g.mkfs("ntfs", "/dev/sda1")
+    g.mount("/dev/sda1", "/")
+    for directory in ["/Windows/System32/config", "/Program Files/Microsoft SQL Server/140", "/Program Files/IBM/WebSphere/AppServer"]:
+        g.mkdir_p(directory)
+    for hive in ["SYSTEM", "SOFTWARE"]:
+        g.upload(os.path.join(args.windows_hives, hive), "/Windows/System32/config/%s" % hive)
+    for i in range(args.system32_files):
+        g.write("/Windows/System32/file%d.dll" % i, b"MZ")
+    for name in ["msiexec.exe", "msi.dll", "netapi32.dll", "scrnsave.scr"]:
+        g.write("/Windows/System32/%s" % name, b"MZ")
+
+
+E2E_PROFILES = {
+    "linux": { "disks": 1, "create": create_linux_images },
+    "multidisk": { "disks": 3, "create": create_linux_images },
+    "windows": { "disks": 1, "create": create_windows_image }
+}
+
+def create_profile_images(profile, image_dir, args):
+    # Images are built once and reused by later runs
+    paths = [os.path.join(image_dir, "%s-%d.img" % (profile, d)) for d in range(E2E_PROFILES[profile]["disks"])]
+    if all(os.path.exists(path) for path in paths):
+        return paths
+    import guestfs
+    g = guestfs.GuestFS(python_return_dict=True)
+    g.set_backend(args.backend)
+    for path in paths:
+        g.disk_create(path + ".tmp", "raw", args.disk_size * 1024 * 1024)
+        g.add_drive_opts(path + ".tmp", format="raw", readonly=0)
+    g.launch()
+    E2E_PROFILES[profile]["create"](g, paths, image_dir, args)
+    g.umount_all()
+    g.shutdown()
+    g.close()
+    for path in paths:
+        os.rename(path + ".tmp", path)
+    return paths
+
+
+class FakeTask:
+    def __init__(self, latency, result=None):
+        self.done_at = time.monotonic() + latency
+        self.info = types.SimpleNamespace(state="running", result=result)
+
+
+def fake_wait_for_task(task):
+    delay = task.done_at - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+    task.info.state = "success"
+
+
+class FakeSnapshot:
+    def __init__(self, vm, name):
+        self._moId = "snapshot-%s-%s" % (vm._moId, name)
+        self.vm = vm
+        self.name = name
+
+
+    def RemoveSnapshot_Task(self, removeChildren):
+        self.vm.removed += 1
+        return FakeTask(self.vm.latency["remove"])
+
+
+class FakeVirtualMachine:
+    def __init__(self, moref, latency):
+        self._moId = moref
+        self.latency = latency
+        self.snapshot = None
+        self.created = 0
+        self.removed = 0
+
+
+    def CreateSnapshot(self, name, description, memory, quiesce):
+        self.created += 1
+        return FakeTask(self.latency["snapshot"], FakeSnapshot(self, name))
+
+
+class FakeServiceInstance:
+    # The parts of a vSphere ServiceInstance that VmAnalyzer uses
+    def __init__(self, vms):
+        self._vms = vms
+        self.content = types.SimpleNamespace(
+            rootFolder = None,
+            searchIndex = types.SimpleNamespace(FindByUuid=self.FindByUuid),
+            viewManager = types.SimpleNamespace(CreateContainerView=self.CreateContainerView)
+        )
+
+
+    def FindByUuid(self, uuid, vmSearch, instanceUuid=False):
+        return self._vms.get(uuid)
+
+
+    def CreateContainerView(self, container, type, recursive):
+        return types.SimpleNamespace(view=list(self._vms.values()), Destroy=lambda: None)
+
+
+    def CurrentTime(self):
+        return time.time()
+
+
+def fake_vsphere_session(service_instance, login_latency):
+    class FakeVsphereSession:
+        def __init__(self, key, host, username, password):
+            time.sleep(login_latency)
+            self.si = service_instance
+            self.key = key
+            self.host = host
+            self.last_used = time.monotonic()
+
+
+        def bind(self, managed_object):
+            return managed_object
+
+
+        def ping(self):
+            self.last_used = time.monotonic()
+
+
+        def close(self):
+            pass
+
+    return FakeVsphereSession
+
+
+def bench_serve(vm_analyzer, args):
+    # vm-analyzer's own main(), with vSphere replaced by the fakes above.
+    # Started by the e2e benchmark, which passes the VMs in a JSON file.
+    with open(args.config) as f:
+        config = json.load(f)
+    latency = { "snapshot": config["snapshot_latency"], "remove": config["remove_latency"] }
+    vms = dict((vm["uuid"], FakeVirtualMachine(vm["id"], latency)) for vm in config["vms"])
+    vm_analyzer.VsphereSession = fake_vsphere_session(FakeServiceInstance(vms), config["login_latency"])
+    vm_analyzer.WaitForTask = fake_wait_for_task
+    vm_analyzer.main()
+
+
+def http_json(method, url, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, method=method, headers={ "Content-Type": "application/json" })
+    try:
+        with urllib.request.urlopen(req) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b"{}")
+
+
+def read_metrics(url):
+    metrics = {}
+    with urllib.request.urlopen(url + "/metrics") as response:
+        for line in response.read().decode().splitlines():
+            if line and not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                metrics[name] = float(value)
+    return metrics
+
+
+def run_e2e_level(args, concurrency, config_path, file_root, vms):
+    url = "http://127.0.0.1:5000"
+    env = dict(os.environ,
+               NBDKIT_PLUGIN = "file",
+               NBDKIT_FILE_ROOT = file_root,
+               INVENTORY_URL = args.inventory_url,
+               MANIFEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "manifest.json"),
+               APPLIANCE_BACKEND = args.backend,
+               APPLIANCE_POOL_SIZE = str(args.pool_size),
+               SCAN_WORKERS = str(concurrency),
+               SCAN_QUEUE_SIZE = str(max(100, concurrency * 2)),
+               SCAN_MAX_PER_HOST = str(concurrency),
+               SCAN_MAX_PER_DATASTORE = str(concurrency),
+               TRIAGE_DISKS = "true" if args.triage else "false")
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve", "--config", config_path],
+                              env=env, stdout=subprocess.DEVNULL if not args.verbose else None, stderr=subprocess.STDOUT)
+    try:
+        for i in range(300):
+            try:
+                urllib.request.urlopen(url + "/debug")
+                break
+            except Exception:
+                if server.poll() is not None:
+                    raise Exception("vm-analyzer exited with code %d" % server.returncode)
+                time.sleep(0.1)
+
+        lock = threading.Lock()
+        submitted = [0]
+        results = []
+
+        def client(index):
+            while True:
+                with lock:
+                    if submitted[0] >= args.scans:
+                        return
+                    vm = vms[submitted[0] % len(vms)]
+                    submitted[0] += 1
+                started = time.perf_counter()
+                body = {
+                    "provider": { "uid": "bench" },
+                    "vm": { "moref": vm["id"] },
+                    "host_authentication": { "username": "root", "password": "bench" },
+                    "force": True
+                }
+                while True:
+                    status, job = http_json("POST", url + "/scan", body)
+                    if status != 429:
+                        break
+                    time.sleep(1)
+                while job.get("status") in ["queued", "running"]:
+                    time.sleep(args.poll_interval)
+                    status, job = http_json("GET", url + "/scan/%s" % job["id"])
+                with lock:
+                    results.append({
+                        "vm": vm["id"],
+                        "profile": vm["profile"],
+                        "status": job.get("status"),
+                        "error": job.get("error"),
+                        "seconds": time.perf_counter() - started,
+                        "timings": (job.get("result") or {}).get("timings", {})
+                    })
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        metrics = read_metrics(url)
+    finally:
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(60)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+
+    done = [r for r in results if r["status"] == "done"]
+    phases = {}
+    for result in done:
+        for phase, seconds in result["timings"].items():
+            phases.setdefault(phase, []).append(seconds)
+    return {
+        "concurrency": concurrency,
+        "scans": len(results),
+        "failed": len(results) - len(done),
+        "errors": sorted(set(r["error"] for r in results if r["error"])),
+        "elapsed": round(elapsed, 3),
+        "scans_per_minute": round(60 * len(done) / elapsed, 2),
+        "latency": dict(("p%d" % p, round(percentile([r["seconds"] for r in done], p), 3)) for p in [50, 95]) if done else {},
+        "phases": dict((phase, { "p50": round(percentile(values, 50), 3), "p95": round(percentile(values, 95), 3) })
+                       for phase, values in phases.items()),
+        "peak_rss_bytes": {
+            "self": metrics.get('vm_analyzer_max_rss_bytes{process="self"}'),
+            "children": metrics.get('vm_analyzer_max_rss_bytes{process="children"}')
+        }
+    }
+
+
+def report_e2e_level(level, previous=None):
+    def delta(key, value):
+        if previous is None or previous.get(key) in [None, 0] or value is None:
+            return ""
+        return " (%+.0f%%)" % (100.0 * (value - previous[key]) / previous[key])
+    print("concurrency %d: %d scans, %d failed, %.1f scans/min%s, p50 %.1fs, p95 %.1fs, peak RSS %.0f MiB (children %.0f MiB)" % (
+        level["concurrency"], level["scans"], level["failed"], level["scans_per_minute"],
+        delta("scans_per_minute", level["scans_per_minute"]),
+        level["latency"].get("p50", 0), level["latency"].get("p95", 0),
+        (level["peak_rss_bytes"]["self"] or 0) / 1024 ** 2, (level["peak_rss_bytes"]["children"] or 0) / 1024 ** 2))
+    for phase, values in level["phases"].items():
+        print("    %-13s p50 %8.3fs  p95 %8.3fs" % (phase, values["p50"], values["p95"]))
+    for error in level["errors"]:
+        print("    error: %s" % error)
+
+
+def bench_e2e(vm_analyzer, args):
+    # Scans synthetic VMs through POST /scan end to end: disks served by the
+    # nbdkit file plugin, the inventory by FakeInventoryServer and vSphere
+    # by the fakes above, in a vm-analyzer subprocess per concurrency level.
+    profiles = args.profiles.split(",")
+    if "windows" in profiles and not args.windows_hives:
+        print("Skipping the windows profile, it needs --windows-hives")
+        profiles.remove("windows")
+    os.makedirs(args.image_dir, exist_ok=True)
+    images = dict((profile, create_profile_images(profile, args.image_dir, args)) for profile in profiles)
+
+    workdir = tempfile.mkdtemp(prefix="vm-analyzer-e2e-")
+    try:
+        # Every VM gets links to its profile's images, as its own datastore files
+        file_root = os.path.join(workdir, "datastores")
+        inventory_vms = []
+        vms = []
+        for i in range(args.vms):
+            profile = profiles[i % len(profiles)]
+            disks = []
+            for d, image in enumerate(images[profile]):
+                os.makedirs(os.path.join(file_root, "bench", "vm-%d" % i), exist_ok=True)
+                os.symlink(os.path.abspath(image), os.path.join(file_root, "bench", "vm-%d" % i, "disk%d.vmdk" % d))
+                disks.append({ "file": "[bench] vm-%d/disk%d.vmdk" % (i, d), "capacity": os.path.getsize(image), "changeId": "52 %d" % d })
+            inventory_vms.append({ "id": "vm-%d" % i, "uuid": "4201%04x-0000-0000-0000-%012x" % (i, i),
+                                   "host": { "kind": "Host", "id": "host-0" }, "disks": disks })
+            vms.append({ "id": "vm-%d" % i, "profile": profile })
+        server = FakeInventoryServer(inventory_vms, [{ "id": "host-0", "name": "esxi0.example.com", "thumbprint": "00:11:22" }])
+        args.inventory_url = server.url
+
+        config_path = os.path.join(workdir, "vsphere.json")
+        with open(config_path, "w") as f:
+            json.dump({
+                "vms": inventory_vms,
+                "login_latency": args.login_latency,
+                "snapshot_latency": args.snapshot_latency,
+                "remove_latency": args.snapshot_latency
+            }, f)
+
+        previous = {}
+        if args.compare:
+            with open(args.compare) as f:
+                previous = dict((level["concurrency"], level) for level in json.load(f)["levels"])
+
+        run = {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "profiles": profiles,
+            "vms": args.vms,
+            "backend": args.backend,
+            "levels": []
+        }
+        for concurrency in [int(c) for c in args.concurrency.split(",")]:
+            level = run_e2e_level(args, concurrency, config_path, file_root, vms)
+            report_e2e_level(level, previous.get(concurrency))
+            run["levels"].append(level)
+        server.shutdown()
+
+        output = args.output or os.path.join("benchmark-results", "e2e-%s.json" % time.strftime("%Y%m%d-%H%M%S"))
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(run, f, indent=2)
+        print("Results saved to %s" % output)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class FakeVimStub:
+    # Stands in for the SOAP stub of a vCenter with synthetic VMs, for
+    # pyVmomi managed objects bound to it. Every property read and method
+    # call is a round-trip to vCenter, so each one is counted and delayed by
+    # latency seconds. RetrievePropertiesEx and ContinueRetrievePropertiesEx
+    # implement the property specs VmHardwareCollector uses.
+    def __init__(self, vm_count, disks_per_vm, datastore_count, latency=0.0):
+        from pyVmomi import vim, vmodl
+        self._vim = vim
+        self.latency = latency
+        self.calls = 0
+        self._pages = {}
+        self.datastores = dict(("datastore-%d" % i, {
+            "name": "datastore%d" % i,
+            "summary.url": "ds:///vmfs/volumes/%08x-0000/" % i
+        }) for i in range(datastore_count))
+        self.vms = {}
+        for i in range(vm_count):
+            devices = [vim.vm.device.VirtualE1000(key=4000)]
+            for d in range(disks_per_vm):
+                ds = (i + d) % datastore_count
+                devices.append(vim.vm.device.VirtualDisk(
+                    key = 2000 + d,
+                    capacityInBytes = 16 * 1024 ** 3,
+                    backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+                        fileName = "[datastore%d] vm-%d/vm-%d_%d.vmdk" % (ds, i, i, d),
+                        datastore = vim.Datastore("datastore-%d" % ds, self),
+                        uuid = "6000C29%d-%04d" % (i, d),
+                        thinProvisioned = True
+                    )
+                ))
+            self.vms["vm-%d" % i] = {
+                "config.uuid": "4201%04x-0000-0000-0000-%012x" % (i, i),
+                "config.hardware.device": devices
+            }
+        self.content = vim.ServiceInstanceContent(
+            rootFolder = vim.Folder("group-d1", self),
+            viewManager = vim.view.ViewManager("ViewManager", self),
+            propertyCollector = vmodl.query.PropertyCollector("propertyCollector", self)
+        )
+
+
+    def service_instance(self):
+        return self._vim.ServiceInstance("ServiceInstance", self)
+
+
+    def _round_trip(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+    def InvokeAccessor(self, mo, info):
+        self._round_trip()
+        vim = self._vim
+        if mo._moId == "ServiceInstance" and info.name == "content":
+            return self.content
+        if mo._moId == "view-1" and info.name == "view":
+            return [vim.VirtualMachine(moid, self) for moid in self.vms]
+        if mo._moId in self.vms and info.name == "config":
+            props = self.vms[mo._moId]
+            return vim.vm.ConfigInfo(uuid=props["config.uuid"], hardware=vim.vm.VirtualHardware(device=props["config.hardware.device"]))
+        if mo._moId in self.vms and info.name == "runtime":
+            return vim.vm.RuntimeInfo(host=vim.HostSystem("host-1", self))
+        if mo._moId in self.datastores and info.name == "name":
+            return self.datastores[mo._moId]["name"]
+        if mo._moId in self.datastores and info.name == "summary":
+            return vim.Datastore.Summary(url=self.datastores[mo._moId]["summary.url"])
+        raise Exception("FakeVimStub has no %s on %s" % (info.name, mo._moId))
+
+
+    def InvokeMethod(self, mo, info, args):
+        self._round_trip()
+        if info.name == "CreateContainerView":
+            return self._vim.view.ContainerView("view-1", self)
+        if info.name == "Destroy":
+            return None
+        if info.name == "RetrievePropertiesEx":
+            return self._retrieve(args[0], args[1])
+        if info.name == "ContinueRetrievePropertiesEx":
+            return self._page(args[0])
+        raise Exception("FakeVimStub has no method %s" % info.name)
+
+
+    def _retrieve(self, spec_set, options):
+        objects = []
+        for spec in spec_set:
+            paths = spec.propSet[0].pathSet
+            for object_spec in spec.objectSet:
+                # A traversal can only be the one over the container view
+                if object_spec.selectSet:
+                    targets = [self._vim.VirtualMachine(moid, self) for moid in self.vms]
+                else:
+                    targets = [object_spec.obj]
+                for target in targets:
+                    props = self.vms.get(target._moId) or self.datastores.get(target._moId) or {}
+                    objects.append(types.SimpleNamespace(
+                        obj = target,
+                        propSet = [types.SimpleNamespace(name=path, val=props[path]) for path in paths if path in props]
+                    ))
+        token = "token-%d" % len(self._pages)
+        self._pages[token] = (objects, options.maxObjects or len(objects))
+        return self._page(token)
+
+
+    def _page(self, token):
+        objects, page_size = self._pages.pop(token)
+        if not objects:
+            return None
+        if len(objects) > page_size:
+            self._pages[token] = (objects[page_size:], page_size)
+        return types.SimpleNamespace(objects=objects[:page_size], token=token if len(objects) > page_size else None)
+
+
+def legacy_find_vm(si, vm_uuid):
+    from pyVmomi import vim
+    view = si.content.viewManager.CreateContainerView(si.content.rootFolder, [vim.VirtualMachine], True)
+    for c in view.view:
+        if c.config.uuid == vm_uuid:
+            return c
+
+
+def legacy_hardware(vm):
+    # The old code read the host of the VM without using it; keep the round
+    # trip so the baseline costs what it used to
+    _ = vm.runtime.host
+    disks = []
+    for device in vm.config.hardware.device:
+        if type(device).__name__ == 'vim.vm.device.VirtualDisk':
+            datastore = device.backing.datastore
+            disks.append({
+                "path": device.backing.fileName.replace("[%s] " % datastore.name, ""),
+                "storage_name": datastore.name,
+                "storage_path": datastore.summary.url.replace("ds://", "")
+            })
+    return disks
+
+
+def bench_hardware(vm_analyzer, args):
+    break2 = load_script("break2", ["break2.py"])
+    stub = FakeVimStub(args.vms, args.disks, args.datastores, args.latency)
+    si = stub.service_instance()
+    target = stub.vms["vm-%d" % (args.vms - 1)]["config.uuid"]
+
+    def legacy_single():
+        return legacy_hardware(legacy_find_vm(si, target))
+
+    def legacy_batch():
+        from pyVmomi import vim
+        view = si.content.viewManager.CreateContainerView(si.content.rootFolder, [vim.VirtualMachine], True)
+        return dict((c.config.uuid, legacy_hardware(c)) for c in view.view)
+
+    runs = [
+        ("legacy one VM", legacy_single),
+        ("collector one VM", lambda: break2.VmHardwareCollector(si, args.page_size).collect([target])),
+        ("legacy all VMs", legacy_batch),
+        ("collector all VMs", lambda: break2.VmHardwareCollector(si, args.page_size).collect())
+    ]
+    for label, run in runs:
+        stub.calls = 0
+        start = time.perf_counter()
+        run()
+        print("%-18s %7d round-trips %10.1f ms" % (label, stub.calls, (time.perf_counter() - start) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VM Analyzer benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    manifest = subparsers.add_parser("manifest", help="Manifest expansion against a synthetic tree")
+    manifest.add_argument("--system32-files", type=int, default=200000)
+    manifest.add_argument("--etc-files", type=int, default=200)
+    manifest.add_argument("--depth", type=int, default=3)
+    manifest.set_defaults(func=bench_manifest)
+
+    pool = subparsers.add_parser("pool", help="Scan latency with and without the appliance pool")
+    pool.add_argument("--image", help="Disk image to serve with nbdkit (default: a generated one)")
+    pool.add_argument("--backend", default="libvirt")
+    pool.add_argument("--pool-size", type=int, default=2)
+    pool.add_argument("--scans", type=int, default=10)
+    pool.add_argument("--interval", type=float, default=5.0)
+    pool.set_defaults(func=bench_pool)
+
+    blockcache = subparsers.add_parser("blockcache", help="Upstream reads of incremental rescans through the block cache")
+    blockcache.add_argument("--size", type=int, default=512, help="Disk size in MiB")
+    blockcache.add_argument("--reads", type=int, default=2000)
+    blockcache.add_argument("--rounds", type=int, default=4)
+    blockcache.add_argument("--changed-extents", type=int, default=8, help="1 MiB extents changed between rounds")
+    blockcache.set_defaults(func=bench_blockcache)
+
+    inventory = subparsers.add_parser("inventory", help="Inventory calls of scans against a stand-in server")
+    inventory.add_argument("--vms", type=int, default=200)
+    inventory.add_argument("--hosts", type=int, default=8)
+    inventory.add_argument("--concurrency", type=int, default=16)
+    inventory.add_argument("--latency", type=float, default=0.005, help="Server latency in seconds")
+    inventory.set_defaults(func=bench_inventory)
+
+    packages = subparsers.add_parser("packages", help="Native package listing against inspect_list_applications2")
+    packages.add_argument("--image", required=True, help="Guest disk image with an rpm or dpkg database")
+    packages.add_argument("--backend", default="direct")
+    packages.add_argument("--rounds", type=int, default=5)
+    packages.set_defaults(func=bench_packages)
+
+    e2e = subparsers.add_parser("e2e", help="POST /scan throughput on synthetic VMs, with stand-ins for vSphere, VDDK and the inventory")
+    e2e.add_argument("--profiles", default="linux,multidisk", help="Comma-separated from linux, multidisk, windows")
+    e2e.add_argument("--windows-hives", help="Directory with SYSTEM and SOFTWARE hives for the windows profile")
+    e2e.add_argument("--image-dir", default="benchmark-images", help="Where the synthetic images are built and kept")
+    e2e.add_argument("--disk-size", type=int, default=1024, help="Disk size in MiB")
+    e2e.add_argument("--packages", type=int, default=500, help="Packages in the synthetic rpmdb")
+    e2e.add_argument("--etc-files", type=int, default=200)
+    e2e.add_argument("--system32-files", type=int, default=2000)
+    e2e.add_argument("--vms", type=int, default=8)
+    e2e.add_argument("--scans", type=int, default=16, help="Scans per concurrency level")
+    e2e.add_argument("--concurrency", default="1,2,4", help="Comma-separated concurrency levels")
+    e2e.add_argument("--backend", default="direct")
+    e2e.add_argument("--pool-size", type=int, default=2)
+    e2e.add_argument("--triage", action="store_true", help="Enable disk triage")
+    e2e.add_argument("--login-latency", type=float, default=0.2, help="Seconds per fake vSphere login")
+    e2e.add_argument("--snapshot-latency", type=float, default=2.0, help="Seconds per fake snapshot create or remove")
+    e2e.add_argument("--poll-interval", type=float, default=0.2)
+    e2e.add_argument("--output", help="Results file (default: benchmark-results/e2e-<time>.json)")
+    e2e.add_argument("--compare", help="Results file of an earlier run to compare with")
+    e2e.add_argument("--verbose", action="store_true", help="Show the vm-analyzer output")
+    e2e.set_defaults(func=bench_e2e)
+
+    hardware = subparsers.add_parser("hardware", help="vSphere round-trips of VM hardware collection against a fake vCenter")
+    hardware.add_argument("--vms", type=int, default=5000)
+    hardware.add_argument("--disks", type=int, default=2, help="Disks per VM")
+    hardware.add_argument("--datastores", type=int, default=20)
+    hardware.add_argument("--page-size", type=int, default=500)
+    hardware.add_argument("--latency", type=float, default=0.0, help="Seconds per round-trip")
+    hardware.set_defaults(func=bench_hardware)
+
+    serve = subparsers.add_parser("serve", help="vm-analyzer with fake vSphere, used by e2e")
+    serve.add_argument("--config", required=True)
+    serve.set_defaults(func=bench_serve)
+
+    args = parser.parse_args()
+    args.func(load_vm_analyzer(), args)
+
+
+if __name__ == '__main__':
+    main()
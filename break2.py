@@ -13,13 +13,131 @@ import sys
 import time
 import uuid
 
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
 from pyVim.connect import SmartStubAdapter, VimSessionOrientedStub, Disconnect
 from pyVim.task import WaitForTask
 
 from flask import Flask, request, jsonify
 from flask_restful import Resource, Api, reqparse
 
+class VmHardwareCollector:
+    # Reads the hardware of one VM or many with a few paged PropertyCollector
+    # calls, instead of fetching config, datastore name and URL object by
+    # object. UUIDs are read first over a view of all the VMs, then the
+    # devices of the wanted ones, then their datastores.
+    def __init__(self, service_instance, page_size=500):
+        self._content = service_instance.content
+        self._page_size = page_size
+
+
+    def _retrieve(self, object_specs, obj_type, paths):
+        property_collector = self._content.propertyCollector
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet = object_specs,
+            propSet = [vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=paths, all=False)]
+        )
+        options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=self._page_size)
+        contents = []
+        result = property_collector.RetrievePropertiesEx([filter_spec], options)
+        while result:
+            for content in result.objects:
+                contents.append((content.obj, dict((prop.name, prop.val) for prop in content.propSet or [])))
+            if not result.token:
+                break
+            result = property_collector.ContinueRetrievePropertiesEx(result.token)
+        return contents
+
+
+    def _all_vms(self, paths):
+        view = self._content.viewManager.CreateContainerView(self._content.rootFolder, [vim.VirtualMachine], True)
+        try:
+            traversal = vmodl.query.PropertyCollector.TraversalSpec(name="traverseView", path="view", skip=False, type=vim.view.ContainerView)
+            return self._retrieve([vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])],
+                                  vim.VirtualMachine, paths)
+        finally:
+            view.Destroy()
+
+
+    @staticmethod
+    def _is_disk(device):
+        return type(device).__name__ == 'vim.vm.device.VirtualDisk'
+
+
+    def collect(self, vm_uuids=None):
+        # Returns { uuid: { "vm": vm, "hardware": ... } } for the given UUIDs,
+        # or for all the VMs.
+        if vm_uuids is None:
+            vms = self._all_vms(["config.uuid", "config.hardware.device"])
+        else:
+            wanted = [vm for vm, props in self._all_vms(["config.uuid"]) if props.get("config.uuid") in vm_uuids]
+            if not wanted:
+                return {}
+            vms = self._retrieve([vmodl.query.PropertyCollector.ObjectSpec(obj=vm, skip=False) for vm in wanted],
+                                 vim.VirtualMachine, ["config.uuid", "config.hardware.device"])
+
+        datastores = {}
+        for vm, props in vms:
+            for device in props.get("config.hardware.device") or []:
+                if self._is_disk(device) and device.backing.datastore is not None:
+                    datastores[device.backing.datastore._moId] = device.backing.datastore
+        datastore_props = {}
+        if datastores:
+            for datastore, props in self._retrieve([vmodl.query.PropertyCollector.ObjectSpec(obj=ds, skip=False) for ds in datastores.values()],
+                                                   vim.Datastore, ["name", "summary.url"]):
+                datastore_props[datastore._moId] = props
+
+        collected = {}
+        for vm, props in vms:
+            if "config.uuid" not in props:
+                continue
+            hardware = {
+                "metadata": {
+                    "vmware_moref": vm._moId
+                },
+                "disks": [],
+            }
+            for device in props.get("config.hardware.device") or []:
+                if not self._is_disk(device):
+                    continue
+                datastore = datastore_props.get(device.backing.datastore._moId, {}) if device.backing.datastore is not None else {}
+                hardware["disks"].append({
+                    "id": device.backing.uuid,
+                    "key": device.key,
+                    "path": device.backing.fileName.replace("[%s] " % datastore.get("name"), ""),
+                    "size": device.capacityInBytes,
+                    "storage_name": datastore.get("name"),
+                    "storage_path": (datastore.get("summary.url") or "").replace("ds://", ""),
+                    "is_sparse": device.backing.thinProvisioned,
+                    "is_rdm": type(device.backing).__name__ == 'vim.vm.device.VirtualDisk.VirtualDiskRawDiskMappingVer1BackingInfo'
+                })
+            collected[props["config.uuid"]] = { "vm": vm, "hardware": hardware }
+        return collected
+
+
+def connect(authentication):
+    # https://github.com/vmware/pyvmomi/issues/347#issuecomment-297591340
+    print("Connecting to %s as %s" % (authentication["hostname"], authentication["username"]))
+    smart_stub = SmartStubAdapter(
+        host = authentication["hostname"],
+        port = 443,
+        sslContext = ssl._create_unverified_context(),
+        connectionPoolTimeout = 0
+    )
+    session_stub = VimSessionOrientedStub(
+        smart_stub,
+        VimSessionOrientedStub.makeUserLoginMethod(
+            authentication["username"],
+            authentication["password"]
+        )
+    )
+    si = vim.ServiceInstance('ServiceInstance', session_stub)
+
+    if not si:
+        raise Exception("Could not connect to %s" % authentication["hostname"])
+
+    return si
+
+
 class VmAnalyzer:
     def __init__(self, request):
         self._request = request
@@ -41,27 +159,7 @@ class VmAnalyzer:
 
 
     def _connect(self):
-        # https://github.com/vmware/pyvmomi/issues/347#issuecomment-297591340
-        print("Connecting to %s as %s" % (self._request["authentication"]["hostname"], self._request["authentication"]["username"]))
-        smart_stub = SmartStubAdapter(
-            host = self._request["authentication"]["hostname"],
-            port = 443,
-            sslContext = ssl._create_unverified_context(),
-            connectionPoolTimeout = 0
-        )
-        session_stub = VimSessionOrientedStub(
-            smart_stub,
-            VimSessionOrientedStub.makeUserLoginMethod(
-                self._request["authentication"]["username"],
-                self._request["authentication"]["password"]
-            )
-        )
-        si = vim.ServiceInstance('ServiceInstance', session_stub)
-
-        if not si:
-            raise Exception("Could not connect to %s" % self._request["authentication"]["hostname"])
-
-        return si
+        return connect(self._request["authentication"])
 
 
     def _disconnect(self):
@@ -73,17 +171,11 @@ class VmAnalyzer:
 
     def _find_vm_by_id(self, vm_id):
         print("Looking for virtual machine with UUID '%s'" % vm_id)
-        # TODO: understand why FindByUuid fails
-        # search_index = self._service_instance.content.searchIndex
-        # vm = search_index.FindByUuid(None, vm_id, True, True)
-        view_manager = self._service_instance.content.viewManager
-        container = view_manager.CreateContainerView(self._service_instance.content.rootFolder, [vim.VirtualMachine], True)
-        for c in container.view:
-            if c.config.uuid == vm_id:
-                vm = c
-        if vm is None:
+        collected = VmHardwareCollector(self._service_instance).collect([vm_id])
+        if vm_id not in collected:
             raise Exception("No virtual machine with UUID '%s'" % vm_id)
-        return vm
+        self._hardware = collected[vm_id]["hardware"]
+        return collected[vm_id]["vm"]
 
 
     def _create_snapshot(self):
@@ -107,31 +199,8 @@ class VmAnalyzer:
             WaitForTask(self._snapshot.RemoveSnapshot_Task(False))
 
     def _get_vm_hardware(self):
-        host = self._vm.runtime.host
-
-        hardware = {
-            "metadata": {
-                "vmware_moref": self._vm._moId
-            },
-            "disks": [],
-        }
-
-        for device in self._vm.config.hardware.device:
-            if type(device).__name__ == 'vim.vm.device.VirtualDisk':
-                datastore = device.backing.datastore
-                path = device.backing.fileName.replace("[%s] " % datastore.name, "")
-                hardware["disks"].append({
-                    "id": device.backing.uuid,
-                    "key": device.key,
-                    "path": path,
-                    "size": device.capacityInBytes,
-                    "storage_name": datastore.name,
-                    "storage_path": datastore.summary.url.replace("ds://", ""),
-                    "is_sparse": device.backing.thinProvisioned,
-                    "is_rdm": type(device.backing).__name__ == 'vim.vm.device.VirtualDisk.VirtualDiskRawDiskMappingVer1BackingInfo'
-                })
-
-        return hardware
+        # Collected along with the VM lookup
+        return self._hardware
 
 
     def _get_vm_software(self, vm_hardware):
@@ -184,6 +253,17 @@ class VmAnalyzer:
         return vm_config
 
 
+class Hardware(Resource):
+    def post(self):
+        input = request.get_json()
+        service_instance = connect(input["authentication"])
+        try:
+            collected = VmHardwareCollector(service_instance).collect(input.get("vm_uuids"))
+        finally:
+            Disconnect(service_instance)
+        return jsonify(dict((vm_uuid, vm["hardware"]) for vm_uuid, vm in collected.items()))
+
+
 class Break(Resource):
     def post(self):
         input = request.get_json()
@@ -195,6 +275,7 @@ def main():
     app = Flask(__name__)
     api = Api(app)
     api.add_resource(Break, '/break')
+    api.add_resource(Hardware, '/hardware')
     app.run(host= '0.0.0.0')
     
 
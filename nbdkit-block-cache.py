@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# nbdkit python plugin that serves a disk from a persistent local block
+# cache, and reads the blocks it doesn't have from an upstream NBD server.
+#
+#   nbdkit python nbdkit-block-cache.py upstream=/tmp/up.sock cache=/var/cache/disk
+#
+# The cache directory holds a sparse `data` file the size of the disk and a
+# `bitmap` file with one bit per cached block. The bitmap is only written
+# after the data has been synced, so a crash can lose cached blocks but never
+# serve stale ones. Invalidation of changed blocks is done by vm-analyzer
+# before the plugin starts.
+#
+# nbdkit calls the module-level open(), so the builtin is used as io.open.
+
+import io
+import os
+import nbd
+
+upstream = None
+cache_dir = None
+block_size = 65536
+max_fetch = 8 * 1024 * 1024
+
+cache = None
+
+
+def config(key, value):
+    global upstream, cache_dir, block_size
+    if key == "upstream":
+        upstream = value
+    elif key == "cache":
+        cache_dir = value
+    elif key == "block-size":
+        block_size = int(value)
+    else:
+        raise Exception("unknown parameter %s" % key)
+
+
+def config_complete():
+    if upstream is None or cache_dir is None:
+        raise Exception("upstream and cache parameters are required")
+
+
+class BlockCache:
+    def __init__(self, directory, size):
+        self.size = size
+        self.blocks = (size + block_size - 1) // block_size
+        self.dirty = False
+        self._bitmap_path = os.path.join(directory, "bitmap")
+        self.fd = os.open(os.path.join(directory, "data"), os.O_RDWR | os.O_CREAT, 0o600)
+        os.ftruncate(self.fd, size)
+        self.bitmap = bytearray((self.blocks + 7) // 8)
+        if os.path.exists(self._bitmap_path):
+            with io.open(self._bitmap_path, "rb") as f:
+                bitmap = f.read()
+            if len(bitmap) == len(self.bitmap):
+                self.bitmap = bytearray(bitmap)
+
+
+    def cached(self, block):
+        return self.bitmap[block // 8] & (1 << (block % 8))
+
+
+    def fill(self, upstream_handle, first, last):
+        # Fetches the missing blocks between first and last, coalescing
+        # contiguous runs into single upstream reads.
+        block = first
+        while block <= last:
+            if self.cached(block):
+                block += 1
+                continue
+            run = block
+            while (run <= last and not self.cached(run)
+                   and (run - block + 1) * block_size <= max_fetch):
+                run += 1
+            offset = block * block_size
+            count = min(run * block_size, self.size) - offset
+            os.pwrite(self.fd, upstream_handle.pread(count, offset), offset)
+            for b in range(block, run):
+                self.bitmap[b // 8] |= 1 << (b % 8)
+            self.dirty = True
+            block = run
+
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.fsync(self.fd)
+        with io.open(self._bitmap_path + ".tmp", "wb") as f:
+            f.write(self.bitmap)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self._bitmap_path + ".tmp", self._bitmap_path)
+        self.dirty = False
+
+
+def open(readonly):
+    global cache
+    h = nbd.NBD()
+    h.connect_unix(upstream)
+    if cache is None:
+        cache = BlockCache(cache_dir, h.get_size())
+    return h
+
+
+def get_size(h):
+    return cache.size
+
+
+def can_write(h):
+    return False
+
+
+def pread(h, count, offset):
+    if count == 0:
+        return bytearray()
+    cache.fill(h, offset // block_size, (offset + count - 1) // block_size)
+    return bytearray(os.pread(cache.fd, count, offset))
+
+
+def close(h):
+    cache.save()
+    h.shutdown()
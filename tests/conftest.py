@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+
+
+@pytest.fixture(scope="session")
+def vm_analyzer():
+    # The scripts import their runtime dependencies at the top, so the tests
+    # need them installed, as in the container image
+    for module in ["guestfs", "hivex", "nbd", "requests", "pyVmomi", "flask", "flask_restful"]:
+        pytest.importorskip(module)
+    return benchmark.load_vm_analyzer()
+
+
+@pytest.fixture(scope="session")
+def break2():
+    for module in ["guestfs", "pyVmomi", "flask", "flask_restful"]:
+        pytest.importorskip(module)
+    return benchmark.load_script("break2", ["break2.py"])
@@ -0,0 +1,41 @@
+import pytest
+
+import benchmark
+
+
+@pytest.fixture
+def stub():
+    pytest.importorskip("pyVmomi")
+    return benchmark.FakeVimStub(vm_count=7, disks_per_vm=2, datastore_count=3)
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 500])
+def test_collect_all_vms(break2, stub, page_size):
+    collected = break2.VmHardwareCollector(stub.service_instance(), page_size).collect()
+    assert sorted(collected) == sorted(props["config.uuid"] for props in stub.vms.values())
+    hardware = collected[stub.vms["vm-5"]["config.uuid"]]["hardware"]
+    assert hardware["metadata"] == { "vmware_moref": "vm-5" }
+    assert [d["path"] for d in hardware["disks"]] == ["vm-5/vm-5_0.vmdk", "vm-5/vm-5_1.vmdk"]
+    assert [d["storage_name"] for d in hardware["disks"]] == ["datastore2", "datastore0"]
+    assert hardware["disks"][0]["storage_path"] == "/vmfs/volumes/00000002-0000/"
+    assert hardware["disks"][0]["size"] == 16 * 1024 ** 3
+    assert not hardware["disks"][0]["is_rdm"]
+
+
+def test_paging_round_trips(break2, stub):
+    # 7 VMs and 3 datastores two at a time: the service content, the view
+    # and its destruction, 4 pages of VMs and 2 pages of datastores
+    break2.VmHardwareCollector(stub.service_instance(), 2).collect()
+    assert stub.calls == 1 + 2 + 4 + 2
+    assert stub._pages == {}
+
+
+def test_collect_some_vms(break2, stub):
+    wanted = [stub.vms["vm-0"]["config.uuid"], stub.vms["vm-6"]["config.uuid"], "no-such-uuid"]
+    collected = break2.VmHardwareCollector(stub.service_instance(), 3).collect(wanted)
+    assert sorted(collected) == sorted(wanted[:2])
+    assert collected[wanted[1]]["vm"]._moId == "vm-6"
+
+
+def test_collect_unknown_vm(break2, stub):
+    assert break2.VmHardwareCollector(stub.service_instance(), 3).collect(["no-such-uuid"]) == {}
@@ -0,0 +1,68 @@
+import pytest
+
+DISK = { "file": "[datastore1] vm-1/vm-1.vmdk", "capacity": 1024 * 1024 }
+
+
+def analyzer(vm_analyzer, nbdkit):
+    # Only the scan request is needed to build the nbdkit command, and the
+    # constructor would go to the inventory. There is nothing to close.
+    scan = object.__new__(vm_analyzer.VmAnalyzer)
+    scan._closed = True
+    scan._request = { "nbdkit": nbdkit }
+    return scan
+
+
+@pytest.mark.parametrize("value, option_type, expected", [
+    ("64M", "size", "64M"),
+    (65536, "size", "65536"),
+    ("64 M", "size", None),
+    ("1M,exportname=x", "size", None),
+    (True, "bool", "true"),
+    (False, "bool", "false"),
+    ("on", "bool", "on"),
+    (True, "int", None),
+    (5, "int", "5"),
+    ("-5", "int", None),
+    (0.5, "number", "0.5"),
+    (0.5, "int", None),
+    (None, "size", None),
+    (["64M"], "size", None)
+])
+def test_nbdkit_option_value(vm_analyzer, value, option_type, expected):
+    assert vm_analyzer.nbdkit_option_value(value, option_type) == expected
+
+
+def test_nbdkit_cmd_with_filters(vm_analyzer, monkeypatch):
+    monkeypatch.setattr(vm_analyzer, "NBDKIT_PLUGIN", "memory")
+    scan = analyzer(vm_analyzer, { "filters": [
+        { "name": "readahead" },
+        { "name": "cache", "cache-max-size": "64M", "cache-on-read": True }
+    ]})
+    cmd = scan._nbdkit_cmd(DISK, "disk.sock", "disk.pid", "disk.stats")
+    assert cmd[cmd.index("--pidfile") + 2:cmd.index("memory")] == ["--filter=readahead", "--filter=cache", "--filter=stats"]
+    assert cmd[cmd.index("memory") + 1:] == [
+        "size=1048576", "cache-max-size=64M", "cache-on-read=true", "statsfile=disk.stats", "statsappend=false"
+    ]
+
+
+def test_nbdkit_filters_per_disk(vm_analyzer):
+    scan = analyzer(vm_analyzer, {
+        "filters": [{ "name": "readahead" }],
+        "disks": { DISK["file"]: [{ "name": "retry", "retries": 3 }] }
+    })
+    assert scan._nbdkit_filters(DISK) == [{ "name": "retry", "retries": 3 }]
+    assert scan._nbdkit_filters({ "file": "[datastore1] vm-1/vm-1_1.vmdk" }) == [{ "name": "readahead" }]
+
+
+@pytest.mark.parametrize("filters, message", [
+    ({ "name": "cache" }, "must be a list of objects"),
+    (["cache"], "must be a list of objects"),
+    ([{ "name": "exec" }], "Unsupported nbdkit filter"),
+    ([{ "name": "cache", "plugin": "sh" }], "Unsupported option of nbdkit filter cache: plugin"),
+    ([{ "name": "cache", "cache-max-size": "1G --run sh" }], "Option cache-max-size of nbdkit filter cache must be a size"),
+    ([{ "name": "retry", "retries": True }], "Option retries of nbdkit filter retry must be a int")
+])
+def test_nbdkit_filters_rejected(vm_analyzer, filters, message):
+    scan = analyzer(vm_analyzer, { "filters": filters })
+    with pytest.raises(Exception, match=message):
+        scan._nbdkit_filters(DISK)
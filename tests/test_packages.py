@@ -0,0 +1,116 @@
+import struct
+
+import pytest
+
+import benchmark
+
+
+def bdb_hash(values, endian="<", pagesize=512):
+    # A Berkeley DB hash database holding values under keys 1, 2, ... on a
+    # single hash page. Values too big for the page go to chains of overflow
+    # pages of at most 64 bytes each.
+    pages = [bytearray(pagesize)]
+    struct.pack_into(endian + "III", pages[0], 12, 0x061561, 9, pagesize)
+    hash_page = bytearray(pagesize)
+    pages.append(hash_page)
+    offsets = []
+    end = pagesize
+    for i, value in enumerate(values):
+        key = b"\x01" + struct.pack(endian + "I", i + 1)
+        end -= len(key)
+        hash_page[end:end + len(key)] = key
+        offsets.append(end)
+        if len(value) > 100:
+            first = len(pages)
+            chunks = [value[j:j + 64] for j in range(0, len(value), 64)]
+            for j, chunk in enumerate(chunks):
+                overflow_page = bytearray(pagesize)
+                next_pgno = first + j + 1 if j + 1 < len(chunks) else 0
+                struct.pack_into(endian + "I", overflow_page, 16, next_pgno)
+                struct.pack_into(endian + "H", overflow_page, 22, len(chunk))
+                overflow_page[25] = 7  # P_OVERFLOW
+                overflow_page[26:26 + len(chunk)] = chunk
+                pages.append(overflow_page)
+            item = b"\x03\0\0\0" + struct.pack(endian + "II", first, len(value))
+        else:
+            item = b"\x01" + value
+        end -= len(item)
+        hash_page[end:end + len(item)] = item
+        offsets.append(end)
+    struct.pack_into(endian + "H", hash_page, 20, len(offsets))
+    hash_page[25] = 13  # P_HASH
+    struct.pack_into(endian + "%dH" % len(offsets), hash_page, 26, *offsets)
+    return b"".join(bytes(page) for page in pages)
+
+
+def test_parse_rpm_header(vm_analyzer):
+    tags = vm_analyzer.parse_rpm_header(benchmark.rpm_header({
+        1000: "bash", 1001: "5.1.8", 1002: "6.el9", 1003: 1, 1022: "x86_64",
+        1004: "The GNU Bourne Again shell", 9999: "ignored"
+    }))
+    assert tags == {
+        "name": "bash", "version": "5.1.8", "release": "6.el9", "epoch": 1,
+        "arch": "x86_64", "summary": "The GNU Bourne Again shell"
+    }
+
+
+def test_parse_rpm_header_rejects_truncated_blob(vm_analyzer):
+    blob = benchmark.rpm_header({ 1000: "bash", 1001: "5.1.8" })
+    with pytest.raises(Exception, match="invalid rpm header"):
+        vm_analyzer.parse_rpm_header(blob[:-4])
+
+
+def test_rpm_applications_skip_non_header_records(vm_analyzer):
+    blobs = [
+        b"\0\0\0\x01",
+        benchmark.rpm_header({ 1001: "1.0" }),
+        benchmark.rpm_header({ 1000: "zlib", 1001: "1.2.11", 1002: "40.el9", 1022: "x86_64" })
+    ]
+    applications = vm_analyzer.rpm_applications(blobs)
+    assert [benchmark.package_key(app) for app in applications] == [("zlib", 0, "1.2.11", "40.el9", "x86_64")]
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+def test_read_bdb_hash_values(vm_analyzer, endian):
+    small = benchmark.rpm_header({ 1000: "bash", 1001: "5.1.8" })
+    large = benchmark.rpm_header({ 1000: "glibc", 1001: "2.34", 1005: "x" * 300 })
+    assert len(large) > 200
+    assert vm_analyzer.read_bdb_hash_values(bdb_hash([small, large], endian)) == [small, large]
+
+
+def test_read_bdb_hash_values_rejects_other_files(vm_analyzer):
+    with pytest.raises(Exception, match="not a Berkeley DB hash database"):
+        vm_analyzer.read_bdb_hash_values(b"\0" * 1024)
+
+
+def test_dpkg_applications(vm_analyzer):
+    status = "\n".join([
+        "Package: openssh-server",
+        "Status: install ok installed",
+        "Architecture: amd64",
+        "Version: 1:8.9p1-3ubuntu0.4",
+        "Homepage: https://www.openssh.com/",
+        "Description: secure shell (SSH) server",
+        " This is the portable version of OpenSSH.",
+        " .",
+        " It provides sshd.",
+        "",
+        "Package: removed",
+        "Status: deinstall ok config-files",
+        "Version: 1.0-1",
+        "",
+        "Package: tzdata",
+        "Status: install ok installed",
+        "Architecture: all",
+        "Version: 2024a",
+        "Description: time zone and daylight-saving time data",
+        ""
+    ])
+    applications = vm_analyzer.dpkg_applications(status)
+    assert [benchmark.package_key(app) for app in applications] == [
+        ("openssh-server", 1, "8.9p1", "3ubuntu0.4", "amd64"),
+        ("tzdata", 0, "2024a", "", "all")
+    ]
+    assert applications[0]["app2_url"] == "https://www.openssh.com/"
+    assert applications[0]["app2_summary"] == "secure shell (SSH) server"
+    assert applications[0]["app2_description"] == "This is the portable version of OpenSSH.\n\nIt provides sshd."
@@ -0,0 +1,192 @@
+import struct
+import types
+import uuid
+
+import pytest
+
+SECTOR = 512
+PART_START = 2048  # in sectors
+
+
+class FakeNBD:
+    # In-memory stand-in for a libnbd handle connected to an nbdkit export
+    def __init__(self, disks):
+        self._disks = disks
+        self._data = None
+
+
+    def connect_unix(self, socket_path):
+        self._data = self._disks[socket_path]
+
+
+    def get_size(self):
+        return len(self._data)
+
+
+    def pread(self, count, offset):
+        return bytes(self._data[offset:offset + count])
+
+
+    def shutdown(self):
+        pass
+
+
+def disk(size=4 * 1024 * 1024):
+    return bytearray(size)
+
+
+def mbr(data, partitions):
+    # partitions are (status, type, start sector)
+    for i, (status, ptype, start) in enumerate(partitions):
+        struct.pack_into("<B3xB3xI", data, 446 + 16 * i, status, ptype, start)
+    data[510:512] = b"\x55\xaa"
+
+
+def gpt(data, type_guids):
+    mbr(data, [(0, 0xee, 1)])
+    data[SECTOR:SECTOR + 8] = b"EFI PART"
+    struct.pack_into("<QII", data, SECTOR + 72, 2, len(type_guids), 128)
+    for i, type_guid in enumerate(type_guids):
+        entry = 2 * SECTOR + 128 * i
+        data[entry:entry + 16] = uuid.UUID(type_guid).bytes_le
+        struct.pack_into("<QQ", data, entry + 32, PART_START * (i + 1), PART_START * (i + 2) - 1)
+
+
+def ext(data, offset, last_mounted):
+    data[offset + 1024 + 56:offset + 1024 + 58] = b"\x53\xef"
+    data[offset + 1024 + 136:offset + 1024 + 136 + len(last_mounted)] = last_mounted.encode()
+
+
+def lvm_pv(data, offset, vg_name, mda_magic=b" LVM2 x[5A%r0N*>"):
+    # A PV label in the second sector, one data area and one metadata area
+    # at 4 KiB whose text starts with the VG name
+    label = offset + SECTOR
+    data[label:label + 8] = b"LABELONE"
+    struct.pack_into("<QII", data, label + 8, 1, 0, 32)
+    data[label + 24:label + 32] = b"LVM2 001"
+    struct.pack_into("<QQQQQQQQ", data, label + 32 + 40, 1024 * 1024, 0, 0, 0, 4096, 1024 * 1024 - 4096, 0, 0)
+    mda = offset + 4096
+    data[mda + 4:mda + 20] = mda_magic
+    text = ("%s {\nid = \"abc\"\nseqno = 1\n}\n" % vg_name).encode()
+    struct.pack_into("<QQ", data, mda + 40, SECTOR, len(text))
+    data[mda + SECTOR:mda + SECTOR + len(text)] = text
+
+
+@pytest.fixture
+def triage(vm_analyzer, monkeypatch):
+    disks = {}
+    monkeypatch.setattr(vm_analyzer, "nbd", types.SimpleNamespace(NBD=lambda: FakeNBD(disks)))
+
+    def run(data, index):
+        disks["disk.sock"] = data
+        return vm_analyzer.triage_disk("disk.sock", index)
+    return run
+
+
+def test_lvm_vg_name(vm_analyzer):
+    data = disk()
+    lvm_pv(data, 0, "vg_data-01")
+    assert vm_analyzer.lvm_vg_name(lambda offset, count: bytes(data[offset:offset + count])) == "vg_data-01"
+
+
+def test_lvm_vg_name_without_metadata(vm_analyzer):
+    data = disk()
+    lvm_pv(data, 0, "vg_data", mda_magic=b"\0" * 16)
+    assert vm_analyzer.lvm_vg_name(lambda offset, count: bytes(data[offset:offset + count])) is None
+    assert vm_analyzer.lvm_vg_name(lambda offset, count: bytes(disk()[offset:offset + count])) is None
+
+
+def test_first_disk_is_os(triage):
+    assert triage(disk(), 0)["class"] == "os"
+
+
+def test_empty_disk(triage):
+    result = triage(disk(), 1)
+    assert result["class"] == "empty"
+    assert not result["attached"]
+
+
+def test_root_filesystem(triage):
+    data = disk()
+    mbr(data, [(0, 0x83, PART_START)])
+    ext(data, PART_START * SECTOR, "/")
+    result = triage(data, 2)
+    assert result["class"] == "os"
+    assert result["root"]
+    assert result["attached"]
+
+
+def test_bootable_partition(triage):
+    data = disk()
+    mbr(data, [(0x80, 0x83, PART_START)])
+    ext(data, PART_START * SECTOR, "/boot")
+    assert triage(data, 1)["class"] == "os"
+
+
+def test_efi_system_partition(triage):
+    data = disk()
+    gpt(data, ["C12A7328-F81F-11D2-BA4B-00A0C93EC93B", "0FC63DAF-8483-4772-8E79-3D69D8477DE4"])
+    result = triage(data, 1)
+    assert result["class"] == "os"
+    assert result["partitions"] == 2
+
+
+def test_data_disk(triage):
+    data = disk()
+    mbr(data, [(0, 0x83, PART_START)])
+    ext(data, PART_START * SECTOR, "/srv")
+    result = triage(data, 1)
+    assert result["class"] == "data"
+    assert result["filesystems"] == ["ext"]
+    assert not result["attached"]
+
+
+def test_logical_partition(triage):
+    data = disk()
+    mbr(data, [(0, 0x05, PART_START)])
+    ebr = PART_START * SECTOR
+    struct.pack_into("<B3xB3xI", data, ebr + 446, 0, 0x83, PART_START)
+    data[ebr + 510:ebr + 512] = b"\x55\xaa"
+    ext(data, 2 * PART_START * SECTOR, "/srv")
+    result = triage(data, 1)
+    assert result["partitions"] == 1
+    assert result["class"] == "data"
+
+
+def test_lvm_partition(triage):
+    data = disk()
+    mbr(data, [(0, 0x8e, PART_START)])
+    lvm_pv(data, PART_START * SECTOR, "vg_data")
+    result = triage(data, 1)
+    assert result["class"] == "lvm"
+    assert result["vgs"] == ["vg_data"]
+    assert result["attached"]
+
+
+def test_lvm_without_readable_vg(triage):
+    data = disk()
+    lvm_pv(data, 0, "vg_data", mda_magic=b"\0" * 16)
+    result = triage(data, 1)
+    assert result["class"] == "lvm"
+    assert result["vgs"] == [None]
+
+
+def test_swap_disk(triage):
+    data = disk()
+    data[4086:4096] = b"SWAPSPACE2"
+    assert triage(data, 1)["class"] == "swap"
+
+
+def test_ntfs_disk(triage):
+    data = disk()
+    mbr(data, [(0, 0x07, PART_START)])
+    data[PART_START * SECTOR + 3:PART_START * SECTOR + 11] = b"NTFS    "
+    assert triage(data, 1)["class"] == "ntfs"
+
+
+def test_unrecognised_partition(triage):
+    data = disk()
+    mbr(data, [(0, 0x83, PART_START)])
+    result = triage(data, 1)
+    assert result["class"] == "unknown"
+    assert result["attached"]
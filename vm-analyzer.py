@@ -1,15 +1,33 @@
 #!/usr/bin/env python3
 
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
 import datetime
+import fnmatch
 import guestfs
+import hashlib
+import hivex
+import http.client
 import json
 import logging
+import nbd
 import os
+import posixpath
 import re
+import resource
+import shutil
 import signal
+import socket
+import sqlite3
+import struct
+import stat
 import subprocess
 import ssl
 import sys
+import tempfile
 import time
 import uuid
 import threading
@@ -17,11 +35,11 @@ import requests
 
 from requests.auth import HTTPDigestAuth
 
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
 from pyVim.connect import SmartStubAdapter, VimSessionOrientedStub, Disconnect
 from pyVim.task import WaitForTask
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_restful import Resource, Api, reqparse
 
 MANIFEST = {
@@ -43,97 +61,2776 @@ MANIFEST = {
         { "path": "/opt/mssql/bin/mssql-conf", "collect_content": False },
         { "path": "/usr/sap/hostctrl/exe/saphostctrl", "collect_content": False },
         { "path": "/etc/.ibm/registry/InstallationManager.dat", "collect_content": False}
+    ],
+    "registry": [
+        { "name": "Microsoft SQL Server", "key": "Microsoft\\Microsoft SQL Server\\Instance Names\\SQL" },
+        { "name": "Microsoft SQL Server", "key": "Microsoft\\Microsoft SQL Server\\MSSQL*\\Setup", "values": ["Edition", "Version", "SQLPath"] },
+        { "name": "IBM WebSphere", "key": "IBM\\WebSphere Application Server\\*", "values": ["Version", "InstallLocation"] }
     ]
 }
 
-class ConcurrentScan(threading.Thread):
-  
-    def __init__(self, post_body):
-        threading.Thread.__init__(self)
-        self._request = post_body
-        print("Initializing ConcurrentScan")
-        
-  
-    def run(self):
-        vm_config = VmAnalyzer(self._request).get_vm_config()
-        print("VM Config: ")
-        print("\tMountpoints: %s" % vm_config["software"][0]["mountpoints"])
-        print("\tOperating System: %s" % vm_config["software"][0]["name"])
-        print("\tHostname: %s" % vm_config["software"][0]["hostname"])
-        for file in vm_config["software"][0]["files"]:
-            if file["name"] == '/etc/oraInst.loc':
-                print("/etc/oraInst.loc: %s" % file["content"])
-            if file["name"] == '/u01/app/oraInventory':
-                print("/u01/app/oraInventory: %s" % file["content"])
-        
+def glob_regex(pattern, flags=0):
+    # Like the shell, wildcards don't match a leading dot unless the pattern
+    # itself starts with one
+    regex = fnmatch.translate(pattern)
+    if not pattern.startswith("."):
+        regex = r"(?!\.)" + regex
+    return re.compile(regex, flags)
+
+
+class ManifestNode:
+    def __init__(self, name, nocase=False):
+        self.name = name
+        self.nocase = nocase
+        self.regex = None
+        if any(c in name for c in "*?["):
+            self.regex = glob_regex(name, re.IGNORECASE if nocase else 0)
+        self.children = []
+        self.entries = []
+
+
+    def child(self, name, nocase):
+        for c in self.children:
+            if c.name == name and c.nocase == nocase:
+                return c
+        c = ManifestNode(name, nocase)
+        self.children.append(c)
+        return c
+
+
+    def matches(self, name):
+        if self.regex:
+            return self.regex.match(name) is not None
+        if self.nocase:
+            return self.name.lower() == name.lower()
+        return self.name == name
+
+
+class ManifestMatcher:
+    # The manifest is compiled once into a prefix trie of path components.
+    # Expansion walks the trie against the guest filesystem, listing a
+    # directory only when one of its children is a glob or is matched
+    # case-insensitively (Windows paths), so every directory is read at most
+    # once and never recursively.
+    def __init__(self, manifest):
+        self._root = ManifestNode("/")
+        for entry in manifest["files"]:
+            nocase = self.is_windows_path(entry["path"])
+            node = self._root
+            for part in self.path_win2lin(entry["path"]).split("/"):
+                if part:
+                    node = node.child(part, nocase)
+            node.entries.append(entry)
+
+
+    @staticmethod
+    def is_windows_path(path):
+        return re.match("^[A-Za-z]:", path) is not None
+
+
+    @staticmethod
+    def path_win2lin(path):
+        return re.sub("^[A-Za-z]:/*", "/", path)
+
+
+    def covers(self, path):
+        # Whether a path is, or is an ancestor of, a path some entry can match
+        nodes = [self._root]
+        for part in path.split("/"):
+            if part:
+                nodes = [c for n in nodes for c in n.children if c.matches(part)]
+                if not nodes:
+                    return False
+        return True
+
+
+    def expand(self, g):
+        found = {}
+        self._walk(g, self._root, "/", False, found)
+        return list(found.values())
+
+
+    def _walk(self, g, node, path, globbed, found):
+        # Literal entries keep their manifest name, expanded ones are named
+        # after the guest path they resolved to.
+        for entry in node.entries:
+            if path not in found:
+                found[path] = {
+                    "name": path if globbed else entry["path"],
+                    "path": path,
+                    "collect_content": entry["collect_content"],
+                    "checksum": entry.get("checksum", False)
+                }
+
+        if not node.children:
+            return
+
+        if any(c.regex or c.nocase for c in node.children):
+            try:
+                names = g.ls(path)
+            except RuntimeError:
+                # Missing directory, or not a directory at all
+                return
+            for name in names:
+                for c in node.children:
+                    if c.matches(name):
+                        self._walk(g, c, posixpath.join(path, name), globbed or c.regex is not None, found)
+        else:
+            for c in node.children:
+                self._walk(g, c, posixpath.join(path, c.name), globbed, found)
+
+
+class Manifest:
+    # A validated manifest. File entries are compiled into one matcher per
+    # guest OS type and distro, holding only the entries that apply to it:
+    # paths with a drive letter to Windows, the others to every other OS,
+    # unless the entry restricts itself with "types" or "distros". Registry
+    # probes only apply to Windows.
+    def __init__(self, manifest):
+        self.validate(manifest)
+        self._files = manifest["files"]
+        self.registry = manifest.get("registry", [])
+        self.version = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:12]
+        self._matchers = {}
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def validate(manifest):
+        def check(condition, message):
+            if not condition:
+                raise Exception("Invalid manifest: %s" % message)
+
+        def check_strings(entry, key):
+            check(isinstance(entry.get(key, []), list) and all(isinstance(v, str) for v in entry.get(key, [])),
+                  "%s must be a list of strings in %s" % (key, entry))
+
+        check(isinstance(manifest, dict), "not an object")
+        check(isinstance(manifest.get("files"), list), "files must be a list")
+        check(isinstance(manifest.get("registry", []), list), "registry must be a list")
+        for entry in manifest["files"]:
+            check(isinstance(entry, dict), "file entry %s is not an object" % entry)
+            path = entry.get("path")
+            check(isinstance(path, str) and (path.startswith("/") or ManifestMatcher.is_windows_path(path)),
+                  "path must be absolute in %s" % entry)
+            check(isinstance(entry.get("collect_content", False), bool), "collect_content must be a boolean in %s" % entry)
+            check(isinstance(entry.get("checksum", False), bool), "checksum must be a boolean in %s" % entry)
+            check_strings(entry, "types")
+            check_strings(entry, "distros")
+        for probe in manifest.get("registry", []):
+            check(isinstance(probe, dict), "registry probe %s is not an object" % probe)
+            check(isinstance(probe.get("name"), str) and isinstance(probe.get("key"), str),
+                  "name and key must be strings in %s" % probe)
+            check_strings(probe, "values")
+
+
+    @staticmethod
+    def _applies(entry, os_type, distro):
+        if "types" in entry:
+            if os_type not in entry["types"]:
+                return False
+        elif ManifestMatcher.is_windows_path(entry["path"]) != (os_type == "windows"):
+            return False
+        return "distros" not in entry or distro in entry["distros"]
+
+
+    def matcher(self, os_type, distro):
+        with self._lock:
+            matcher = self._matchers.get((os_type, distro))
+            if matcher is None:
+                files = [dict(entry, collect_content=entry.get("collect_content", False))
+                         for entry in self._files if self._applies(entry, os_type, distro)]
+                matcher = ManifestMatcher({ "files": files })
+                self._matchers[(os_type, distro)] = matcher
+        return matcher
+
+
+    def registry_probes(self, os_type):
+        return self.registry if os_type == "windows" else []
+
+
+class ManifestLoader:
+    # Serves the manifest from path, reloading it when the file's mtime
+    # changes. A manifest that fails to load or validate is reported and the
+    # previous one is kept. Without the file, the built-in MANIFEST is used.
+    def __init__(self, path, default):
+        self._path = path
+        self._default = default
+        self._manifest = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+
+    def get(self):
+        try:
+            mtime = os.stat(self._path).st_mtime_ns
+        except OSError:
+            mtime = None
+        with self._lock:
+            if self._manifest is not None and mtime == self._mtime:
+                return self._manifest
+            try:
+                if mtime is None:
+                    manifest = Manifest(self._default)
+                else:
+                    with open(self._path) as f:
+                        manifest = Manifest(json.load(f))
+                print("Loaded manifest %s from %s" % (manifest.version, self._path if mtime else "defaults"))
+                self._manifest = manifest
+            except Exception as e:
+                print("[ERROR] Could not load manifest %s: %s" % (self._path, e))
+                if self._manifest is None:
+                    self._manifest = Manifest(self._default)
+            self._mtime = mtime
+            return self._manifest
+
+
+MANIFEST_LOADER = ManifestLoader(os.environ.get("MANIFEST_PATH", "/data/manifest.json"), MANIFEST)
+
+class MountPlanner:
+    # Mounts only the filesystems that can hold a path the scan looks at,
+    # when it needs them, parents first. The root filesystem is always
+    # mounted, and the package database location of the guest's package
+    # format is needed for the package listing.
+    PACKAGE_DATABASES = {
+        "rpm": ["/var/lib/rpm", "/usr/lib/sysimage/rpm"],
+        "deb": ["/var/lib/dpkg"],
+        "pacman": ["/var/lib/pacman"],
+        "apk": ["/lib/apk/db"],
+        "ebuild": ["/var/db/pkg"],
+        "pkgsrc": ["/var/db/pkg"],
+        "pisi": ["/var/lib/pisi"]
+    }
+
+    def __init__(self, g, mountpoints, matcher, package_format):
+        self._g = g
+        self._mountpoints = sorted(mountpoints.items(), key=lambda k: len(k[0]))
+        self._matcher = matcher
+        self._package_databases = self.PACKAGE_DATABASES.get(package_format, [])
+        self._mounted = set()
+
+
+    def _mount(self, needed):
+        for mp, device in self._mountpoints:
+            if mp not in self._mounted and (mp == "/" or needed(mp)):
+                self._g.mount_ro(device, mp)
+                self._mounted.add(mp)
+
+
+    def mount_for_packages(self):
+        self._mount(lambda mp: any(path == mp or path.startswith(mp.rstrip("/") + "/") for path in self._package_databases))
+
+
+    def mount_for_manifest(self):
+        self._mount(self._matcher.covers)
+
+
+    def skipped(self):
+        return [{ "mountpoint": mp, "device": device } for mp, device in self._mountpoints if mp not in self._mounted]
+
+
+class FileProber:
+    # Resolves the expanded manifest paths with one lstatnslist() call per
+    # parent directory instead of one is_file_opts() call per path. Symlinks
+    # are followed with readlinklist(), again batched per directory, for a
+    # bounded number of hops.
+    MAX_SYMLINK_HOPS = 8
+
+    def probe(self, g, ap_files):
+        hits = []
+        pending = [(ap_file, ap_file["path"]) for ap_file in ap_files]
+        for hop in range(self.MAX_SYMLINK_HOPS + 1):
+            if not pending:
+                break
+            stats = self._lstat(g, [path for ap_file, path in pending])
+            links = []
+            for ap_file, path in pending:
+                st = stats[path]
+                if st is None:
+                    continue
+                if stat.S_ISLNK(st["st_mode"]):
+                    links.append((ap_file, path))
+                    continue
+                if stat.S_ISREG(st["st_mode"]):
+                    file_type = "file"
+                elif stat.S_ISDIR(st["st_mode"]):
+                    file_type = "directory"
+                else:
+                    continue
+                hits.append(dict(ap_file, type=file_type, size=st["st_size"], mtime=st["st_mtime_sec"]))
+            targets = self._readlink(g, [path for ap_file, path in links])
+            pending = [(ap_file, targets[path]) for ap_file, path in links if targets.get(path)]
+        return hits
+
+
+    def _by_directory(self, paths):
+        directories = {}
+        for path in paths:
+            directory, name = posixpath.split(path)
+            directories.setdefault(directory, []).append(name)
+        return directories
+
+
+    def _lstat(self, g, paths):
+        stats = {}
+        for directory, names in self._by_directory(paths).items():
+            try:
+                results = g.lstatnslist(directory, names)
+            except RuntimeError:
+                # The directory itself doesn't exist
+                results = [None] * len(names)
+            for name, st in zip(names, results):
+                if st is not None and st["st_ino"] == -1:
+                    st = None
+                stats[posixpath.join(directory, name)] = st
+        return stats
+
+
+    def _readlink(self, g, paths):
+        targets = {}
+        for directory, names in self._by_directory(paths).items():
+            try:
+                results = g.readlinklist(directory, names)
+            except RuntimeError:
+                continue
+            for name, target in zip(names, results):
+                if target:
+                    targets[posixpath.join(directory, name)] = posixpath.normpath(posixpath.join(directory, target))
+        return targets
+
+
+CONTENT_MAX_FILE_BYTES = int(os.environ.get("CONTENT_MAX_FILE_BYTES", str(1024 * 1024)))
+CONTENT_MAX_SCAN_BYTES = int(os.environ.get("CONTENT_MAX_SCAN_BYTES", str(16 * 1024 * 1024)))
+
+class ContentCollector:
+    # Reads file contents in bounded pread() chunks so that neither a single
+    # file nor the whole scan can exceed its byte budget. Checksums are
+    # computed inside the appliance and never transfer the file.
+    CHUNK_SIZE = 1024 * 1024
+    CHECKSUM = "sha256"
+
+    def __init__(self, max_file_bytes=CONTENT_MAX_FILE_BYTES, max_scan_bytes=CONTENT_MAX_SCAN_BYTES):
+        self._max_file_bytes = max_file_bytes
+        self._remaining = max_scan_bytes
+
+
+    def collect(self, g, ap_file):
+        result = { "content": None, "truncated": False }
+        if ap_file["type"] != "file":
+            return result
+
+        if ap_file.get("checksum"):
+            result["checksum"] = "%s:%s" % (self.CHECKSUM, g.checksum(self.CHECKSUM, ap_file["path"]))
+
+        if ap_file["collect_content"]:
+            limit = min(ap_file["size"], self._max_file_bytes, self._remaining)
+            chunks = []
+            offset = 0
+            while offset < limit:
+                chunk = g.pread(ap_file["path"], min(self.CHUNK_SIZE, limit - offset), offset)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+            self._remaining -= offset
+            result["content"] = b"".join(chunks).decode("utf-8", errors="replace")
+            result["truncated"] = offset < ap_file["size"]
+
+        return result
+
+
+RPM_TAGS = {
+    1000: "name",
+    1001: "version",
+    1002: "release",
+    1003: "epoch",
+    1004: "summary",
+    1005: "description",
+    1020: "url",
+    1022: "arch"
+}
+RPM_INT32_TYPE = 4
+RPM_STRING_TYPES = [6, 9]  # STRING, I18NSTRING
+
+BDB_HASH_MAGIC = 0x061561
+BDB_HASH_PAGE_TYPES = [2, 13]  # P_HASH_UNSORTED, P_HASH
+BDB_KEYDATA = 1
+BDB_OFFPAGE = 3
+
+def application(name, display_name="", epoch=0, version="", release="", arch="", install_path="",
+                publisher="", url="", summary="", description=""):
+    # Same shape as the entries of inspect_list_applications2()
+    return {
+        "app2_name": name,
+        "app2_display_name": display_name,
+        "app2_epoch": epoch,
+        "app2_version": version,
+        "app2_release": release,
+        "app2_arch": arch,
+        "app2_install_path": install_path,
+        "app2_trans": "",
+        "app2_publisher": publisher,
+        "app2_url": url,
+        "app2_source_package": "",
+        "app2_summary": summary,
+        "app2_description": description,
+        "app2_spare1": "",
+        "app2_spare2": "",
+        "app2_spare3": "",
+        "app2_spare4": ""
+    }
+
+
+def parse_rpm_header(blob):
+    # An rpm header blob as stored in the rpmdb, without the header magic:
+    # index length, data length, the index entries and the data store.
+    il, dl = struct.unpack(">II", blob[0:8])
+    data_start = 8 + 16 * il
+    if il > 0xffff or data_start + dl > len(blob):
+        raise Exception("invalid rpm header")
+    tags = {}
+    for i in range(il):
+        tag, tag_type, offset, count = struct.unpack(">IIiI", blob[8 + 16 * i:24 + 16 * i])
+        if tag not in RPM_TAGS:
+            continue
+        position = data_start + offset
+        if tag_type == RPM_INT32_TYPE:
+            tags[RPM_TAGS[tag]] = struct.unpack(">i", blob[position:position + 4])[0]
+        elif tag_type in RPM_STRING_TYPES:
+            end = blob.index(b"\0", position)
+            tags[RPM_TAGS[tag]] = blob[position:end].decode("utf-8", errors="replace")
+    return tags
+
+
+def read_bdb_hash_values(data):
+    # Values of a Berkeley DB hash database, as used by /var/lib/rpm/Packages
+    # up to RHEL 8. Values that don't fit in a page are stored in chains of
+    # overflow pages.
+    for endian in "<>":
+        magic, version, pagesize = struct.unpack(endian + "III", data[12:24])
+        if magic == BDB_HASH_MAGIC:
+            break
+    else:
+        raise Exception("not a Berkeley DB hash database")
+
+    def page(pgno):
+        return data[pgno * pagesize:(pgno + 1) * pagesize]
+
+    def overflow(pgno, length):
+        chunks = []
+        remaining = length
+        while pgno and remaining > 0:
+            overflow_page = page(pgno)
+            next_pgno = struct.unpack(endian + "I", overflow_page[16:20])[0]
+            size = struct.unpack(endian + "H", overflow_page[22:24])[0]
+            chunks.append(overflow_page[26:26 + size])
+            remaining -= size
+            pgno = next_pgno
+        return b"".join(chunks)[:length]
+
+    values = []
+    for pgno in range(1, len(data) // pagesize):
+        hash_page = page(pgno)
+        if hash_page[25] not in BDB_HASH_PAGE_TYPES:
+            continue
+        entries = struct.unpack(endian + "H", hash_page[20:22])[0]
+        offsets = struct.unpack(endian + "%dH" % entries, hash_page[26:26 + 2 * entries])
+        # Keys and values alternate, items are laid out from the end of the
+        # page so a value ends where its key starts.
+        for i in range(1, entries, 2):
+            offset = offsets[i]
+            if hash_page[offset] == BDB_OFFPAGE:
+                pgno_data, length = struct.unpack(endian + "II", hash_page[offset + 4:offset + 12])
+                values.append(overflow(pgno_data, length))
+            elif hash_page[offset] == BDB_KEYDATA:
+                values.append(hash_page[offset + 1:offsets[i - 1]])
+    return values
+
+
+def rpm_applications(blobs):
+    applications = []
+    for blob in blobs:
+        # The Packages database also holds a few non-header records
+        if len(blob) < 8:
+            continue
+        tags = parse_rpm_header(blob)
+        if "name" not in tags:
+            continue
+        applications.append(application(**tags))
+    return applications
+
+
+def dpkg_applications(status):
+    applications = []
+    for stanza in status.split("\n\n"):
+        fields = {}
+        field = None
+        for line in stanza.splitlines():
+            if line.startswith((" ", "\t")) and field:
+                fields[field].append(line[1:])
+            elif ":" in line:
+                field, value = line.split(":", 1)
+                fields[field] = [value.strip()]
+        if "Package" not in fields or fields.get("Status", [""])[0] != "install ok installed":
+            continue
+        version = fields.get("Version", [""])[0]
+        epoch = 0
+        if ":" in version:
+            epoch, version = version.split(":", 1)
+            epoch = int(epoch)
+        release = ""
+        if "-" in version:
+            version, release = version.rsplit("-", 1)
+        description = fields.get("Description", [""])
+        applications.append(application(
+            fields["Package"][0],
+            epoch = epoch,
+            version = version,
+            release = release,
+            arch = fields.get("Architecture", [""])[0],
+            url = fields.get("Homepage", [""])[0],
+            summary = description[0],
+            description = "\n".join("" if line == "." else line for line in description[1:])
+        ))
+    return applications
+
+
+class PackageLister:
+    # Lists rpm and dpkg packages by downloading the package database and
+    # parsing it here instead of in the appliance. Parsed lists are kept by
+    # database checksum, so an unchanged database is only checksummed.
+    # Other package formats, and databases that fail to parse, go through
+    # inspect_list_applications2().
+    RPM_DIRECTORIES = ["/usr/lib/sysimage/rpm", "/var/lib/rpm"]
+    DPKG_STATUS = "/var/lib/dpkg/status"
+    CHECKSUM = "sha256"
+
+    def __init__(self, native=True, max_entries=256):
+        self._native = native
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = { "hits": 0, "misses": 0, "evictions": 0, "fallbacks": 0 }
+
+
+    def _database(self, g, package_format):
+        if package_format == "rpm":
+            for directory in self.RPM_DIRECTORIES:
+                sqlite_path = directory + "/rpmdb.sqlite"
+                if g.is_file(sqlite_path, followsymlinks=True):
+                    paths = [sqlite_path]
+                    wal_path = sqlite_path + "-wal"
+                    if g.is_file(wal_path, followsymlinks=True) and g.filesize(wal_path) > 0:
+                        paths.append(wal_path)
+                    return "rpm-sqlite", paths
+                if g.is_file(directory + "/Packages", followsymlinks=True):
+                    return "rpm-bdb", [directory + "/Packages"]
+        elif package_format == "deb" and g.is_file(self.DPKG_STATUS, followsymlinks=True):
+            return "dpkg", [self.DPKG_STATUS]
+        return None, []
+
+
+    def _parse(self, g, kind, paths):
+        tmpdir = tempfile.mkdtemp(prefix="packages-")
+        try:
+            local_paths = []
+            for path in paths:
+                local_path = os.path.join(tmpdir, posixpath.basename(path))
+                g.download(path, local_path)
+                local_paths.append(local_path)
+            if kind == "rpm-sqlite":
+                connection = sqlite3.connect(local_paths[0])
+                try:
+                    blobs = [bytes(row[0]) for row in connection.execute("SELECT blob FROM Packages")]
+                finally:
+                    connection.close()
+                return rpm_applications(blobs)
+            if kind == "rpm-bdb":
+                with open(local_paths[0], "rb") as f:
+                    return rpm_applications(read_bdb_hash_values(f.read()))
+            with open(local_paths[0], encoding="utf-8", errors="replace") as f:
+                return dpkg_applications(f.read())
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+    def list_applications(self, g, root, package_format):
+        kind, paths = self._database(g, package_format) if self._native else (None, [])
+        if kind is None:
+            return g.inspect_list_applications2(root)
+
+        key = kind + ":" + ":".join(g.checksum(self.CHECKSUM, path) for path in paths)
+        with self._lock:
+            applications = self._entries.get(key)
+            if applications is not None:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return applications
+            self._counters["misses"] += 1
+
+        try:
+            applications = self._parse(g, kind, paths)
+        except Exception as e:
+            print("[ERROR] Could not parse %s database %s: %s" % (kind, paths[0], e))
+            with self._lock:
+                self._counters["fallbacks"] += 1
+            return g.inspect_list_applications2(root)
+
+        with self._lock:
+            self._entries[key] = applications
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+        return applications
+
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._entries)
+        return stats
+
+
+PACKAGE_LISTER = PackageLister(
+    native = os.environ.get("PACKAGE_LISTER", "native") == "native",
+    max_entries = int(os.environ.get("PACKAGE_CACHE_SIZE", "256"))
+)
+
+
+class RegistryInventory:
+    # Lists the software of Windows guests from their SOFTWARE hive, which is
+    # downloaded once and walked here with hivex: the Uninstall keys, as
+    # inspect_list_applications2() does, the Windows Installer products, and
+    # the registry probes of the manifest. Results are kept by hive checksum.
+    UNINSTALL_KEYS = [
+        "Microsoft\\Windows\\CurrentVersion\\Uninstall",
+        "WOW6432Node\\Microsoft\\Windows\\CurrentVersion\\Uninstall"
+    ]
+    PRODUCTS_KEY = "Classes\\Installer\\Products"
+    CHECKSUM = "sha256"
+
+    def __init__(self, max_entries=256):
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = { "hits": 0, "misses": 0, "evictions": 0, "fallbacks": 0 }
+
+
+    @staticmethod
+    def _value(h, node, name):
+        for value in h.node_values(node):
+            if h.value_key(value).lower() != name.lower():
+                continue
+            value_type = h.value_type(value)[0]
+            if value_type in [1, 2]:  # REG_SZ, REG_EXPAND_SZ
+                return h.value_string(value)
+            if value_type == 4:  # REG_DWORD
+                return h.value_dword(value)
+            if value_type == 11:  # REG_QWORD
+                return h.value_qword(value)
+            if value_type == 7:  # REG_MULTI_SZ
+                return h.value_multiple_strings(value)
+            return h.value_value(value)[1].hex()
+        return None
+
+
+    @staticmethod
+    def _find(h, node, path):
+        # Keys matching path, whose components can be globs. Registry key
+        # names are case insensitive.
+        nodes = [("", node)]
+        for component in path.split("\\"):
+            if not component:
+                continue
+            matches = []
+            for key, parent in nodes:
+                if any(c in component for c in "*?["):
+                    regex = glob_regex(component, re.IGNORECASE)
+                    children = [child for child in h.node_children(parent) if regex.match(h.node_name(child))]
+                else:
+                    child = h.node_get_child(parent, component)
+                    children = [child] if child else []
+                matches.extend([((key + "\\" if key else "") + h.node_name(child), child) for child in children])
+            nodes = matches
+        return nodes
+
+
+    def _walk(self, h, probes):
+        root = h.root()
+        packages = []
+        for uninstall_key in self.UNINSTALL_KEYS:
+            for key, node in self._find(h, root, uninstall_key + "\\*"):
+                packages.append(application(
+                    h.node_name(node),
+                    display_name = self._value(h, node, "DisplayName") or "",
+                    version = self._value(h, node, "DisplayVersion") or "",
+                    install_path = self._value(h, node, "InstallLocation") or "",
+                    publisher = self._value(h, node, "Publisher") or "",
+                    url = self._value(h, node, "URLInfoAbout") or "",
+                    description = self._value(h, node, "Comments") or ""
+                ))
+
+        # Windows Installer products that have no Uninstall entry
+        display_names = set(package["app2_display_name"] for package in packages)
+        for key, node in self._find(h, root, self.PRODUCTS_KEY + "\\*"):
+            product_name = self._value(h, node, "ProductName")
+            if not product_name or product_name in display_names:
+                continue
+            # The product version is packed in a DWORD as major.minor.build
+            version = self._value(h, node, "Version")
+            if isinstance(version, int):
+                version = "%d.%d.%d" % (version >> 24, (version >> 16) & 0xff, version & 0xffff)
+            packages.append(application(h.node_name(node), display_name=product_name, version=version or ""))
+
+        registry = []
+        for probe in probes:
+            for key, node in self._find(h, root, probe["key"]):
+                if "values" in probe:
+                    values = dict((name, self._value(h, node, name)) for name in probe["values"])
+                else:
+                    values = dict((h.value_key(value), self._value(h, node, h.value_key(value))) for value in h.node_values(node))
+                registry.append({ "name": probe["name"], "key": key, "values": values })
+        return packages, registry
+
+
+    def scan(self, g, root, manifest):
+        # Returns the packages and the registry probes. If the hive can't be
+        # read, the packages come from libguestfs and there are no probes.
+        try:
+            return self._scan(g, root, manifest)
+        except Exception as e:
+            print("[ERROR] Could not read the registry of %s: %s" % (root, e))
+            with self._lock:
+                self._counters["fallbacks"] += 1
+            return g.inspect_list_applications2(root), []
+
+
+    def _scan(self, g, root, manifest):
+        hive_path = g.inspect_get_windows_software_hive(root)
+        key = "%s:%s" % (g.checksum(self.CHECKSUM, hive_path), manifest.version)
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return result
+            self._counters["misses"] += 1
+
+        tmpdir = tempfile.mkdtemp(prefix="registry-")
+        try:
+            local_path = os.path.join(tmpdir, "software")
+            g.download(hive_path, local_path)
+            result = self._walk(hivex.Hivex(local_path), manifest.registry_probes("windows"))
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        with self._lock:
+            self._entries[key] = result
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+        return result
+
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._entries)
+        return stats
+
+
+REGISTRY_INVENTORY = RegistryInventory(
+    max_entries = int(os.environ.get("REGISTRY_CACHE_SIZE", "256"))
+)
+
+
+class Metrics:
+    # Process-wide counters, histograms and high-water marks, rendered in the
+    # Prometheus text format on /metrics. The stats() of the long-lived
+    # components are added when the metrics are scraped: the keys registered
+    # as counters, which only ever grow, as counters named *_total, the
+    # others as gauges.
+    BUCKETS = [0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900]
+
+    def __init__(self, prefix):
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(float)
+        self._histograms = {}
+        self._high_water = {}
+        self._components = {}
+
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[self._key(name, labels)] += value
+
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.setdefault(key, { "buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0 })
+            index = bisect.bisect_left(self.BUCKETS, value)
+            if index < len(self.BUCKETS):
+                histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+
+    def high_water(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._high_water[key] = max(self._high_water.get(key, 0), value)
+
+
+    def register(self, name, component, counters=()):
+        # counters are sample names without the component prefix, e.g.
+        # "hits", or "latency_count" for the count of a nested dict
+        self._components[name] = (component, set(counters))
+
+
+    @staticmethod
+    def stats_samples(name, stats, labels=()):
+        # Numeric leaves of a stats() dict, keys of nested dicts become a
+        # "key" label.
+        samples = []
+        for key, value in stats.items():
+            metric = "%s_%s" % (name, re.sub(r"[^a-zA-Z0-9_]", "_", str(key)))
+            if isinstance(value, dict) and not labels:
+                for sub_key, sub_value in value.items():
+                    if isinstance(sub_value, dict):
+                        samples.extend(Metrics.stats_samples(metric, sub_value, (("key", sub_key),)))
+                    elif isinstance(sub_value, (int, float)):
+                        samples.append((metric, (("key", sub_key),), sub_value))
+            elif isinstance(value, (int, float)):
+                samples.append((metric, labels, value))
+        return samples
+
+
+    def _line(self, name, labels, value):
+        if labels:
+            escaped = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                               for k, v in labels)
+            return "%s%s{%s} %s" % (self._prefix, name, escaped, float(value))
+        return "%s%s %s" % (self._prefix, name, float(value))
+
+
+    def render(self):
+        families = collections.OrderedDict()
+        def sample(name, metric_type, line):
+            families.setdefault(name, (metric_type, []))[1].append(line)
+
+        self.high_water("max_rss_bytes", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, process="self")
+        self.high_water("max_rss_bytes", resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024, process="children")
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                sample(name, "counter", self._line(name, labels, value))
+            for (name, labels), value in sorted(self._high_water.items()):
+                sample(name, "gauge", self._line(name, labels, value))
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for le, count in zip(self.BUCKETS, histogram["buckets"]):
+                    cumulative += count
+                    sample(name, "histogram", self._line(name + "_bucket", labels + (("le", le),), cumulative))
+                sample(name, "histogram", self._line(name + "_bucket", labels + (("le", "+Inf"),), histogram["count"]))
+                sample(name, "histogram", self._line(name + "_sum", labels, histogram["sum"]))
+                sample(name, "histogram", self._line(name + "_count", labels, histogram["count"]))
+        for component, (stats, counters) in list(self._components.items()):
+            for name, labels, value in self.stats_samples(component, stats.stats()):
+                if name[len(component) + 1:] in counters:
+                    sample(name + "_total", "counter", self._line(name + "_total", labels, value))
+                else:
+                    sample(name, "gauge", self._line(name, labels, value))
+
+        lines = []
+        for name, (metric_type, samples) in families.items():
+            lines.append("# TYPE %s%s %s" % (self._prefix, name, metric_type))
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics("vm_analyzer_")
+
+
+class ScanTimer:
+    # Wall-clock time of each phase of one scan, attached to its result.
+    # Phases run more than once, per root for instance, add up.
+    def __init__(self):
+        self._phases = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+
+    @contextlib.contextmanager
+    def span(self, phase):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self._phases[phase] = self._phases.get(phase, 0) + elapsed
+            METRICS.observe("phase_seconds", elapsed, phase=phase)
+
+
+    def to_dict(self):
+        with self._lock:
+            return dict((phase, round(seconds, 3)) for phase, seconds in self._phases.items())
+
+
+class InstrumentedGuestFS:
+    # Wraps a guestfs handle to count and time every call by name
+    def __init__(self, g):
+        self._g = g
+
+
+    def __getattr__(self, name):
+        attr = getattr(self._g, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return attr(*args, **kwargs)
+            except Exception:
+                METRICS.inc("guestfs_call_errors_total", call=name)
+                raise
+            finally:
+                METRICS.observe("guestfs_call_seconds", time.monotonic() - started, call=name)
+        return call
+
+
+class Appliance:
+    def __init__(self, backend, prelaunch):
+        self.g = InstrumentedGuestFS(guestfs.GuestFS(python_return_dict=True))
+        self.g.set_backend(backend)
+        self.memsize = self.g.get_memsize()
+        self.created = time.monotonic()
+        self.uses = 0
+        self._labels = []
+        if prelaunch:
+            self.g.launch()
+
+
+    def add_nbd_drive(self, socket_path):
+        # Labels are required to hot-plug (and later remove) drives on an
+        # already launched appliance.
+        label = "d%d" % len(self._labels)
+        self.g.add_drive_opts("", protocol="nbd", format="raw", server=["unix:%s" % socket_path], readonly=1, label=label)
+        self._labels.append(label)
+
+
+    def launch(self):
+        if self.g.is_config():
+            self.g.launch()
+
+
+    def reset(self):
+        # The volume groups of the previous scan are deactivated so their
+        # device-mapper devices don't keep the drives busy
+        self.g.umount_all()
+        self.g.vg_activate_all(False)
+        for label in self._labels:
+            self.g.remove_drive(label)
+        self._labels = []
+
+
+    def close(self):
+        try:
+            self.g.close()
+        except Exception:
+            pass
+
+
+class AppliancePool:
+    # Keeps `size` appliances ready for the next scans. Drives can only be
+    # hot-plugged with the libvirt backend, so that is the only case where
+    # appliances are launched ahead of time and recycled. With the direct
+    # backend an unlaunched handle saves nothing, so the pool is off by
+    # default there.
+    def __init__(self, size, backend="direct", max_age=3600, max_uses=20):
+        self._size = size
+        self._backend = backend
+        self._max_age = max_age
+        self._max_uses = max_uses
+        self._prelaunch = backend.startswith("libvirt")
+        self._idle = []
+        self._creating = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._counters = { "hits": 0, "misses": 0, "recycled": 0, "discarded": 0 }
+
+
+    def start(self):
+        if self._size > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._refill, daemon=True)
+            self._thread.start()
+
+
+    def _expired(self, appliance):
+        return time.monotonic() - appliance.created > self._max_age
+
+
+    def _refill(self):
+        while True:
+            with self._cond:
+                while len(self._idle) + self._creating >= self._size:
+                    self._cond.wait(timeout=60)
+                    expired = [a for a in self._idle if self._expired(a)]
+                    self._idle = [a for a in self._idle if a not in expired]
+                    self._counters["discarded"] += len(expired)
+                    for appliance in expired:
+                        appliance.close()
+                self._creating += 1
+            try:
+                appliance = Appliance(self._backend, self._prelaunch)
+            except Exception as e:
+                print("[ERROR] Could not prepare appliance: %s" % e)
+                appliance = None
+                time.sleep(10)
+            with self._cond:
+                self._creating -= 1
+                if appliance:
+                    self._idle.append(appliance)
+                    self._cond.notify_all()
+
+
+    def acquire(self, memsize=None):
+        # With a memsize in MiB, only an appliance with at least that much
+        # memory is taken from the pool, or else a new one is created
+        appliance = None
+        with self._cond:
+            for candidate in list(self._idle):
+                if self._expired(candidate):
+                    self._idle.remove(candidate)
+                    self._counters["discarded"] += 1
+                    candidate.close()
+                elif memsize is None or candidate.memsize >= memsize:
+                    self._idle.remove(candidate)
+                    appliance = candidate
+                    break
+            self._counters["hits" if appliance else "misses"] += 1
+            self._cond.notify_all()
+        if appliance is None:
+            appliance = Appliance(self._backend, False)
+        if memsize is not None and appliance.memsize < memsize:
+            appliance.g.set_memsize(memsize)
+            appliance.memsize = memsize
+        appliance.uses += 1
+        return appliance
+
+
+    def release(self, appliance, healthy=True):
+        reusable = (healthy and self._prelaunch
+                    and appliance.uses < self._max_uses
+                    and not self._expired(appliance))
+        if reusable:
+            try:
+                appliance.reset()
+            except RuntimeError as e:
+                print("[ERROR] Could not reset appliance: %s" % e)
+                reusable = False
+        with self._cond:
+            if reusable and len(self._idle) < self._size:
+                self._counters["recycled"] += 1
+                self._idle.append(appliance)
+                self._cond.notify_all()
+                return
+            self._counters["discarded"] += 1
+        appliance.close()
+
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats["idle"] = len(self._idle)
+            stats["size"] = self._size
+            stats["backend"] = self._backend
+        return stats
+
+
+APPLIANCE_BACKEND = os.environ.get("APPLIANCE_BACKEND", "direct")
+APPLIANCE_POOL = AppliancePool(
+    int(os.environ.get("APPLIANCE_POOL_SIZE", "2" if APPLIANCE_BACKEND.startswith("libvirt") else "0")),
+    backend = APPLIANCE_BACKEND,
+    max_age = int(os.environ.get("APPLIANCE_MAX_AGE", "3600")),
+    max_uses = int(os.environ.get("APPLIANCE_MAX_USES", "20"))
+)
+
+
+class ScanCancelled(Exception):
+    pass
+
+
+class ScanJob:
+    def __init__(self, post_body, priority=0, batch=None):
+        self.id = str(uuid.uuid4())
+        self.request = post_body
+        self.priority = priority
+        self.batch = batch
+        self.status = "queued"
+        self.placement = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "vm": self.request["vm"]["moref"],
+            "priority": self.priority,
+            "batch": self.batch,
+            "status": self.status,
+            "placement": self.placement,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+            "result": self.result
+        }
+
+
+class ScanScheduler:
+    # Runs scans on a fixed set of worker threads, highest priority first and
+    # FIFO within a priority. A job only starts when its ESXi host and all its
+    # datastores are below their concurrency limits; jobs that can't start
+    # yet stay queued and the next eligible one runs instead. The scans of a
+    # batch are run by the pipeline rather than the workers, but they are
+    # tracked here too, and claim their host and datastore slots from the
+    # same limits.
+    def __init__(self, workers=4, max_queue=100, max_per_host=2, max_per_datastore=2, max_finished=1000):
+        self._workers = workers
+        self._max_queue = max_queue
+        self._max_per_host = max_per_host
+        self._max_per_datastore = max_per_datastore
+        self._max_finished = max_finished
+        self._queue = []
+        self._jobs = collections.OrderedDict()
+        self._running_hosts = collections.Counter()
+        self._running_datastores = collections.Counter()
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._threads = []
+
+
+    def start(self):
+        while len(self._threads) < self._workers:
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+
+    @staticmethod
+    def validate(post_body):
+        def check(condition, message):
+            if not condition:
+                raise Exception("Invalid scan request: %s" % message)
+
+        check(isinstance(post_body, dict), "not an object")
+        check(isinstance(post_body.get("provider"), dict) and isinstance(post_body["provider"].get("uid"), str),
+              "provider.uid must be a string")
+        check(isinstance(post_body.get("vm"), dict) and isinstance(post_body["vm"].get("moref"), str) and post_body["vm"]["moref"],
+              "vm.moref must be a string")
+        check(isinstance(post_body.get("host_authentication"), dict)
+              and all(isinstance(post_body["host_authentication"].get(k), str) for k in ["username", "password"]),
+              "host_authentication must have a username and a password")
+        priority = post_body.get("priority", 0)
+        check(isinstance(priority, int) and not isinstance(priority, bool), "priority must be an integer")
+
+
+    def submit(self, post_body, priority=0):
+        job = ScanJob(post_body, priority)
+        with self._cond:
+            if len(self._queue) >= self._max_queue:
+                return None
+            self._seq += 1
+            bisect.insort(self._queue, ((-priority, self._seq), job.id))
+            self._jobs[job.id] = job
+            self._cond.notify_all()
+        print("Queued scan %s for VM MORef: %s" % (job.id, post_body["vm"]["moref"]))
+        return job
+
+
+    def track(self, post_body, batch):
+        job = ScanJob(post_body, batch=batch)
+        with self._cond:
+            self._jobs[job.id] = job
+        return job
+
+
+    def claim(self, job, placement):
+        # Blocks until the host and datastores of a tracked job are below
+        # their limits, or the job is cancelled
+        with self._cond:
+            job.placement = placement
+            while not self._available(placement) and not job.cancel_event.is_set():
+                self._cond.wait(timeout=1)
+            if job.cancel_event.is_set():
+                raise ScanCancelled("Scan of VM MORef %s cancelled" % job.request["vm"]["moref"])
+            self._claim(job)
+
+
+    def finish(self, job, status):
+        with self._cond:
+            self._finish(job, status)
+
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+
+    def cancel(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job.status == "queued" and job.batch is None:
+                self._queue = [q for q in self._queue if q[1] != job_id]
+                job.status = "cancelled"
+                job.finished = time.time()
+            elif job.status in ["queued", "running"]:
+                job.cancel_event.set()
+                self._cond.notify_all()
+            return job
+
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": len(self._queue),
+                "running": sum(self._running_hosts.values()),
+                "hosts": dict(self._running_hosts),
+                "datastores": dict(self._running_datastores)
+            }
+
+
+    def _available(self, placement):
+        if self._running_hosts[placement["host"]] >= self._max_per_host:
+            return False
+        return all(self._running_datastores[d] < self._max_per_datastore for d in placement["datastores"])
+
+
+    def _next_job(self):
+        # Called with the lock held. Jobs without a placement yet are returned
+        # as is, the worker resolves it and puts the job back if needed.
+        for index, (key, job_id) in enumerate(self._queue):
+            job = self._jobs[job_id]
+            if job.placement is None or self._available(job.placement):
+                del self._queue[index]
+                return key, job
+        return None, None
+
+
+    def _claim(self, job):
+        self._running_hosts[job.placement["host"]] += 1
+        for datastore in job.placement["datastores"]:
+            self._running_datastores[datastore] += 1
+        job.status = "running"
+        job.started = time.time()
+
+
+    def _finish(self, job, status):
+        if job.status == "running":
+            self._running_hosts[job.placement["host"]] -= 1
+            for datastore in job.placement["datastores"]:
+                self._running_datastores[datastore] -= 1
+            self._running_hosts += collections.Counter()
+            self._running_datastores += collections.Counter()
+        job.status = status
+        job.finished = time.time()
+        METRICS.inc("scans_total", status=status)
+        if job.started:
+            METRICS.observe("scan_seconds", job.finished - job.started)
+        finished = [j for j in self._jobs.values() if j.finished]
+        for old_job in finished[:max(0, len(finished) - self._max_finished)]:
+            del self._jobs[old_job.id]
+        self._cond.notify_all()
+
+
+    def _work(self):
+        while True:
+            with self._cond:
+                key, job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    key, job = self._next_job()
+                if job.placement is not None:
+                    self._claim(job)
+            self._run(key, job)
+
+
+    def _run(self, key, job):
+        analyzer = None
+        error = None
+        try:
+            analyzer = VmAnalyzer(job.request, job.cancel_event)
+            cached = analyzer.get_cached_vm_config() if job.status != "running" else None
+            if cached is not None:
+                # No snapshot, no disk access, so no need to hold a slot
+                with self._cond:
+                    if job.status != "cancelled":
+                        job.result = cached
+                        self._finish(job, "done")
+                return
+            if job.status != "running":
+                placement = analyzer.get_vm_placement()
+                with self._cond:
+                    job.placement = placement
+                    if job.status == "cancelled":
+                        return
+                    if not self._available(placement):
+                        bisect.insort(self._queue, (key, job.id))
+                        return
+                    self._claim(job)
+            job.result = analyzer.get_vm_config(use_cache=False)
+            status = "done"
+        except ScanCancelled:
+            status = "cancelled"
+        except Exception as e:
+            print("[ERROR] Scan %s failed: %s" % (job.id, e))
+            job.error = str(e)
+            status = "failed"
+            error = e
+        finally:
+            if analyzer:
+                analyzer.close(error)
+        with self._cond:
+            # A job cancelled before it got its slot is already finished
+            if job.status != "cancelled":
+                self._finish(job, status)
+            status = job.status
+        print("Scan %s for VM MORef %s %s" % (job.id, job.request["vm"]["moref"], status))
+
+
+SCAN_SCHEDULER = ScanScheduler(
+    workers = int(os.environ.get("SCAN_WORKERS", "4")),
+    max_queue = int(os.environ.get("SCAN_QUEUE_SIZE", "100")),
+    max_per_host = int(os.environ.get("SCAN_MAX_PER_HOST", "2")),
+    max_per_datastore = int(os.environ.get("SCAN_MAX_PER_DATASTORE", "2"))
+)
+SCAN_RETRY_AFTER = int(os.environ.get("SCAN_RETRY_AFTER", "60"))
+
+
+class ScanPipeline:
+    # Runs the scans of a batch through the stages of VmAnalyzer, each stage
+    # with its own concurrency limit shared by all batches. A VM moves to
+    # the next stage as soon as it gets a slot there, so the snapshot and
+    # exports of one VM overlap with the inspection of another. At most
+    # `window` VMs of a batch are in flight, to bound the snapshots and
+    # nbdkit processes waiting for an appliance. Every VM is a job of the
+    # scheduler: it holds a slot of its host and datastores from connect to
+    # the end of the inspection, and can be cancelled with DELETE /scan/<id>.
+    STAGES = ["connect", "snapshot", "export", "inspect"]
+
+    def __init__(self, limits, window, scheduler, packer=None):
+        self._limits = limits
+        self._window = window
+        self._slots = dict((stage, threading.BoundedSemaphore(limits[stage])) for stage in self.STAGES)
+        self._scheduler = scheduler
+        self._packer = packer
+
+
+    @staticmethod
+    def validate(batch):
+        def check(condition, message):
+            if not condition:
+                raise Exception("Invalid batch: %s" % message)
+
+        check(isinstance(batch, dict), "not an object")
+        check(isinstance(batch.get("provider"), dict) and isinstance(batch["provider"].get("uid"), str),
+              "provider.uid must be a string")
+        check(isinstance(batch.get("vms"), list) and len(batch["vms"]) > 0, "vms must be a non empty list")
+        for vm in batch["vms"]:
+            check(isinstance(vm, dict) and isinstance(vm.get("moref"), str) and vm["moref"],
+                  "%s is not a {\"moref\": ...} object" % json.dumps(vm))
+        morefs = [vm["moref"] for vm in batch["vms"]]
+        check(len(set(morefs)) == len(morefs), "a VM is listed more than once")
+
+
+    def _stage(self, timings, stage, func, job):
+        started = time.monotonic()
+        while not self._slots[stage].acquire(timeout=1):
+            if job.cancel_event.is_set():
+                raise ScanCancelled("Scan of VM MORef %s cancelled" % job.request["vm"]["moref"])
+        try:
+            waited = time.monotonic() - started
+            func()
+        finally:
+            self._slots[stage].release()
+        timings[stage] = { "wait": round(waited, 3), "run": round(time.monotonic() - started - waited, 3) }
+
+
+    def _scan(self, job, pack):
+        line = { "id": job.id, "vm": job.request["vm"]["moref"], "status": "failed", "stages": {} }
+        analyzer = None
+        status = "failed"
+        error = None
+        try:
+            if job.cancel_event.is_set():
+                raise ScanCancelled("Scan of VM MORef %s cancelled" % line["vm"])
+            analyzer = VmAnalyzer(job.request, job.cancel_event)
+            line["result"] = analyzer.get_cached_vm_config()
+            if line["result"] is None:
+                self._scheduler.claim(job, analyzer.get_vm_placement())
+                self._stage(line["stages"], "connect", analyzer.connect, job)
+                self._stage(line["stages"], "snapshot", analyzer.snapshot, job)
+                self._stage(line["stages"], "export", analyzer.start_exports, job)
+                if pack:
+                    line["stages"]["inspect"] = self._packer.inspect(analyzer, self._slots["inspect"])
+                else:
+                    self._stage(line["stages"], "inspect", analyzer.inspect, job)
+                line["result"] = analyzer.finish()
+            status = "done"
+        except ScanCancelled:
+            status = "cancelled"
+        except Exception as e:
+            print("[ERROR] Batch scan of VM MORef %s failed: %s" % (line["vm"], e))
+            line["error"] = job.error = str(e)
+            error = e
+        finally:
+            if analyzer:
+                analyzer.close(error)
+        job.result = line.get("result")
+        self._scheduler.finish(job, status)
+        line["status"] = status
+        return line
+
+
+    def run(self, batch):
+        # Yields one result per VM, in the order they finish. The batch must
+        # have gone through validate() first.
+        batch_id = str(uuid.uuid4())
+        jobs = []
+        for vm in batch["vms"]:
+            post_body = dict((k, v) for k, v in batch.items() if k != "vms")
+            post_body["vm"] = vm
+            jobs.append(self._scheduler.track(post_body, batch_id))
+
+        try:
+            INVENTORY_CLIENT.prefetch(get_inventory_db(batch["provider"]["uid"]), set(vm["moref"] for vm in batch["vms"]))
+        except Exception as e:
+            print("[ERROR] Could not prefetch inventory: %s" % e)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._window) as executor:
+            pack = bool(batch.get("pack")) and self._packer is not None
+            futures = [executor.submit(self._scan, job, pack) for job in jobs]
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+
+
+def root_drive_indexes(g, root):
+    # Drives a root filesystem lives on, as indexes in the order the drives
+    # were added: the disk of a partition, or the disks of all the PVs of the
+    # volume group of a logical volume.
+    if root.startswith("btrfsvol:"):
+        root = "/".join(root[len("btrfsvol:"):].split("/")[:3])
+    if g.is_lv(root):
+        lv_uuid = g.lvuuid(root)
+        pvs = dict((g.pvuuid(pv), pv) for pv in g.pvs())
+        for vg in g.vgs():
+            if lv_uuid in g.vglvuuids(vg):
+                indexes = set()
+                for pv_uuid in g.vgpvuuids(vg):
+                    indexes |= root_drive_indexes(g, pvs[pv_uuid])
+                return indexes
+        return set()
+    try:
+        root = g.part_to_dev(root)
+    except RuntimeError:
+        # Already a whole device
+        pass
+    return set([g.device_index(root)])
+
+
+class PackedGroup:
+    def __init__(self):
+        self.members = []
+        self.drives = 0
+        self.closed = False
+        self.done = threading.Event()
+        self.errors = {}
+        self.timings = {}
+
+
+class AppliancePacker:
+    # Inspects several VMs of a batch with a single appliance launch. The
+    # first VM to arrive opens a group and waits up to `wait` seconds for
+    # others, within the drive and memory budget, then launches the
+    # appliance with all their drives. Roots are mapped back to their VM by
+    # drive index, and every VM is inspected in isolation, so one VM's
+    # failure doesn't affect the others. VMs whose LVM volume groups clash
+    # by name with another VM's can't share an appliance, they are
+    # inspected on their own afterwards, as are VMs sharing a filesystem
+    # UUID or label with another, VMs that mount a disk left out by triage,
+    # and all of them if the shared appliance can't be launched.
+    def __init__(self, max_drives=16, memory_base=1024, memory_per_vm=256, max_memory=4096, wait=5):
+        self._max_drives = max_drives
+        self._max_vms = max(1, (max_memory - memory_base) // memory_per_vm)
+        self._memory_base = memory_base
+        self._memory_per_vm = memory_per_vm
+        self._wait = wait
+        self._group = None
+        self._cond = threading.Condition()
+
+
+    def _fits(self, group, analyzer):
+        return (len(group.members) < self._max_vms
+                and group.drives + len(analyzer.drive_sockets()) <= self._max_drives)
+
+
+    def inspect(self, analyzer, slot):
+        leader = False
+        with self._cond:
+            group = self._group
+            if group is None or group.closed or not self._fits(group, analyzer):
+                if group and not group.closed:
+                    group.closed = True
+                    self._cond.notify_all()
+                group = PackedGroup()
+                self._group = group
+                leader = True
+            group.members.append(analyzer)
+            group.drives += len(analyzer.drive_sockets())
+            if not self._fits(group, analyzer):
+                group.closed = True
+                self._group = None
+                self._cond.notify_all()
+
+        if leader:
+            deadline = time.monotonic() + self._wait
+            with self._cond:
+                while not group.closed and time.monotonic() < deadline:
+                    self._cond.wait(deadline - time.monotonic())
+                group.closed = True
+                if self._group is group:
+                    self._group = None
+            try:
+                self._run(group, slot)
+            except Exception as e:
+                for member in group.members:
+                    group.errors.setdefault(member, e)
+            finally:
+                group.done.set()
+
+        group.done.wait()
+        if analyzer in group.errors:
+            raise group.errors[analyzer]
+        return group.timings[analyzer]
+
+
+    def _isolated(self, g, owners):
+        # Members that can't share the appliance: those with a PV of a
+        # volume group whose name clashes with another's (or a PV that can't
+        # be read), and those with a filesystem UUID or label another member
+        # also has, as VMs cloned from one template do. Their fstab entries
+        # would resolve to whichever disk comes first.
+        alone = []
+        def isolate(device):
+            for index in root_drive_indexes(g, device):
+                if owners[index] not in alone:
+                    alone.append(owners[index])
+
+        vg_names = [vg["vg_name"] for vg in g.vgs_full()]
+        clashing = set(name for name in vg_names if vg_names.count(name) > 1)
+        if clashing:
+            for pv in g.pvs():
+                try:
+                    vg_name = lvm_vg_name(lambda offset, count: g.pread_device(pv, count, offset))
+                except RuntimeError:
+                    vg_name = None
+                if vg_name is None or vg_name in clashing:
+                    isolate(pv)
+
+        owners_by_id = collections.defaultdict(set)
+        devices_by_id = collections.defaultdict(list)
+        for device in g.list_filesystems():
+            try:
+                members = set(owners[index] for index in root_drive_indexes(g, device))
+                ids = [("UUID", g.vfs_uuid(device)), ("LABEL", g.vfs_label(device))]
+            except RuntimeError:
+                continue
+            for fs_id in ids:
+                if fs_id[1]:
+                    owners_by_id[fs_id] |= members
+                    devices_by_id[fs_id].append(device)
+        for fs_id, members in owners_by_id.items():
+            if len(members) > 1:
+                for device in devices_by_id[fs_id]:
+                    isolate(device)
+        return alone
+
+
+    def _run(self, group, slot):
+        started = time.monotonic()
+        with slot:
+            waited = time.monotonic() - started
+            alone = []
+            appliance = None
+            launched = False
+            healthy = False
+            try:
+                appliance = APPLIANCE_POOL.acquire(memsize=self._memory_base + self._memory_per_vm * len(group.members))
+                g = appliance.g
+                owners = []
+                for member in group.members:
+                    for socket_path in member.drive_sockets():
+                        appliance.add_nbd_drive(socket_path)
+                        owners.append(member)
+                appliance.launch()
+                launched = True
+                alone.extend(self._isolated(g, owners))
+
+                roots = dict((member, []) for member in group.members)
+                if len(alone) < len(group.members):
+                    for root in g.inspect_os():
+                        indexes = root_drive_indexes(g, root)
+                        members = set(owners[index] for index in indexes)
+                        if len(members) == 1:
+                            roots[members.pop()].append(root)
+
+                for member in group.members:
+                    if member in alone:
+                        continue
+                    try:
+                        if member.needs_left_out_disks(g, roots[member]):
+                            member.reattach_disks()
+                            alone.append(member)
+                            continue
+                        member.stop_left_out_exports()
+                        member.inspect_roots(g, roots[member])
+                    except Exception as e:
+                        group.errors[member] = e
+                healthy = True
+            except Exception as e:
+                if not launched:
+                    # One bad appliance shouldn't fail the whole group
+                    print("[ERROR] Could not launch a shared appliance, inspecting each VM on its own: %s" % e)
+                    alone = list(group.members)
+                else:
+                    for member in group.members:
+                        if member not in alone:
+                            group.errors.setdefault(member, e)
+            finally:
+                if appliance is not None:
+                    APPLIANCE_POOL.release(appliance, healthy)
+            run = time.monotonic() - started - waited
+            for member in group.members:
+                group.timings[member] = { "wait": round(waited, 3), "run": round(run, 3), "packed": len(group.members) - len(alone) }
+                if member not in alone:
+                    member.stop_exports()
+
+            for member in alone:
+                print("Inspecting VM %s on its own appliance" % member.vm_moref())
+                member_started = time.monotonic()
+                try:
+                    member.inspect()
+                except Exception as e:
+                    group.errors[member] = e
+                group.timings[member] = { "wait": round(waited, 3), "run": round(time.monotonic() - member_started, 3), "packed": 1 }
+
+
+SCAN_PIPELINE = ScanPipeline(
+    limits = {
+        "connect": int(os.environ.get("BATCH_CONNECT_CONCURRENCY", "8")),
+        "snapshot": int(os.environ.get("BATCH_SNAPSHOT_CONCURRENCY", "4")),
+        "export": int(os.environ.get("BATCH_EXPORT_CONCURRENCY", "4")),
+        "inspect": int(os.environ.get("BATCH_INSPECT_CONCURRENCY", "2"))
+    },
+    window = int(os.environ.get("BATCH_WINDOW", "6")),
+    scheduler = SCAN_SCHEDULER,
+    packer = AppliancePacker(
+        max_drives = int(os.environ.get("PACK_MAX_DRIVES", "16")),
+        memory_base = int(os.environ.get("PACK_MEMORY_BASE", "1024")),
+        memory_per_vm = int(os.environ.get("PACK_MEMORY_PER_VM", "256")),
+        max_memory = int(os.environ.get("PACK_MAX_MEMORY", "4096")),
+        wait = float(os.environ.get("PACK_WAIT", "5"))
+    )
+)
+
+
+NBDKIT_START_TIMEOUT = float(os.environ.get("NBDKIT_START_TIMEOUT", "60"))
+NBDKIT_PLUGIN = os.environ.get("NBDKIT_PLUGIN", "vddk")
+NBDKIT_FILE_ROOT = os.environ.get("NBDKIT_FILE_ROOT", "/data/disks")
+NBDKIT_FILTERS = json.loads(os.environ.get("NBDKIT_FILTERS", "[]"))
+# The options each filter may be given in a scan request, and their type.
+# Anything else would reach the plugin or filters as a parameter.
+NBDKIT_ALLOWED_FILTERS = {
+    "readahead": {},
+    "cache": {
+        "cache-max-size": "size",
+        "cache-min-block-size": "size",
+        "cache-high-threshold": "int",
+        "cache-low-threshold": "int",
+        "cache-on-read": "bool"
+    },
+    "cacheextents": {},
+    "blocksize": { "minblock": "size", "maxdata": "size", "maxlen": "size" },
+    "retry": { "retries": "int", "retry-delay": "number", "retry-exponential": "bool", "retry-readonly": "bool" }
+}
+NBDKIT_OPTION_TYPES = {
+    "int": re.compile(r"^[0-9]+$"),
+    "number": re.compile(r"^[0-9]+(\.[0-9]+)?$"),
+    "size": re.compile(r"^[0-9]+[kKmMgGtTpPeE]?$"),
+    "bool": re.compile(r"^(true|false|yes|no|on|off|1|0)$", re.IGNORECASE)
+}
+
+def nbdkit_option_value(value, option_type):
+    # Option value as passed to nbdkit, None if it isn't of the given type
+    if isinstance(value, bool):
+        return ("true" if value else "false") if option_type == "bool" else None
+    if isinstance(value, int) or (isinstance(value, float) and option_type == "number"):
+        value = str(value)
+    if isinstance(value, str) and NBDKIT_OPTION_TYPES[option_type].match(value):
+        return value
+    return None
+
+TRIAGE_DISKS = os.environ.get("TRIAGE_DISKS", "false").lower() == "true"
+
+NBDKIT_STATS_UNITS = { "bytes": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3, "TiB": 1024 ** 4 }
+
+def read_nbdkit_stats(statsfile):
+    # Lines look like "read: 1234 ops, 0.012 s, 5.00 MiB, 1.00 MiB/s"; the
+    # time column only exists in recent nbdkit versions.
+    stats = {}
+    if not os.path.exists(statsfile):
+        return stats
+    with open(statsfile) as f:
+        for line in f:
+            match = re.match(r"^(\w+): (\d+) ops(?:, [\d.]+ s)?(?:, ([\d.]+) (bytes|KiB|MiB|GiB|TiB))?", line.strip())
+            if match and match.group(1) != "total":
+                stats[match.group(1)] = { "requests": int(match.group(2)) }
+                if match.group(3):
+                    stats[match.group(1)]["bytes"] = int(float(match.group(3)) * NBDKIT_STATS_UNITS[match.group(4)])
+    return stats
+
+
+def wait_for_nbd_exports(exports, timeout):
+    # Waits for the pidfiles of all the exports with a single deadline, and
+    # fails as soon as one nbdkit process exits.
+    deadline = time.monotonic() + timeout
+    pending = list(exports)
+    while pending:
+        for export in list(pending):
+            if os.path.exists(export["pidfile"]) and os.path.getsize(export["pidfile"]) > 0:
+                pending.remove(export)
+            elif export["process"].poll() is not None:
+                raise Exception("nbdkit exited with code %d before serving disk %s" % (export["process"].returncode, export["disk"]))
+        if not pending:
+            break
+        if time.monotonic() > deadline:
+            raise Exception("nbdkit did not serve disks %s within %.0f seconds" % (", ".join(e["disk"] for e in pending), timeout))
+        time.sleep(0.005)
+
+
+GPT_BOOT_TYPES = [
+    uuid.UUID("C12A7328-F81F-11D2-BA4B-00A0C93EC93B"),  # EFI system partition
+    uuid.UUID("21686148-6449-6E6F-744E-656564454649")   # BIOS boot partition
+]
+GPT_LVM_TYPE = uuid.UUID("E6D6D379-F507-44C2-A23C-238F2A3DF928")
+MBR_EXTENDED_TYPES = [0x05, 0x0f, 0x85]
+MBR_LVM_TYPE = 0x8e
+
+LINUX_FILESYSTEMS = ["LVM2_member", "ext", "xfs", "btrfs"]
+
+def sniff_filesystem(read, offset):
+    label = read(offset + 512, 32)
+    if label[0:8] == b"LABELONE" and label[24:32] == b"LVM2 001":
+        return { "type": "LVM2_member", "vg": lvm_vg_name(lambda pv_offset, count: read(offset + pv_offset, count)) }
+    if read(offset, 6) == b"LUKS\xba\xbe":
+        return { "type": "crypto_LUKS" }
+    superblock = read(offset + 1024, 200)
+    if superblock[56:58] == b"\x53\xef":
+        return { "type": "ext", "last_mounted": superblock[136:200].split(b"\0")[0].decode("utf-8", errors="replace") }
+    if read(offset, 4) == b"XFSB":
+        return { "type": "xfs" }
+    if read(offset + 3, 8) == b"NTFS    ":
+        return { "type": "ntfs" }
+    if read(offset + 0x10040, 8) == b"_BHRfS_M":
+        return { "type": "btrfs" }
+    if read(offset + 82, 5) == b"FAT32" or read(offset + 54, 4) == b"FAT1":
+        return { "type": "vfat" }
+    if read(offset + 4086, 10) in [b"SWAPSPACE2", b"SWAP-SPACE"]:
+        return { "type": "swap" }
+    return None
+
+
+LVM_MDA_MAGIC = b" LVM2 x[5A%r0N*>"
+
+def lvm_vg_name(read):
+    # Name of the volume group of an LVM physical volume, from the text
+    # metadata in its first metadata area. read(offset, count) reads the PV.
+    label = read(512, 512)
+    if label[0:8] != b"LABELONE" or label[24:32] != b"LVM2 001":
+        return None
+    pv_header = label[struct.unpack("<I", label[20:24])[0]:]
+    # After the PV UUID and size come the data areas, then the metadata
+    # areas, each list ending with an empty entry
+    areas = [[], []]
+    position = 40
+    for area_list in areas:
+        while position + 16 <= len(pv_header):
+            offset, size = struct.unpack("<QQ", pv_header[position:position + 16])
+            position += 16
+            if offset == 0:
+                break
+            area_list.append(offset)
+    if not areas[1]:
+        return None
+    mda_header = read(areas[1][0], 512)
+    if mda_header[4:20] != LVM_MDA_MAGIC:
+        return None
+    text_offset, text_size = struct.unpack("<QQ", mda_header[40:56])
+    if text_size == 0:
+        return None
+    match = re.match(rb"\s*([A-Za-z0-9+_.-]+)\s*\{", read(areas[1][0] + text_offset, min(text_size, 512)))
+    return match.group(1).decode() if match else None
+
+
+def triage_disk(socket_path, index):
+    # Reads the partition table and the superblocks of each partition over
+    # NBD, before the appliance is launched, and tells whether the disk is
+    # needed to find the OS. The first disk, bootable disks and disks with a
+    # root filesystem are, and so are disks whose partitions can't be
+    # recognised. Data, swap, NTFS and empty disks are left out, LVM disks
+    # are kept or not by _triage_exports depending on their volume groups.
+    # If the guest turns out to mount a left out disk, inspection attaches
+    # it again.
+    h = nbd.NBD()
+    h.connect_unix(socket_path)
+    try:
+        size = h.get_size()
+        def read(offset, count):
+            if offset < 0 or offset + count > size:
+                return b""
+            return h.pread(count, offset)
+
+        boot = False
+        lvm = False
+        partitions = []
+        whole = sniff_filesystem(read, 0)
+        sector0 = read(0, 512)
+        if whole is None and sector0[510:512] == b"\x55\xaa":
+            entries = [sector0[446 + 16 * i:462 + 16 * i] for i in range(4)]
+            header = read(512, 92)
+            if any(e[4] == 0xee for e in entries) and header[0:8] == b"EFI PART":
+                entries_lba, count, entry_size = struct.unpack("<QII", header[72:88])
+                table = read(entries_lba * 512, min(count, 128) * entry_size)
+                for i in range(len(table) // entry_size):
+                    entry = table[i * entry_size:(i + 1) * entry_size]
+                    type_guid = uuid.UUID(bytes_le=entry[0:16])
+                    if type_guid.int == 0:
+                        continue
+                    first, last = struct.unpack("<QQ", entry[32:48])
+                    boot = boot or type_guid in GPT_BOOT_TYPES
+                    lvm = lvm or type_guid == GPT_LVM_TYPE
+                    partitions.append(first * 512)
+            else:
+                ebr_base = None
+                ebr_hops = 0
+                while entries:
+                    entry = entries.pop(0)
+                    status, ptype = entry[0], entry[4]
+                    start = struct.unpack("<I", entry[8:12])[0]
+                    if ptype == 0:
+                        continue
+                    boot = boot or status == 0x80
+                    lvm = lvm or ptype == MBR_LVM_TYPE
+                    if ptype in MBR_EXTENDED_TYPES:
+                        # Logical partitions are chained through EBRs
+                        ebr_offset = (start + (ebr_base or 0)) * 512
+                        ebr_base = ebr_base or start
+                        ebr = read(ebr_offset, 512)
+                        ebr_hops += 1
+                        if ebr[510:512] == b"\x55\xaa" and ebr_hops <= 128:
+                            logical = bytearray(ebr[446:462])
+                            logical[8:12] = struct.pack("<I", struct.unpack("<I", ebr[454:458])[0] + ebr_offset // 512)
+                            entries.extend([bytes(logical), ebr[462:478]])
+                        continue
+                    partitions.append(start * 512)
+
+        sniffed = [whole] if whole else [sniff_filesystem(read, offset) for offset in partitions]
+        types = [fs["type"] if fs else None for fs in sniffed]
+        lvm = lvm or "LVM2_member" in types
+        root = any(fs and (fs["type"] == "btrfs" or fs.get("last_mounted") == "/") for fs in sniffed)
+        # None stands for a PV whose volume group can't be read
+        vgs = set(fs.get("vg") for fs in sniffed if fs and fs["type"] == "LVM2_member")
+        if lvm and not vgs:
+            vgs = set([None])
+
+        if boot or index == 0 or root:
+            disk_class = "os"
+        elif lvm:
+            disk_class = "lvm"
+        elif not sniffed:
+            disk_class = "empty"
+        elif all(t == "swap" for t in types):
+            disk_class = "swap"
+        elif all(t == "ntfs" for t in types):
+            disk_class = "ntfs"
+        elif any(t is None for t in types):
+            disk_class = "unknown"
+        else:
+            disk_class = "data"
+        return {
+            "class": disk_class,
+            "partitions": len(partitions),
+            "filesystems": [t for t in types if t],
+            "root": root,
+            "vgs": sorted(vgs, key=str),
+            "attached": disk_class in ["os", "lvm", "unknown"]
+        }
+    finally:
+        h.shutdown()
+
+
+def stop_nbdkit(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+BLOCK_CACHE_DIR = os.environ.get("BLOCK_CACHE_DIR", "/var/cache/vm-analyzer/blocks")
+BLOCK_CACHE_MAX_BYTES = int(os.environ.get("BLOCK_CACHE_MAX_BYTES", str(20 * 1024 ** 3)))
+BLOCK_CACHE_BLOCK_SIZE = int(os.environ.get("BLOCK_CACHE_BLOCK_SIZE", "65536"))
+BLOCK_CACHE_PLUGIN = os.environ.get("BLOCK_CACHE_PLUGIN", "/usr/local/lib/vm-analyzer/nbdkit-block-cache.py")
+
+def block_cache_cmd(socket_path, pidfile, upstream_socket, cache_dir):
+    nbdkit_cmd = ['/usr/sbin/nbdkit', '--readonly', '--exit-with-parent', '--newstyle']
+    nbdkit_cmd.extend(['--unix', socket_path, '--pidfile', pidfile])
+    nbdkit_cmd.extend(['python', BLOCK_CACHE_PLUGIN])
+    nbdkit_cmd.extend(['upstream=%s' % upstream_socket, 'cache=%s' % cache_dir])
+    nbdkit_cmd.extend(['block-size=%d' % BLOCK_CACHE_BLOCK_SIZE])
+    return nbdkit_cmd
+
+
+class BlockCacheStore:
+    # One directory per disk UUID, holding the sparse data file and block
+    # bitmap used by nbdkit-block-cache.py, and a meta.json with the change
+    # ID the cached blocks are valid for. Before a scan, the blocks changed
+    # since that change ID are dropped from the bitmap. Directories are
+    # evicted least recently used first once the store exceeds max_bytes.
+    def __init__(self, directory, max_bytes, block_size):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._block_size = block_size
+        self._in_use = set()
+        self._lock = threading.Lock()
+
+
+    def _read_meta(self, path):
+        try:
+            with open(os.path.join(path, "meta.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    def _write_meta(self, path, meta):
+        with open(os.path.join(path, "meta.json.tmp"), "w") as f:
+            json.dump(meta, f)
+        os.rename(os.path.join(path, "meta.json.tmp"), os.path.join(path, "meta.json"))
+
+
+    def _invalidate(self, path, areas):
+        bitmap_path = os.path.join(path, "bitmap")
+        if not os.path.exists(bitmap_path):
+            return
+        with open(bitmap_path, "rb") as f:
+            bitmap = bytearray(f.read())
+        for start, length in areas:
+            if length <= 0:
+                continue
+            for block in range(start // self._block_size, (start + length - 1) // self._block_size + 1):
+                if block // 8 < len(bitmap):
+                    bitmap[block // 8] &= ~(1 << (block % 8)) & 0xff
+        with open(bitmap_path + ".tmp", "wb") as f:
+            f.write(bitmap)
+        os.rename(bitmap_path + ".tmp", bitmap_path)
+
+
+    def prepare(self, disk_uuid, size, change_id, changed_areas):
+        with self._lock:
+            if disk_uuid in self._in_use:
+                return None, "busy"
+            self._in_use.add(disk_uuid)
+
+        try:
+            path = os.path.join(self._directory, disk_uuid)
+            meta = self._read_meta(path)
+            status = "new"
+            if meta and meta["size"] == size and meta["block_size"] == self._block_size:
+                if meta["change_id"] == change_id:
+                    status = "unchanged"
+                else:
+                    areas = changed_areas(meta["change_id"])
+                    if areas is not None:
+                        self._invalidate(path, areas)
+                        status = "incremental"
+            if status == "new":
+                shutil.rmtree(path, ignore_errors=True)
+                os.makedirs(path)
+
+            self._write_meta(path, {
+                "disk_uuid": disk_uuid,
+                "size": size,
+                "block_size": self._block_size,
+                "change_id": change_id,
+                "last_used": time.time()
+            })
+        except Exception:
+            self.release(disk_uuid)
+            raise
+        return path, status
+
+
+    def release(self, disk_uuid):
+        with self._lock:
+            self._in_use.discard(disk_uuid)
+
+
+    def evict(self):
+        if not os.path.isdir(self._directory):
+            return
+        entries = []
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            if not os.path.isdir(path):
+                continue
+            meta = self._read_meta(path) or {}
+            usage = 0
+            for f in os.listdir(path):
+                try:
+                    usage += os.stat(os.path.join(path, f)).st_blocks * 512
+                except OSError:
+                    # Renamed or removed by a running scan
+                    pass
+            entries.append((meta.get("last_used", 0), name, path, usage))
+        total = sum(e[3] for e in entries)
+        for last_used, name, path, usage in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            with self._lock:
+                if name in self._in_use:
+                    continue
+                print("Evicting block cache of disk %s" % name)
+                shutil.rmtree(path, ignore_errors=True)
+            total -= usage
+
+
+BLOCK_CACHE_STORE = BlockCacheStore(BLOCK_CACHE_DIR, BLOCK_CACHE_MAX_BYTES, BLOCK_CACHE_BLOCK_SIZE)
+
+
+class VsphereChangedAreas:
+    # Changed Block Tracking lookups for the disks of a snapshot. The change
+    # ID of a disk is only set when CBT is enabled on the VM.
+    def __init__(self, vm, snapshot):
+        self._vm = vm
+        self._snapshot = snapshot
+
+
+    def disk_info(self, disk):
+        for device in self._snapshot.config.hardware.device:
+            if isinstance(device, vim.vm.device.VirtualDisk) and device.backing.fileName == disk["file"]:
+                return {
+                    "uuid": device.backing.uuid,
+                    "key": device.key,
+                    "size": device.capacityInBytes,
+                    "change_id": getattr(device.backing, "changeId", None)
+                }
+        return None
+
+
+    def changed_areas(self, info, since_change_id):
+        areas = []
+        offset = 0
+        try:
+            while offset < info["size"]:
+                changes = self._vm.QueryChangedDiskAreas(snapshot=self._snapshot, deviceKey=info["key"],
+                                                         startOffset=offset, changeId=since_change_id)
+                areas.extend((area.start, area.length) for area in changes.changedArea or [])
+                offset = changes.startOffset + changes.length
+        except vmodl.MethodFault as e:
+            # The change ID is no longer valid, e.g. CBT was reset
+            print("Could not query changed areas of disk %s: %s" % (info["uuid"], e.msg))
+            return None
+        return areas
+
+
+class InventoryClient:
+    # Forklift inventory client shared by all the scans. It uses one pooled
+    # HTTPS session, caches /vms/<id> and /hosts/<id> objects for ttl
+    # seconds, and lets concurrent callers asking for the same object share
+    # the same request. Callers that need a fresher object, like the disk
+    # lookups the result fingerprint is made of, pass a shorter max_age.
+    CACHEABLE = re.compile(r"/(vms|hosts)/[^/?]+$")
+
+    def __init__(self, ttl=300, max_entries=10000, pool_size=16):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._cache = collections.OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._counters = { "requests": 0, "hits": 0, "coalesced": 0, "evictions": 0 }
+
+
+    def _fetch(self, url):
+        with self._lock:
+            self._counters["requests"] += 1
+        api_response = self._session.get(url, verify=os.environ.get("CA_TLS_CERTIFICATE", True))
+        if(api_response.ok):
+            return json.loads(api_response.content)
+        else:
+            raise Exception("Failed call to inventory database, return code: %s" % api_response)
+
+
+    def _store(self, url, value):
+        # Called with the lock held
+        self._cache[url] = (time.monotonic(), value)
+        self._cache.move_to_end(url)
+        while len(self._cache) > self._max_entries:
+            self._cache.popitem(last=False)
+            self._counters["evictions"] += 1
+
+
+    def get(self, url, max_age=None):
+        if not self.CACHEABLE.search(url):
+            return self._fetch(url)
+
+        max_age = self._ttl if max_age is None else min(max_age, self._ttl)
+        with self._lock:
+            cached = self._cache.get(url)
+            if cached and time.monotonic() - cached[0] < max_age:
+                self._counters["hits"] += 1
+                return copy.deepcopy(cached[1])
+            inflight = self._inflight.get(url)
+            owner = inflight is None
+            if owner:
+                inflight = { "done": threading.Event(), "value": None, "error": None }
+                self._inflight[url] = inflight
+            else:
+                self._counters["coalesced"] += 1
+
+        if owner:
+            try:
+                inflight["value"] = self._fetch(url)
+                with self._lock:
+                    self._store(url, inflight["value"])
+            except Exception as e:
+                inflight["error"] = e
+            finally:
+                with self._lock:
+                    del self._inflight[url]
+                inflight["done"].set()
+        else:
+            inflight["done"].wait()
+
+        if inflight["error"]:
+            raise inflight["error"]
+        return copy.deepcopy(inflight["value"])
+
+
+    def prefetch(self, provider_url, vm_ids=None):
+        # Loads the VMs, and their hosts, of a provider with one list call
+        # each, so that the following lookups are served from the cache.
+        vms = self._fetch(provider_url + "/vms?detail=1")
+        if vm_ids is not None:
+            vms = [vm for vm in vms if vm["id"] in vm_ids]
+        host_ids = set(vm["host"]["id"] for vm in vms if vm.get("host"))
+        hosts = [host for host in self._fetch(provider_url + "/hosts?detail=1") if host["id"] in host_ids]
+        with self._lock:
+            for vm in vms:
+                self._store(provider_url + "/vms/" + vm["id"], vm)
+            for host in hosts:
+                self._store(provider_url + "/hosts/" + host["id"], host)
+        return len(vms), len(hosts)
+
+
+    def invalidate(self, url):
+        with self._lock:
+            self._cache.pop(url, None)
+
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._cache)
+        return stats
+
+
+INVENTORY_CLIENT = InventoryClient(
+    ttl = int(os.environ.get("INVENTORY_CACHE_TTL", "300")),
+    max_entries = int(os.environ.get("INVENTORY_CACHE_SIZE", "10000"))
+)
+
+
+class VsphereSession:
+    def __init__(self, key, host, username, password):
+        print("Connecting to %s as %s" % (host, username))
+        smart_stub = SmartStubAdapter(
+            host = host,
+            port = 443,
+            sslContext = ssl._create_unverified_context(),
+            connectionPoolTimeout = 0
+        )
+        session_stub = VimSessionOrientedStub(
+            smart_stub,
+            VimSessionOrientedStub.makeUserLoginMethod(username, password)
+        )
+        self.si = vim.ServiceInstance('ServiceInstance', session_stub)
+        if not self.si:
+            raise Exception("Could not connect to %s" % host)
+        self.key = key
+        self.host = host
+        self.last_used = time.monotonic()
+
+
+    def bind(self, managed_object):
+        # The same vSphere object, used through this session
+        return type(managed_object)(managed_object._moId, self.si._stub)
+
+
+    def ping(self):
+        self.si.CurrentTime()
+        self.last_used = time.monotonic()
+
+
+    def close(self):
+        try:
+            Disconnect(self.si)
+        except:
+            pass
+
+
+# Errors after which a vSphere session is not reused: its login is gone or
+# its connection broke
+VSPHERE_SESSION_ERRORS = (
+    vim.fault.NotAuthenticated,
+    vmodl.fault.HostCommunication,
+    http.client.HTTPException,
+    ConnectionError,
+    socket.timeout,
+    ssl.SSLError
+)
+
+def is_vsphere_session_error(error):
+    # The error itself or one it was raised from
+    while error is not None:
+        if isinstance(error, VSPHERE_SESSION_ERRORS):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class VsphereSessionPool:
+    # Logged in vSphere sessions, shared by the scans of the same host and
+    # user. At most max_per_host sessions, idle or in use, are open against
+    # a host; scans wait for one to be released beyond that. Idle sessions
+    # are kept alive, and logged out after idle_timeout seconds.
+    def __init__(self, max_per_host=4, idle_timeout=900, keepalive=120, acquire_timeout=1800):
+        self._max_per_host = max_per_host
+        self._idle_timeout = idle_timeout
+        self._keepalive = keepalive
+        self._acquire_timeout = acquire_timeout
+        self._idle = {}
+        self._open = collections.Counter()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._counters = { "logins": 0, "reused": 0, "waits": 0, "expired": 0 }
+
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._keep_alive, daemon=True)
+            self._thread.start()
+
+
+    def acquire(self, host, username, password):
+        key = (host, username, hashlib.sha256(password.encode()).hexdigest())
+        deadline = time.monotonic() + self._acquire_timeout
+        evicted = None
+        with self._cond:
+            while True:
+                if self._idle.get(key):
+                    session = self._idle[key].pop()
+                    self._counters["reused"] += 1
+                    break
+                if self._open[host] < self._max_per_host:
+                    self._open[host] += 1
+                    session = None
+                    break
+                # Make room by logging out an idle session of another user
+                others = [k for k, sessions in self._idle.items() if k[0] == host and sessions]
+                if others:
+                    evicted = self._idle[others[0]].pop()
+                    session = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Exception("No vSphere session available for %s after %d seconds" % (host, self._acquire_timeout))
+                self._counters["waits"] += 1
+                self._cond.wait(remaining)
+
+        if evicted:
+            evicted.close()
+        if session and time.monotonic() - session.last_used > self._keepalive:
+            try:
+                session.ping()
+            except Exception as e:
+                print("vSphere session to %s is not usable anymore: %s" % (host, e))
+                session.close()
+                session = None
+        if session is None:
+            try:
+                session = VsphereSession(key, host, username, password)
+            except Exception:
+                with self._cond:
+                    self._open[host] -= 1
+                    self._cond.notify_all()
+                raise
+            with self._cond:
+                self._counters["logins"] += 1
+        return session
+
+
+    def release(self, session, healthy=True):
+        session.last_used = time.monotonic()
+        with self._cond:
+            if healthy:
+                self._idle.setdefault(session.key, []).append(session)
+            else:
+                self._open[session.host] -= 1
+            self._cond.notify_all()
+        if not healthy:
+            session.close()
+
+
+    def _keep_alive(self):
+        while True:
+            time.sleep(self._keepalive)
+            with self._cond:
+                idle = [s for sessions in self._idle.values() for s in sessions]
+                for sessions in self._idle.values():
+                    sessions.clear()
+            alive = []
+            expired = 0
+            for session in idle:
+                if time.monotonic() - session.last_used > self._idle_timeout:
+                    expired += 1
+                    session.close()
+                    continue
+                try:
+                    session.ping()
+                    alive.append(session)
+                except Exception:
+                    session.close()
+            with self._cond:
+                self._counters["expired"] += expired
+                for session in idle:
+                    if session in alive:
+                        self._idle.setdefault(session.key, []).append(session)
+                    else:
+                        self._open[session.host] -= 1
+                self._cond.notify_all()
+
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats["open"] = dict(self._open)
+            stats["idle"] = sum(len(sessions) for sessions in self._idle.values())
+        return stats
+
+
+VSPHERE_SESSIONS = VsphereSessionPool(
+    max_per_host = int(os.environ.get("VSPHERE_MAX_SESSIONS_PER_HOST", "4")),
+    idle_timeout = int(os.environ.get("VSPHERE_SESSION_IDLE_TIMEOUT", "900")),
+    keepalive = int(os.environ.get("VSPHERE_SESSION_KEEPALIVE", "120"))
+)
+
+
+class PendingSnapshot:
+    def __init__(self, vm, name, task):
+        self.vm = vm
+        self.name = name
+        self._task = task
+        self._started = time.monotonic()
+        self._snapshot = None
+
+
+    def wait(self, session=None):
+        # The reaper waits through its own session rather than the scan's
+        if self._snapshot is None:
+            task = session.bind(self._task) if session else self._task
+            WaitForTask(task)
+            self._snapshot = task.info.result
+            SNAPSHOTS.observe("create", time.monotonic() - self._started)
+        return self._snapshot
+
+
+class SnapshotManager:
+    # Snapshots are created asynchronously, so the caller can prepare the
+    # rest of the scan while vSphere works, and removed by background reaper
+    # threads, so the scan result doesn't wait for the consolidation.
+    # Leftovers of scans that died are swept once per ESXi host. Other
+    # replicas and other tools snapshot the same VMs, so only snapshots
+    # named by this service and older than max_age seconds, which no scan
+    # still running can own, are swept. Names carry a per-process token
+    # and a random suffix so concurrent scans never share one. Removals and
+    # sweeps take their own session from the pool, the scan's session is
+    # back in the pool by the time they run.
+    SUFFIX = "-vm-analysis"
+    NAME_PATTERN = re.compile(r"^\d{14}-[0-9a-f]{8}-[0-9a-f]{8}-vm-analysis$")
+
+    def __init__(self, sessions, reapers=2, retries=3, retry_delay=30, max_age=21600):
+        self._sessions = sessions
+        self._reapers = reapers
+        self._max_age = max_age
+        self.token = uuid.uuid4().hex[:8]
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._queue = collections.deque()
+        self._active = set()
+        self._swept = set()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._counters = { "created": 0, "removed": 0, "failed": 0, "orphans": 0 }
+        self._latency = {
+            "create": { "count": 0, "sum": 0.0, "max": 0.0 },
+            "remove": { "count": 0, "sum": 0.0, "max": 0.0 }
+        }
+
+
+    def start(self):
+        while len(self._threads) < self._reapers:
+            thread = threading.Thread(target=self._reap, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+
+    def observe(self, operation, seconds):
+        with self._cond:
+            latency = self._latency[operation]
+            latency["count"] += 1
+            latency["sum"] += seconds
+            latency["max"] = max(latency["max"], seconds)
+
+
+    def name(self, now):
+        return "%s-%s-%s%s" % (now.strftime("%Y%m%d%H%M%S"), self.token, uuid.uuid4().hex[:8], self.SUFFIX)
+
+
+    def create(self, vm, name, description, quiesce=True):
+        print("Creating %s snapshot to protect the VM disks" % ("quiesced" if quiesce else "crash-consistent"))
+        with self._cond:
+            self._active.add((vm._moId, name))
+            self._counters["created"] += 1
+        task = vm.CreateSnapshot(name = name,
+                                 description = description,
+                                 memory = False,
+                                 quiesce = quiesce)
+        return PendingSnapshot(vm, name, task)
+
+
+    def remove(self, vm, name, snapshot, credentials):
+        # snapshot is either a snapshot object or a PendingSnapshot whose
+        # creation the reaper waits for first. credentials are the host,
+        # username and password to get a session for the removal.
+        with self._cond:
+            self._queue.append({ "vm": vm, "name": name, "snapshot": snapshot, "credentials": credentials,
+                                 "attempts": 0, "not_before": 0 })
+            self._cond.notify()
+
+
+    def _reap(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                item = self._queue.popleft()
+            delay = item["not_before"] - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            started = time.monotonic()
+            try:
+                self._remove(item)
+                self.observe("remove", time.monotonic() - started)
+                with self._cond:
+                    self._counters["removed"] += 1
+                    self._active.discard((item["vm"]._moId, item["name"]))
+            except Exception as e:
+                item["attempts"] += 1
+                print("[ERROR] Could not remove snapshot %s of VM %s (attempt %d): %s" % (item["name"], item["vm"]._moId, item["attempts"], e))
+                with self._cond:
+                    if item["attempts"] < self._retries:
+                        item["not_before"] = time.monotonic() + self._retry_delay
+                        self._queue.append(item)
+                        self._cond.notify()
+                    else:
+                        self._counters["failed"] += 1
+                        self._active.discard((item["vm"]._moId, item["name"]))
+
+
+    def _remove(self, item):
+        session = self._sessions.acquire(*item["credentials"])
+        healthy = True
+        try:
+            snapshot = item["snapshot"]
+            if isinstance(snapshot, PendingSnapshot):
+                snapshot = snapshot.wait(session)
+            print("Removing snapshot %s of VM %s" % (item["name"], item["vm"]._moId))
+            WaitForTask(session.bind(snapshot).RemoveSnapshot_Task(False))
+        except Exception as e:
+            healthy = not is_vsphere_session_error(e)
+            raise
+        finally:
+            self._sessions.release(session, healthy)
+
+
+    def sweep(self, credentials):
+        host = credentials[0]
+        with self._cond:
+            if host in self._swept:
+                return
+            self._swept.add(host)
+        threading.Thread(target=self._sweep, args=(credentials,), daemon=True).start()
+
+
+    def _orphaned(self, vm, tree):
+        if not self.NAME_PATTERN.match(tree.name) or (vm._moId, tree.name) in self._active:
+            return False
+        created = tree.createTime
+        if created.tzinfo is None:
+            created = created.replace(tzinfo=datetime.timezone.utc)
+        return (datetime.datetime.now(datetime.timezone.utc) - created).total_seconds() > self._max_age
+
+
+    def _sweep(self, credentials):
+        host = credentials[0]
+        def walk(trees):
+            for tree in trees or []:
+                yield tree
+                for child in walk(tree.childSnapshotList):
+                    yield child
+        session = None
+        healthy = True
+        try:
+            session = self._sessions.acquire(*credentials)
+            si = session.si
+            view = si.content.viewManager.CreateContainerView(si.content.rootFolder, [vim.VirtualMachine], True)
+            for vm in view.view:
+                if vm.snapshot is None:
+                    continue
+                for tree in walk(vm.snapshot.rootSnapshotList):
+                    with self._cond:
+                        orphan = self._orphaned(vm, tree)
+                        if orphan:
+                            self._active.add((vm._moId, tree.name))
+                            self._counters["orphans"] += 1
+                    if orphan:
+                        print("Found orphaned snapshot %s of VM %s" % (tree.name, vm._moId))
+                        self.remove(vm, tree.name, tree.snapshot, credentials)
+            view.Destroy()
+        except Exception as e:
+            print("[ERROR] Could not sweep snapshots on %s: %s" % (host, e))
+            healthy = not is_vsphere_session_error(e)
+            with self._cond:
+                self._swept.discard(host)
+        finally:
+            if session:
+                self._sessions.release(session, healthy)
+
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats["pending_removals"] = len(self._queue)
+            stats["latency"] = copy.deepcopy(self._latency)
+        return stats
+
+
+SNAPSHOTS = SnapshotManager(
+    VSPHERE_SESSIONS,
+    reapers = int(os.environ.get("SNAPSHOT_REAPERS", "2")),
+    max_age = int(os.environ.get("SNAPSHOT_MAX_AGE", "21600"))
+)
+
+
+class ResultStore:
+    # Last scan result per VM UUID, reused as long as the fingerprint of the
+    # VM (disk change IDs and manifest version) is the same and the entry is
+    # younger than ttl seconds.
+    def __init__(self, max_entries=1000, ttl=86400):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = { "hits": 0, "misses": 0, "evictions": 0 }
+
+
+    @staticmethod
+    def fingerprint(vm_disks, manifest_version):
+        # Without a change ID for every disk there is no cheap way to tell
+        # that the VM didn't change.
+        change_ids = [(disk["file"], disk.get("changeId")) for disk in vm_disks]
+        if not change_ids or any(change_id is None for file, change_id in change_ids):
+            return None
+        fingerprint = json.dumps({ "disks": sorted(change_ids), "manifest": manifest_version })
+        return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+
+    def get(self, vm_uuid, fingerprint):
+        with self._lock:
+            entry = self._entries.get(vm_uuid)
+            if entry and time.time() - entry["stored"] > self._ttl:
+                del self._entries[vm_uuid]
+                self._counters["evictions"] += 1
+                entry = None
+            if fingerprint is None or entry is None or entry["fingerprint"] != fingerprint:
+                self._counters["misses"] += 1
+                return None
+            self._counters["hits"] += 1
+            self._entries.move_to_end(vm_uuid)
+            return entry["vm_config"]
+
+
+    def put(self, vm_uuid, fingerprint, vm_config):
+        if fingerprint is None:
+            return
+        with self._lock:
+            self._entries[vm_uuid] = { "fingerprint": fingerprint, "vm_config": vm_config, "stored": time.time() }
+            self._entries.move_to_end(vm_uuid)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._entries)
+        return stats
+
+
+RESULT_STORE = ResultStore(
+    max_entries = int(os.environ.get("RESULT_CACHE_SIZE", "1000")),
+    ttl = int(os.environ.get("RESULT_CACHE_TTL", "86400"))
+)
+
+
+def get_inventory_db(provider_uid):
+    if "INVENTORY_URL" in os.environ:
+        inventory_url = os.environ["INVENTORY_URL"]
+    else:
+        inventory_hostname = os.environ["INVENTORY_SERVICE"] + "." + os.environ["POD_NAMESPACE"] + ".svc.cluster.local"
+        inventory_socket   = inventory_hostname + ":" + os.environ["FORKLIFT_INVENTORY_SERVICE_PORT"]
+        inventory_url      = "https://" + inventory_socket
+    return inventory_url + "/providers/vsphere/" + provider_uid
+
+
 class VmAnalyzer:
-    def __init__(self, post_body):
+    def __init__(self, post_body, cancel_event=None):
         now = datetime.datetime.now()
         self._request = post_body
-        print("Initializing VmAnalyzer at %s" % now.strftime("%Y-%m-%d %H:%M:%S"))
-        self._inventory_db = self._get_inventory_db()
-        self._vm_uuid = self._get_vm_uuid()
-        self._vm_host = self._get_vm_host()
-        self._service_instance = self._connect()
-        self._vm = self._find_vm_by_uuid()
-        self._snapshot_name = "%s-vm-analysis" % now.strftime("%Y%m%d%H%M%S")
+        self._cancel_event = cancel_event or threading.Event()
+        # Everything close() uses is set before the inventory lookups, which
+        # can fail
+        self._closed = False
+        self._session = None
+        self._service_instance = None
+        self._vm = None
+        self._snapshot_name = SNAPSHOTS.name(now)
         self._snapshot_desc = "%s - VM Analysis" % now.strftime("%Y-%m-%d %H:%M:%S")
         self._snapshot = None
+        self._pending_snapshot = None
+        self._vm_disks = []
+        self._exports = []
+        self._software = []
+        self._nbd_stats = []
+        self._triage = None
+        self._timer = ScanTimer()
+        self._inventory_db = None
+        self._vm_uuid = None
+        self._vm_host = None
+        # The whole scan uses the manifest as it is when the scan starts
+        self._manifest = MANIFEST_LOADER.get()
+        print("Initializing VmAnalyzer at %s" % now.strftime("%Y-%m-%d %H:%M:%S"))
+        with self._timer.span("inventory"):
+            self._inventory_db = self._get_inventory_db()
+            self._vm_uuid = self._get_vm_uuid()
+            self._vm_host = self._get_vm_host()
 
         if not os.path.exists("/tmp/%s" % self._vm_uuid):
             os.mkdir("/tmp/%s" % self._vm_uuid)
             
 
     def __del__(self):
+        self.close()
+
+
+    def close(self, error=None):
+        # Safe to call more than once; the scheduler calls it as soon as the
+        # scan ends, with the error the scan failed with if any, __del__ is
+        # only a fallback.
+        if self._closed:
+            return
+        self._closed = True
         now = datetime.datetime.now()
-        self._remove_snapshot()
-        self._disconnect()
+        try:
+            self.stop_exports()
+            self._remove_snapshot()
+        finally:
+            self._disconnect(healthy=not is_vsphere_session_error(error))
         print("Terminating VmAnalyzer at %s" % now.strftime("%Y-%m-%d %H:%M:%S"))
         
 
-    def _connect(self):
-        print("Connecting to %s as %s" % (self._vm_host["name"], self._request["host_authentication"]["username"]))
-        smart_stub = SmartStubAdapter(
-            host = self._vm_host["name"],
-            port = 443,
-            sslContext = ssl._create_unverified_context(),
-            connectionPoolTimeout = 0
-        )
-        self._session_stub = VimSessionOrientedStub(
-            smart_stub,
-            VimSessionOrientedStub.makeUserLoginMethod(
-                self._request["host_authentication"]["username"],
-                self._request["host_authentication"]["password"]
-            )
+    def _credentials(self):
+        return (
+            self._vm_host["name"],
+            self._request["host_authentication"]["username"],
+            self._request["host_authentication"]["password"]
         )
-        si = vim.ServiceInstance('ServiceInstance', self._session_stub)
 
-        if not si:
-            raise Exception("Could not connect to %s" % self._vm_host["name"])
 
-        return si
+    def _connect(self):
+        self._session = VSPHERE_SESSIONS.acquire(*self._credentials())
+        SNAPSHOTS.sweep(self._credentials())
+        return self._session.si
       
 
-    def _disconnect(self):
-        try:
-            Disconnect(self._service_instance)
-        except:
-            pass
+    def _disconnect(self, healthy=True):
+        if self._session:
+            VSPHERE_SESSIONS.release(self._session, healthy)
+            self._session = None
+            self._service_instance = None
+
+
+    def _check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise ScanCancelled("Scan of VM MORef %s cancelled" % self._request["vm"]["moref"])
           
           
     def _get_inventory_db(self):
-        inventory_hostname = os.environ["INVENTORY_SERVICE"] + "." + os.environ["POD_NAMESPACE"] + ".svc.cluster.local"
-        inventory_socket   = inventory_hostname + ":" + os.environ["FORKLIFT_INVENTORY_SERVICE_PORT"]
-        inventory_db       = "https://" + inventory_socket + "/providers/vsphere/" + self._request["provider"]["uid"]
-        return inventory_db
+        return get_inventory_db(self._request["provider"]["uid"])
       
       
-    def _call_inventory_db(self, href_slug):
-        api_response = requests.get(self._inventory_db + href_slug, verify=os.environ["CA_TLS_CERTIFICATE"])
-        if(api_response.ok):
-            return json.loads(api_response.content)
-        else:
-            raise Exception("Failed call to inventory database, return code: %s" % api_response)
+    def _call_inventory_db(self, href_slug, max_age=None):
+        return INVENTORY_CLIENT.get(self._inventory_db + href_slug, max_age)
           
 
     def _get_vm_uuid(self):
@@ -156,51 +2853,61 @@ class VmAnalyzer:
       
       
     def _create_snapshot(self):
-        print("Creating snapshot to protect the VM disks")
-        task = self._vm.CreateSnapshot(name = self._snapshot_name,
-                                 description = self._snapshot_desc,
-                                 memory = False,
-                                 # The `quiesce` parameter can be False to
-                                 # make it slightly faster, but it should
-                                 # be first tested independently.
-                                 quiesce = True)
-        WaitForTask(task)
-        # Update the VM data
-        self._vm.Reload()
-        self._snapshot = self._vm.snapshot.currentSnapshot
+        self._pending_snapshot = SNAPSHOTS.create(self._vm, self._snapshot_name, self._snapshot_desc,
+                                                  quiesce=self._request.get("quiesce", True))
+
+
+    def _wait_snapshot(self):
+        self._snapshot = self._pending_snapshot.wait()
         
 
     def _remove_snapshot(self):
-        print("Removing snapshot")
-        if self._snapshot:
-            WaitForTask(self._snapshot.RemoveSnapshot_Task(False))
+        # The reaper takes the pending snapshot if creation didn't complete
+        if self._pending_snapshot:
+            SNAPSHOTS.remove(self._vm, self._snapshot_name, self._snapshot or self._pending_snapshot, self._credentials())
+            self._pending_snapshot = None
+            self._snapshot = None
             
 
-    def _path_win2lin(self, path):
-        if not re.compile('^/').match(path):
-            path = re.sub('^.*/', '/', path)
-        return path
-      
-
     def _get_vm_disks(self):
-        host = self._vm.runtime.host
+        # Not taken from the cache: the change IDs decide whether the
+        # previous result can be reused
         print("Getting VM disk details")
         href_slug = "/vms/" + self._request["vm"]["moref"]
-        return self._call_inventory_db(href_slug)["disks"]
+        return self._call_inventory_db(href_slug, max_age=0)["disks"]
 
 
-    def _get_vm_software(self, vm_disks):
-        self._create_snapshot()
-        print("Snapshot MORef: %s" % self._snapshot._moId)
+    def _nbdkit_filters(self, disk):
+        config = self._request.get("nbdkit", {})
+        filters = config.get("disks", {}).get(disk["file"], config.get("filters", NBDKIT_FILTERS))
+        if not isinstance(filters, list) or not all(isinstance(f, dict) for f in filters):
+            raise Exception("nbdkit filters for disk %s must be a list of objects" % disk["file"])
+        for nbd_filter in filters:
+            options = NBDKIT_ALLOWED_FILTERS.get(nbd_filter.get("name"))
+            if options is None:
+                raise Exception("Unsupported nbdkit filter for disk %s: %s" % (disk["file"], nbd_filter.get("name")))
+            for key, value in nbd_filter.items():
+                if key == "name":
+                    continue
+                if key not in options:
+                    raise Exception("Unsupported option of nbdkit filter %s: %s" % (nbd_filter["name"], key))
+                if nbdkit_option_value(value, options[key]) is None:
+                    raise Exception("Option %s of nbdkit filter %s must be a %s, not %s" % (key, nbd_filter["name"], options[key], json.dumps(value)))
+        return filters
 
-        nbdkit_env = os.environ.copy()
-        sockets_paths = []
-        nbd_servers = []
-        for index, disk in enumerate(vm_disks):
-            socket_path = "/tmp/%s/%s.sock" % (self._vm_uuid, "d%0.5d" % index)
-            nbdkit_env = { 'LD_LIBRARY_PATH': '/opt/vmware-vix-disklib-distrib/lib64' }
-            nbdkit_cmd = ['/usr/sbin/nbdkit', '--readonly', '--exit-with-parent', '--newstyle']
-            nbdkit_cmd.extend(['--unix', socket_path])
+
+    def _nbdkit_cmd(self, disk, socket_path, pidfile, statsfile):
+        nbdkit_cmd = ['/usr/sbin/nbdkit', '--readonly', '--exit-with-parent', '--newstyle']
+        nbdkit_cmd.extend(['--unix', socket_path, '--pidfile', pidfile])
+
+        # The first filter is the closest to the client. The stats filter is
+        # the last one, so it counts what the plugin had to serve.
+        filters = self._nbdkit_filters(disk)
+        for nbd_filter in filters:
+            nbdkit_cmd.append('--filter=%s' % nbd_filter["name"])
+        nbdkit_cmd.append('--filter=stats')
+
+        if NBDKIT_PLUGIN == "vddk":
             nbdkit_cmd.extend(['vddk', 'libdir=/opt/vmware-vix-disklib-distrib'])
             nbdkit_cmd.extend(['server=%s' % self._vm_host["name"]])
             nbdkit_cmd.extend(['user=%s' % self._request["host_authentication"]["username"]])
@@ -209,31 +2916,163 @@ class VmAnalyzer:
             nbdkit_cmd.extend(['file=%s' % disk["file"]])
             nbdkit_cmd.extend(['vm=moref=%s' % self._vm._moId])
             nbdkit_cmd.extend(['snapshot=%s' % self._snapshot._moId])
-            nbd_server = subprocess.Popen(nbdkit_cmd, env=nbdkit_env)
+        elif NBDKIT_PLUGIN == "file":
+            # "[datastore] dir/disk.vmdk" is served from NBDKIT_FILE_ROOT/datastore/dir/disk.vmdk
+            match = re.match(r"^\[(.*?)\] (.*)$", disk["file"])
+            nbdkit_cmd.extend(['file', 'file=%s' % os.path.join(NBDKIT_FILE_ROOT, match.group(1), match.group(2))])
+        elif NBDKIT_PLUGIN == "memory":
+            nbdkit_cmd.extend(['memory', 'size=%d' % disk.get("capacity", 1024 * 1024 * 1024)])
+        else:
+            raise Exception("Unsupported nbdkit plugin: %s" % NBDKIT_PLUGIN)
 
-            # Allowing some time for the socket to be created
-            for i in range(10):
-                if os.path.exists(socket_path):
-                    break
-                time.sleep(1)
+        for nbd_filter in filters:
+            options = NBDKIT_ALLOWED_FILTERS[nbd_filter["name"]]
+            for key, value in nbd_filter.items():
+                if key != "name":
+                    nbdkit_cmd.append('%s=%s' % (key, nbdkit_option_value(value, options[key])))
+        nbdkit_cmd.extend(['statsfile=%s' % statsfile, 'statsappend=false'])
+        return nbdkit_cmd
 
-            sockets_paths.append(socket_path)
-            nbd_servers.append(nbd_server)
 
+    def _changed_areas_provider(self):
+        return VsphereChangedAreas(self._vm, self._snapshot)
+
+
+    def _start_block_cache(self, disk, export, provider, nbdkit_env):
+        # The cache proxy becomes the export libguestfs connects to, and the
+        # nbdkit serving the disk becomes its upstream.
+        info = provider.disk_info(disk)
+        if info is None or not info["change_id"]:
+            print("No changed block tracking for disk %s, not caching" % disk["file"])
+            return
+        cache_dir, status = BLOCK_CACHE_STORE.prepare(info["uuid"], info["size"], info["change_id"],
+                                                       lambda since: provider.changed_areas(info, since))
+        if cache_dir is None:
+            return
+        cache = {
+            "disk": disk["file"],
+            "uuid": info["uuid"],
+            "change_id": info["change_id"],
+            "status": status,
+            "socket_path": export["socket_path"].replace(".sock", "-cache.sock"),
+            "pidfile": export["pidfile"].replace(".pid", "-cache.pid")
+        }
+        for path in [cache["socket_path"], cache["pidfile"]]:
+            if os.path.exists(path):
+                os.remove(path)
+        nbdkit_cmd = block_cache_cmd(cache["socket_path"], cache["pidfile"], export["socket_path"], cache_dir)
         try:
-            g = guestfs.GuestFS(python_return_dict=True)
-            g.set_backend("direct")
-            for socket_path in sockets_paths:
-                g.add_drive_opts("", protocol="nbd", format="raw", server=["unix:%s" % socket_path], readonly=1)
-            g.launch()
-
-            roots = g.inspect_os()
-            if len(roots) == 0:
-                raise(Error("inspect_os: no operating systems found"))
-
-            operating_systems = []
-            for root in roots:
-                osh = {}
+            cache["process"] = subprocess.Popen(nbdkit_cmd, env=nbdkit_env)
+        except Exception:
+            BLOCK_CACHE_STORE.release(info["uuid"])
+            raise
+        export["cache"] = cache
+        export["drive_socket"] = cache["socket_path"]
+
+
+    def _start_nbd_exports(self, vm_disks, exports):
+        # All the nbdkit processes are started at once. nbdkit writes its
+        # pidfile only once the socket accepts connections, so the pidfile
+        # is the readiness signal.
+        nbdkit_env = { 'LD_LIBRARY_PATH': '/opt/vmware-vix-disklib-distrib/lib64' }
+        provider = self._changed_areas_provider() if self._request.get("incremental") else None
+        for index, disk in enumerate(vm_disks):
+            export = {
+                "disk": disk["file"],
+                "filters": [f["name"] for f in self._nbdkit_filters(disk)],
+                "socket_path": "/tmp/%s/%s.sock" % (self._vm_uuid, "d%0.5d" % index),
+                "pidfile": "/tmp/%s/%s.pid" % (self._vm_uuid, "d%0.5d" % index),
+                "statsfile": "/tmp/%s/%s.stats" % (self._vm_uuid, "d%0.5d" % index),
+                "cache": None,
+                "attached": True
+            }
+            export["drive_socket"] = export["socket_path"]
+            for path in [export["socket_path"], export["pidfile"], export["statsfile"]]:
+                if os.path.exists(path):
+                    os.remove(path)
+            nbdkit_cmd = self._nbdkit_cmd(disk, export["socket_path"], export["pidfile"], export["statsfile"])
+            export["process"] = subprocess.Popen(nbdkit_cmd, env=nbdkit_env)
+            exports.append(export)
+            if provider:
+                self._start_block_cache(disk, export, provider, nbdkit_env)
+        wait_for_nbd_exports(exports + [e["cache"] for e in exports if e["cache"]], NBDKIT_START_TIMEOUT)
+
+
+    def _triage_exports(self, exports):
+        self._triage = []
+        for index, export in enumerate(exports):
+            try:
+                triage = triage_disk(export["drive_socket"], index)
+            except Exception as e:
+                print("[ERROR] Could not triage disk %s: %s" % (export["disk"], e))
+                triage = { "class": "unknown", "attached": True }
+            export["attached"] = triage["attached"]
+            self._triage.append(dict(triage, disk=export["disk"]))
+        linux = any(fs in LINUX_FILESYSTEMS for t in self._triage for fs in t.get("filesystems", []))
+        os_disks = [t for t in self._triage if t["class"] == "os"]
+        root_vgs = set(vg for t in os_disks for vg in t.get("vgs", []))
+        # Without a root filesystem on the OS disks, root is on a logical
+        # volume of a volume group that may not reach them
+        root_on_lvm = not any(t.get("root") for t in os_disks)
+        for export, triage in zip(exports, self._triage):
+            if not os_disks:
+                # Nothing looks like an OS disk, let inspection decide
+                export["attached"] = triage["attached"] = True
+            elif triage["class"] == "lvm":
+                vgs = set(triage.get("vgs", [None]))
+                needed = None in vgs or vgs & root_vgs or (root_on_lvm and not root_vgs)
+                export["attached"] = triage["attached"] = bool(needed)
+            elif triage["class"] == "ntfs" and not linux:
+                # NTFS is only plain data on a Linux guest
+                export["attached"] = triage["attached"] = True
+        for triage in self._triage:
+            if not triage["attached"]:
+                print("Not attaching %s disk %s" % (triage["class"], triage["disk"]))
+
+
+    def _stop_nbd_exports(self, exports):
+        # The cache proxies go first so they flush their bitmap while the
+        # upstream is still there. nbdkit writes the stats file when it exits
+        # cleanly, so it gets a chance to shut down before being killed.
+        caches = [e["cache"] for e in exports if e["cache"]]
+        for cache in caches:
+            stop_nbdkit(cache["process"])
+            BLOCK_CACHE_STORE.release(cache["uuid"])
+            for path in [cache["socket_path"], cache["pidfile"]]:
+                if os.path.exists(path):
+                    os.remove(path)
+        for export in exports:
+            export["process"].terminate()
+        nbd_stats = []
+        for export in exports:
+            stop_nbdkit(export["process"])
+            nbd_stats.append({
+                "disk": export["disk"],
+                "filters": export["filters"],
+                "block_cache": export["cache"]["status"] if export["cache"] else None,
+                "stats": read_nbdkit_stats(export["statsfile"])
+            })
+            for operation, operation_stats in nbd_stats[-1]["stats"].items():
+                METRICS.inc("nbd_requests_total", operation_stats["requests"], operation=operation)
+                METRICS.inc("nbd_bytes_total", operation_stats.get("bytes", 0), operation=operation)
+            for path in [export["socket_path"], export["pidfile"], export["statsfile"]]:
+                if os.path.exists(path):
+                    os.remove(path)
+        if caches:
+            BLOCK_CACHE_STORE.evict()
+        return nbd_stats
+
+
+    def _get_vm_software(self, g, roots):
+        if len(roots) == 0:
+            raise Exception("inspect_os: no operating systems found")
+
+        collector = ContentCollector()
+        operating_systems = []
+        for root in roots:
+            self._check_cancelled()
+            osh = {}
+            with self._timer.span("inspect_root"):
                 #osh["filesystems"] = g.inspect_get_filesystems(root)
                 osh["mountpoints"] = g.inspect_get_mountpoints(root)
                 osh["name"] = g.inspect_get_product_name(root)
@@ -247,77 +3086,316 @@ class VmAnalyzer:
                 osh["package_management"] = g.inspect_get_package_management(root)
                 osh["hostname"] = g.inspect_get_hostname(root)
 
-                for device, mp in sorted(osh["mountpoints"].items(), key=lambda k: len(k[0])):
-                    try:
-                        g.mount_ro(mp, device)
-                    except RuntimeError as err:
-                        raise err
-
-                osh["packages"] = g.inspect_list_applications2(root)
-
-                # with open("/data/manifest.json") as f:
-                #     manifest = json.load(f)
-                manifest = MANIFEST
-                
-                ext_ap_files = []
-                for ap_file in manifest["files"]:
-                    if '*' in ap_file["path"]:
-                        #print("%s is a wildcard. Extending" % ap_file["path"])
-                        founds = g.find(os.path.dirname(self._path_win2lin(ap_file["path"])))
-                        for f in founds:
-                            if re.compile(ap_file["path"]).match(f):
-                                ext_ap_files.append({ "path": f, "collect_content": ap_file["collect_content"]})
-                    else:
-                        #print("%s is NOT a wildcard. Adding" % ap_file["path"])
-                        ext_ap_files.append(ap_file)
-                #print("Extended AP Files: %s" % ext_ap_files)
-                
+            matcher = self._manifest.matcher(osh["type"], osh["distro"])
+            planner = MountPlanner(g, osh["mountpoints"], matcher, osh["package_format"])
+            with self._timer.span("mount"):
+                planner.mount_for_packages()
+            with self._timer.span("packages"):
+                osh["registry"] = []
+                if osh["type"] == "windows":
+                    osh["packages"], osh["registry"] = REGISTRY_INVENTORY.scan(g, root, self._manifest)
+                else:
+                    osh["packages"] = PACKAGE_LISTER.list_applications(g, root, osh["package_format"])
+
+            with self._timer.span("mount"):
+                planner.mount_for_manifest()
+            with self._timer.span("files"):
+                ext_ap_files = matcher.expand(g)
                 osh["files"] = []
-                for ap_file in ext_ap_files:
-                    path = self._path_win2lin(ap_file["path"])
-                    # Skip files that don't exist
-                    if not g.is_file_opts(self._path_win2lin(path), followsymlinks=True):
-                        #print("%s doesn't exist. Skipping" % ap_file["path"])
-                        continue
-                
+                for ap_file in FileProber().probe(g, ext_ap_files):
+                    osh_file = {
+                        "name": ap_file["name"],
+                        "type": ap_file["type"],
+                        "size": ap_file["size"],
+                        "mtime": ap_file["mtime"]
+                    }
                     # Collect the content of the file is requested
-                    if ap_file["collect_content"]:
-                        content = "\n".join(g.read_lines(path))
-                    else:
-                        content = None
-                
-                    osh["files"].append({ "name": ap_file["path"], "content": content})
+                    osh_file.update(collector.collect(g, ap_file))
+                    osh["files"].append(osh_file)
 
-                g.umount_all()
-                operating_systems.append(osh)
-            return operating_systems
+            osh["skipped_mountpoints"] = planner.skipped()
+            g.umount_all()
+            operating_systems.append(osh)
+        return operating_systems
 
-        except Exception as e:
-            os._exit()
-            print("[ERROR] %s" % e)
-            raise e
+
+    def get_vm_placement(self):
+        # The placement only decides the concurrency slot, the cached
+        # inventory is good enough for it
+        datastores = set()
+        for disk in self._call_inventory_db("/vms/" + self._request["vm"]["moref"])["disks"]:
+            match = re.match(r"^\[(.*?)\]", disk["file"])
+            if match:
+                datastores.add(match.group(1))
+        return { "host": self._vm_host["name"], "datastores": sorted(datastores) }
+
+
+    def get_cached_vm_config(self):
+        if self._request.get("force"):
+            return None
+        vm_config = RESULT_STORE.get(self._vm_uuid, ResultStore.fingerprint(self._get_vm_disks(), self._manifest.version))
+        if vm_config is not None:
+            print("VM %s hasn't changed since its last scan, using cached result" % self._vm_uuid)
+            vm_config = dict(vm_config, cached=True)
+        return vm_config
+
+
+    # The scan stages, in order. get_vm_config() runs them back to back, the
+    # batch pipeline schedules each of them separately.
+    def connect(self):
+        self._check_cancelled()
+        with self._timer.span("connect"):
+            self._service_instance = self._connect()
+            self._vm = self._find_vm_by_uuid()
+            self._vm_disks = self._get_vm_disks()
+
+
+    def start_snapshot(self):
+        self._check_cancelled()
+        with self._timer.span("snapshot"):
+            self._create_snapshot()
+
+
+    def snapshot(self):
+        self.start_snapshot()
+        with self._timer.span("snapshot"):
+            self._wait_snapshot()
+
+
+    def start_exports(self):
+        self._check_cancelled()
+        with self._timer.span("snapshot"):
+            self._wait_snapshot()
+        print("Snapshot MORef: %s" % self._snapshot._moId)
+        with self._timer.span("exports"):
+            self._start_nbd_exports(self._vm_disks, self._exports)
+        if self._request.get("triage", TRIAGE_DISKS):
+            with self._timer.span("triage"):
+                self._triage_exports(self._exports)
+
+
+    def acquire_appliance(self):
+        with self._timer.span("appliance"):
+            return APPLIANCE_POOL.acquire()
+
+
+    def inspect(self, appliance=None):
+        if appliance is None:
+            appliance = self.acquire_appliance()
+        healthy = False
+        try:
+            self._check_cancelled()
+            self._launch(appliance)
+            with self._timer.span("inspect_os"):
+                roots = appliance.g.inspect_os()
+            if self.needs_left_out_disks(appliance.g, roots):
+                # Drives can't be added to a launched direct appliance, so
+                # the inspection starts over on a new one with every disk
+                print("VM %s mounts a disk left out by triage, inspecting it with all its disks" % self.vm_moref())
+                self.reattach_disks()
+                APPLIANCE_POOL.release(appliance, False)
+                appliance = None
+                appliance = self.acquire_appliance()
+                self._launch(appliance)
+                with self._timer.span("inspect_os"):
+                    roots = appliance.g.inspect_os()
+            else:
+                self.stop_left_out_exports()
+            self._software = self._get_vm_software(appliance.g, roots)
+            healthy = True
+        finally:
+            if appliance is not None:
+                APPLIANCE_POOL.release(appliance, healthy)
+            self.stop_exports()
+
+
+    def _launch(self, appliance):
+        with self._timer.span("launch"):
+            for socket_path in self.drive_sockets():
+                appliance.add_nbd_drive(socket_path)
+            appliance.launch()
+
+
+    def needs_left_out_disks(self, g, roots):
+        # True when a disk left out by triage turns out to be needed: no OS
+        # was found, or a mountpoint of the guest isn't on the attached
+        # disks. inspect_get_mountpoints drops the fstab entries whose UUID
+        # or label can't be resolved, and maps /dev/sdX names to whatever
+        # the appliance has, so the fstab is also checked on its own.
+        if all(export["attached"] for export in self._exports):
+            return False
+        if len(roots) == 0:
+            return True
+        filesystems = g.list_filesystems()
+        for root in roots:
+            if any(device not in filesystems for device in g.inspect_get_mountpoints(root).values()):
+                return True
+            if g.inspect_get_type(root) == "linux" and self._unresolved_fstab_entries(g, root):
+                return True
+        return False
+
+
+    def _unresolved_fstab_entries(self, g, root):
+        g.mount_ro(root, "/")
+        try:
+            if not g.is_file("/etc/fstab"):
+                return []
+            fstab = g.cat("/etc/fstab")
+        finally:
+            g.umount_all()
+        lvs = set()
+        for lv in g.lvs():
+            vg_name, lv_name = lv.split("/")[2:4]
+            lvs.update([lv, "/dev/mapper/%s-%s" % (vg_name.replace("-", "--"), lv_name.replace("-", "--"))])
+        unresolved = []
+        for line in fstab.splitlines():
+            fields = line.split()
+            if len(fields) < 3 or fields[0].startswith("#") or not fields[1].startswith("/") or fields[2] == "swap":
+                continue
+            if len(fields) > 3 and "noauto" in fields[3].split(","):
+                continue
+            if not self._fstab_device_found(g, fields[0], lvs):
+                unresolved.append(fields[0])
+        return unresolved
+
+
+    def _fstab_device_found(self, g, spec, lvs):
+        by_id = re.match(r"^/dev/disk/by-(uuid|label)/(.+)$", spec)
+        disk = re.match(r"^/dev/(?:xvd|vd|sd|hd)([a-z]+)[0-9]*$", spec)
+        try:
+            if spec.startswith("UUID=") or (by_id and by_id.group(1) == "uuid"):
+                g.findfs_uuid(spec[5:].strip("\"'") if spec.startswith("UUID=") else by_id.group(2))
+            elif spec.startswith("LABEL=") or by_id:
+                label = spec[6:].strip("\"'") if spec.startswith("LABEL=") else by_id.group(2)
+                g.findfs_label(re.sub(r"\\x([0-9a-fA-F]{2})", lambda m: chr(int(m.group(1), 16)), label))
+            elif disk:
+                # The guest names its disks in the order of the VM's disks
+                index = 0
+                for letter in disk.group(1):
+                    index = index * 26 + ord(letter) - ord("a") + 1
+                return index - 1 < len(self._exports) and self._exports[index - 1]["attached"]
+            elif spec.startswith("/dev/"):
+                # Logical volumes are found, other paths (by-id, by-path,
+                # by-partuuid, md, LUKS mappings) can't be matched to a disk
+                return spec in lvs
+            elif "=" in spec:
+                # PARTUUID=, PARTLABEL=
+                return False
+        except RuntimeError:
+            return False
+        # Not a block device: tmpfs, proc, network or bind mounts
+        return True
+
+
+    def stop_left_out_exports(self):
+        # Once inspection has shown that the guest doesn't mount them
+        left_out = [export for export in self._exports if not export["attached"]]
+        if left_out:
+            with self._timer.span("stop_exports"):
+                self._nbd_stats.extend(self._stop_nbd_exports(left_out))
+            self._exports = [export for export in self._exports if export["attached"]]
+
+
+    def reattach_disks(self):
+        for export in self._exports:
+            export["attached"] = True
+        for triage in self._triage or []:
+            if not triage["attached"]:
+                triage["attached"] = triage["reattached"] = True
+
+
+    def vm_moref(self):
+        return self._request["vm"]["moref"]
+
+
+    def drive_sockets(self):
+        return [export["drive_socket"] for export in self._exports if export["attached"]]
+
+
+    def inspect_roots(self, g, roots):
+        # Inspection of this VM's roots on an appliance shared with other VMs
+        self._check_cancelled()
+        try:
+            self._software = self._get_vm_software(g, roots)
         finally:
-            for nbd_server in nbd_servers:
-                nbd_server.kill()
-            for socket_path in sockets_paths:
-                os.remove(socket_path)
+            g.umount_all()
 
 
-    def get_vm_config(self):
-        vm_disks = self._get_vm_disks()
+    def stop_exports(self):
+        if self._exports:
+            with self._timer.span("stop_exports"):
+                self._nbd_stats.extend(self._stop_nbd_exports(self._exports))
+            self._exports = []
+
+
+    def finish(self):
         vm_config = {
-            "disks": vm_disks,
-            "software": self._get_vm_software(vm_disks),
+            "disks": self._vm_disks,
+            "software": self._software,
+            "nbd": self._nbd_stats,
+            "triage": self._triage,
+            "manifest_version": self._manifest.version,
+            "timings": self._timer.to_dict(),
+            "cached": False
         }
+        RESULT_STORE.put(self._vm_uuid, ResultStore.fingerprint(self._vm_disks, self._manifest.version), vm_config)
         return vm_config
+
+
+    def get_vm_config(self, use_cache=True):
+        vm_config = self.get_cached_vm_config() if use_cache else None
+        if vm_config is not None:
+            return vm_config
+        self.connect()
+        self.start_snapshot()
+        # The appliance is prepared while vSphere takes the snapshot
+        appliance = self.acquire_appliance()
+        try:
+            self.start_exports()
+        except Exception:
+            APPLIANCE_POOL.release(appliance, False)
+            raise
+        self.inspect(appliance)
+        return self.finish()
       
 
 class Scanning(Resource):
     def post(self):
-        post_body = request.get_json()      
-        scan = ConcurrentScan(post_body)
-        scan.start()
-        return "Scan started for VM MORef: " + post_body["vm"]["moref"]
+        post_body = request.get_json(silent=True)
+        try:
+            ScanScheduler.validate(post_body)
+        except Exception as e:
+            return { "error": str(e) }, 400
+        job = SCAN_SCHEDULER.submit(post_body, post_body.get("priority", 0))
+        if job is None:
+            return { "error": "Scan queue is full" }, 429, { "Retry-After": str(SCAN_RETRY_AFTER) }
+        return job.to_dict(), 202, { "Location": "/scan/%s" % job.id }
+
+
+class BatchScanning(Resource):
+    def post(self):
+        batch = request.get_json(silent=True)
+        try:
+            ScanPipeline.validate(batch)
+        except Exception as e:
+            return { "error": str(e) }, 400
+        lines = (json.dumps(line) + "\n" for line in SCAN_PIPELINE.run(batch))
+        return Response(lines, mimetype="application/x-ndjson")
+
+
+class ScanStatus(Resource):
+    def get(self, job_id):
+        job = SCAN_SCHEDULER.get(job_id)
+        if job is None:
+            return { "error": "No scan with id %s" % job_id }, 404
+        return job.to_dict()
+
+
+    def delete(self, job_id):
+        job = SCAN_SCHEDULER.cancel(job_id)
+        if job is None:
+            return { "error": "No scan with id %s" % job_id }, 404
+        return job.to_dict()
       
 
 class Debug(Resource):
@@ -325,11 +3403,73 @@ class Debug(Resource):
         return "<h1>Debug</h1><p>Working</p>"
       
 
+class PrometheusMetrics(Resource):
+    def get(self):
+        return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+
+class AppliancePoolStats(Resource):
+    def get(self):
+        return APPLIANCE_POOL.stats()
+
+
+class ResultStoreStats(Resource):
+    def get(self):
+        return RESULT_STORE.stats()
+
+
+class InventoryStats(Resource):
+    def get(self):
+        return INVENTORY_CLIENT.stats()
+
+
+class VsphereSessionStats(Resource):
+    def get(self):
+        return VSPHERE_SESSIONS.stats()
+
+
+class SnapshotStats(Resource):
+    def get(self):
+        return SNAPSHOTS.stats()
+
+
+class PackageListerStats(Resource):
+    def get(self):
+        return PACKAGE_LISTER.stats()
+
+
+class RegistryInventoryStats(Resource):
+    def get(self):
+        return REGISTRY_INVENTORY.stats()
+
+
 def main():     
     app = Flask(__name__)
     api = Api(app)
     api.add_resource(Scanning, '/scan')
+    api.add_resource(BatchScanning, '/scan/batch')
+    api.add_resource(ScanStatus, '/scan/<string:job_id>')
     api.add_resource(Debug, '/debug')
+    api.add_resource(AppliancePoolStats, '/debug/appliances')
+    api.add_resource(ResultStoreStats, '/debug/results')
+    api.add_resource(InventoryStats, '/debug/inventory')
+    api.add_resource(VsphereSessionStats, '/debug/sessions')
+    api.add_resource(SnapshotStats, '/debug/snapshots')
+    api.add_resource(PackageListerStats, '/debug/packages')
+    api.add_resource(RegistryInventoryStats, '/debug/registry')
+    api.add_resource(PrometheusMetrics, '/metrics')
+    METRICS.register("scheduler", SCAN_SCHEDULER)
+    METRICS.register("appliances", APPLIANCE_POOL, ["hits", "misses", "recycled", "discarded"])
+    METRICS.register("results", RESULT_STORE, ["hits", "misses", "evictions"])
+    METRICS.register("inventory", INVENTORY_CLIENT, ["requests", "hits", "coalesced", "evictions"])
+    METRICS.register("sessions", VSPHERE_SESSIONS, ["logins", "reused", "waits", "expired"])
+    METRICS.register("snapshots", SNAPSHOTS, ["created", "removed", "failed", "orphans", "latency_count", "latency_sum"])
+    METRICS.register("packages", PACKAGE_LISTER, ["hits", "misses", "evictions", "fallbacks"])
+    METRICS.register("registry", REGISTRY_INVENTORY, ["hits", "misses", "evictions", "fallbacks"])
+    APPLIANCE_POOL.start()
+    SCAN_SCHEDULER.start()
+    VSPHERE_SESSIONS.start()
+    SNAPSHOTS.start()
     app.run(host= '0.0.0.0')
     
 